@@ -1,12 +1,9 @@
-from concert_app.extensions import app, db
-from concert_app.main.routes import main
-from concert_app.auth.routes import auth
+from concert_app.extensions import db
+from concert_app.factory import create_app
 
-app.register_blueprint(main)
-app.register_blueprint(auth)
-
-with app.app_context():
-    db.create_all()
+app = create_app()
 
 if __name__ == "__main__":
+    with app.app_context():
+        db.create_all()
     app.run(debug=True)
@@ -0,0 +1,63 @@
+"""Bytes sent for the list pages and static files, with and without gzip.
+
+    python benchmarks/compression.py
+
+Requests each page of a seeded database (see `flask seed`) once plain and
+once with `Accept-Encoding: gzip, br`, and prints the bytes on the wire
+and the share saved. Static files are measured from the last
+`flask assets build`, if there is one.
+"""
+import os
+import sys
+
+from flask import url_for
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from concert_app.factory import create_app  # noqa: E402
+
+PAGES = [
+    '/',
+    '/concert',
+    '/concert?sort=popular',
+    '/artist',
+    '/artist?sort=popular',
+    '/search?q=punk',
+    '/trending?window=30d',
+    '/api/v1/concerts',
+    '/api/v1/artists',
+]
+
+STATIC = ['style.css', 'autocomplete.js', 'nearby.js']
+
+
+def measure(client, url):
+    plain = client.get(url)
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    return (plain.status_code, len(plain.get_data()),
+            len(compressed.get_data()),
+            compressed.headers.get('Content-Encoding', '-'))
+
+
+def main():
+    app = create_app()
+    client = app.test_client()
+    print(f'{"url":<28}{"status":>7}{"plain":>9}{"sent":>9}{"saved":>8}'
+          f'  encoding')
+    total_plain = total_sent = 0
+    with app.test_request_context():
+        static_urls = [url_for('static', filename=name) for name in STATIC]
+    for url in PAGES + static_urls:
+        status, plain, sent, encoding = measure(client, url)
+        total_plain += plain
+        total_sent += sent
+        saved = 1 - sent / plain if plain else 0
+        print(f'{url[:27]:<28}{status:>7}{plain:>9}{sent:>9}{saved:>8.0%}'
+              f'  {encoding}')
+    print(f'{"total":<35}{total_plain:>9}{total_sent:>9}'
+          f'{1 - total_sent / total_plain:>8.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""Latency, throughput and query counts of every page, against a baseline.
+
+    FLASK_APP=app.py flask db upgrade && FLASK_APP=app.py flask seed --scale 0.01
+    python benchmarks/load.py [--requests 50] [--concurrency 4]
+                              [--url http://localhost:5000]
+                              [--baseline benchmarks/baseline.json]
+                              [--save-baseline benchmarks/baseline.json]
+
+Each scenario is one route of the `main` and `auth` blueprints, requested
+`--requests` times by `--concurrency` threads. Requests go through the
+Flask test client in this process, or over HTTP to a running server with
+`--url` (which must use the same DATABASE_URL). The database is expected
+to come from `flask seed`: ids are picked from the seeded ranges, half
+among the most popular rows, and the workers log in as seeded users.
+
+Query counts come from the `Server-Timing` header added by
+`concert_app.instrumentation`. Against `--baseline` the run fails (exit
+status 1) when a route's median query count goes up, or its p95 latency
+grows by more than `--tolerance` and by at least `--min-delta-ms`.
+Write operations toggle back and forth (attend then unattend, ...) so
+repeated runs see the same data; signing up adds users named 'bench-*'.
+"""
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concert_app.extensions import db  # noqa: E402
+from concert_app.factory import create_app  # noqa: E402
+from concert_app.models import (  # noqa: E402
+    Artist, Concert, User, user_artist, user_concert)
+from concert_app.seed import PASSWORD, seed_username  # noqa: E402
+
+app = create_app()
+
+Response = namedtuple('Response', 'status headers text')
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+# Share of ids drawn from the most popular 1% of rows
+POPULAR_SHARE = 0.5
+
+# Unmeasured requests per thread before each scenario (even, so toggling
+# writes stay in step)
+WARMUP = 2
+
+##########################################
+#           Clients                      #
+##########################################
+
+
+class TestClient(object):
+    """Requests through the Flask test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return Response(response.status_code, response.headers,
+                        response.get_data(as_text=True))
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient(object):
+    """Requests over HTTP, keeping cookies and not following redirects."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirects())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                return Response(response.status, response.headers,
+                                response.read().decode('utf-8', 'replace'))
+        except urllib.error.HTTPError as error:
+            return Response(error.code, error.headers,
+                            error.read().decode('utf-8', 'replace'))
+
+##########################################
+#           Scenarios                    #
+##########################################
+
+
+class Catalogue(object):
+    """Id ranges and sample rows of the database being benchmarked."""
+
+    def __init__(self):
+        with app.app_context():
+            self.artists = db.session.query(db.func.max(Artist.id)).scalar()
+            self.concerts = db.session.query(db.func.max(Concert.id)).scalar()
+            # Users made by the signup scenario have no known profile names
+            self.users = (db.session.query(db.func.max(User.id))
+                          .filter(~User.username.startswith('bench-'))
+                          .scalar())
+            self.places = (db.session.query(Concert.latitude, Concert.longitude)
+                           .filter(Concert.geohash.isnot(None))
+                           .limit(100).all())
+        if not (self.artists and self.concerts and self.users):
+            sys.exit('The database is empty; run `flask seed` first.')
+
+    def pick(self, rng, highest):
+        if rng.random() < POPULAR_SHARE:
+            return rng.randint(1, max(1, highest // 100))
+        return rng.randint(1, highest)
+
+
+class Worker(object):
+    """One thread's clients: anonymous, logged in, and for logging in."""
+
+    def __init__(self, number, make_client, catalogue, seed):
+        self.number = number
+        self.catalogue = catalogue
+        self.rng = random.Random(seed * 1000 + number)
+        self.anonymous = make_client()
+        self.auth = make_client()
+        self.user = make_client()
+        user_id = number % catalogue.users + 1
+        self.username = seed_username(user_id)
+        self.csrf_token = csrf_token(self.auth.request('GET', '/login'))
+        login = self.user.request('POST', '/login', {
+            'username': self.username, 'password': PASSWORD,
+            'csrf_token': csrf_token(self.user.request('GET', '/login'))})
+        if login.status != 302:
+            sys.exit(f'Could not log in as {self.username}; was the '
+                     'database made by `flask seed`?')
+        # Rows the toggling writes flip on and back off again
+        self.concert_id = self.unused(user_concert, 'concert_id', user_id,
+                                      catalogue.concerts)
+        self.artist_id = self.unused(user_artist, 'artist_id', user_id,
+                                     catalogue.artists)
+
+    def unused(self, table, column, user_id, highest):
+        """Pick an id the user hasn't attended or favourited."""
+        with app.app_context():
+            while True:
+                id = self.catalogue.pick(self.rng, highest)
+                if not db.session.query(table).filter_by(
+                        user_id=user_id, **{column: id}).first():
+                    return id
+
+
+def csrf_token(response):
+    match = CSRF_TOKEN.search(response.text)
+    return match.group(1) if match else ''
+
+
+def artist(w, i):
+    return 'GET', f'/artist/{w.catalogue.pick(w.rng, w.catalogue.artists)}'
+
+
+def concert(w, i):
+    return 'GET', f'/concert/{w.catalogue.pick(w.rng, w.catalogue.concerts)}'
+
+
+def profile(w, i):
+    number = w.catalogue.pick(w.rng, w.catalogue.users)
+    return 'GET', f'/profile/{seed_username(number)}'
+
+
+def nearby(w, i):
+    latitude, longitude = w.rng.choice(w.catalogue.places or [(51.05, -114.07)])
+    return 'GET', f'/concert/nearby?lat={latitude:.4f}&lon={longitude:.4f}'
+
+
+def search(w, i):
+    query = w.rng.choice(['artist', 'show', 'punk band', 'venue 12',
+                          f'show {w.rng.randint(1, w.catalogue.concerts)}'])
+    return 'GET', '/search?' + urllib.parse.urlencode({'q': query})
+
+
+def autocomplete(w, i):
+    return 'GET', f'/artist/autocomplete?q=artist+{w.rng.randint(0, 99):02d}'
+
+
+def attend(w, i):
+    action = 'attending' if i % 2 == 0 else 'unattend'
+    return 'POST', f'/{action}/{w.concert_id}'
+
+
+def favourite(w, i):
+    action = 'favourite' if i % 2 == 0 else 'unfavourite'
+    return 'POST', f'/{action}/{w.artist_id}'
+
+
+def trending(w, i):
+    return 'GET', f'/trending?window={w.rng.choice(["24h", "7d", "30d"])}'
+
+
+def login(w, i):
+    return 'POST', '/login', {'username': w.username, 'password': PASSWORD,
+                              'csrf_token': w.csrf_token}
+
+
+def signup(w, i):
+    return 'POST', '/signup', {
+        'username': f'bench-{os.getpid()}-{w.number}-{i}-{time.time_ns()}',
+        'password': PASSWORD, 'csrf_token': w.csrf_token}
+
+
+def get(path):
+    return lambda w, i: ('GET', path)
+
+
+# (name, client, request maker)
+SCENARIOS = [
+    ('home', 'anonymous', get('/')),
+    ('concerts', 'anonymous', get('/concert')),
+    ('artists', 'anonymous', get('/artist')),
+    ('concerts popular', 'anonymous', get('/concert?sort=popular')),
+    ('artists popular', 'anonymous', get('/artist?sort=popular')),
+    ('search', 'anonymous', search),
+    ('autocomplete', 'anonymous', autocomplete),
+    ('nearby', 'anonymous', nearby),
+    ('trending', 'anonymous', trending),
+    ('artist', 'anonymous', artist),
+    ('concert', 'anonymous', concert),
+    ('profile', 'anonymous', profile),
+    ('login form', 'anonymous', get('/login')),
+    ('signup form', 'anonymous', get('/signup')),
+    ('home logged in', 'user', get('/')),
+    ('artist logged in', 'user', artist),
+    ('concert logged in', 'user', concert),
+    ('profile logged in', 'user', profile),
+    ('trending logged in', 'user', trending),
+    ('new artist form', 'user', get('/new_artist')),
+    ('new concert form', 'user', get('/new_concert')),
+    ('edit artist form', 'user', lambda w, i: ('GET', artist(w, i)[1] + '/edit')),
+    ('edit concert form', 'user', lambda w, i: ('GET', concert(w, i)[1] + '/edit')),
+    ('attend/unattend', 'user', attend),
+    ('favourite/unfavourite', 'user', favourite),
+    ('login', 'auth', login),
+    ('signup', 'auth', signup),
+    ('logout', 'auth', get('/logout')),
+]
+
+##########################################
+#           Running and reporting        #
+##########################################
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run_scenario(workers, client_name, make_request, requests):
+    samples, errors, lock = [], [0], threading.Lock()
+
+    def work(worker, count):
+        client = getattr(worker, client_name)
+        # An odd count gets one more unmeasured request to undo the last
+        for i in range(WARMUP + count + count % 2):
+            method, path, *data = make_request(worker, i)
+            started = time.perf_counter()
+            response = client.request(method, path, *data)
+            elapsed = (time.perf_counter() - started) * 1000
+            match = QUERIES.search(response.headers.get('Server-Timing', ''))
+            if not WARMUP <= i < WARMUP + count:
+                continue
+            with lock:
+                if response.status >= 400:
+                    errors[0] += 1
+                samples.append((elapsed, int(match.group(1)) if match else 0))
+
+    share, extra = divmod(requests, len(workers))
+    threads = [threading.Thread(target=work,
+                                args=(worker, share + (n < extra)))
+               for n, worker in enumerate(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for elapsed, _ in samples)
+    queries = sorted(count for _, count in samples)
+    return {
+        'requests': len(samples),
+        'errors': errors[0],
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'requests_per_s': round(len(samples) / wall, 1),
+        'queries': percentile(queries, 50),
+        'max_queries': queries[-1],
+    }
+
+
+def regressions(results, baseline, tolerance, min_delta_ms):
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['queries'] > before['queries']:
+            found.append(f'{name}: {result["queries"]} queries per request, '
+                         f'was {before["queries"]}')
+        slower = result['p95_ms'] - before['p95_ms']
+        if (result['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+                and slower >= min_delta_ms):
+            found.append(f'{name}: p95 {result["p95_ms"]:.1f}ms, '
+                         f'was {before["p95_ms"]:.1f}ms')
+        if result['errors']:
+            found.append(f'{name}: {result["errors"]} error responses')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=50,
+                        help='Requests per scenario.')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--url', help='Benchmark a running server instead.')
+    parser.add_argument('--scenario', action='append',
+                        help='Only run the named scenarios.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', help='Fail on regressions against it.')
+    parser.add_argument('--save-baseline', help='Write the results here.')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='Allowed p95 growth, as a fraction.')
+    parser.add_argument('--min-delta-ms', type=float, default=20,
+                        help='p95 growth always allowed, in ms.')
+    args = parser.parse_args()
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)  # noqa: E731
+    else:
+        make_client = TestClient
+    catalogue = Catalogue()
+    workers = [Worker(number, make_client, catalogue, args.seed)
+               for number in range(args.concurrency)]
+
+    print(f'{catalogue.artists} artists, {catalogue.concerts} concerts, '
+          f'{catalogue.users} users; {args.requests} requests per scenario, '
+          f'{args.concurrency} threads, '
+          f'{"HTTP " + args.url if args.url else "test client"}')
+    print(f'{"scenario":<24}{"p50":>8}{"p95":>8}{"p99":>8}{"req/s":>8}'
+          f'{"queries":>9}{"errors":>8}')
+    results = {}
+    for name, client_name, make_request in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        result = run_scenario(workers, client_name, make_request,
+                              args.requests)
+        results[name] = result
+        print(f'{name:<24}{result["p50_ms"]:8.1f}{result["p95_ms"]:8.1f}'
+              f'{result["p99_ms"]:8.1f}{result["requests_per_s"]:8.1f}'
+              f'{result["queries"]:9d}{result["errors"]:8d}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance,
+                                args.min_delta_ms)
+        for line in found:
+            print(f'REGRESSION {line}')
+        if found:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Concurrent read/write throughput of SQLite with and without the pragmas.
+
+    python benchmarks/sqlite_concurrency.py [--readers 4] [--writers 2]
+                                            [--seconds 5]
+
+Each run starts from a fresh database file of concerts, then readers run
+the homepage's upcoming concerts query and writers mark concerts as updated
+(one short transaction each), all in separate processes like gunicorn
+workers. The run is done once with SQLite's defaults (rollback journal) and
+once with the pragmas `concert_app.database` applies.
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concert_app.database import DEFAULTS, apply_sqlite_pragmas, sqlite_pragmas  # noqa: E402
+
+CONCERTS = 5000
+
+SCHEMA = [
+    'CREATE TABLE concert (id INTEGER PRIMARY KEY, name TEXT NOT NULL, '
+    'date DATE, updated_at DATETIME)',
+    'CREATE INDEX ix_concert_date_id ON concert (date, id)',
+]
+
+READ = ('SELECT id, name, date FROM concert WHERE date >= ? '
+        'ORDER BY date, id LIMIT 24')
+WRITE = "UPDATE concert SET updated_at = datetime('now') WHERE id = ?"
+
+
+def connect(path, tuned):
+    # Without the pragmas a locked database fails at once; give both runs
+    # the same timeout so only the journal mode and caching differ
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    if tuned:
+        apply_sqlite_pragmas(conn, sqlite_pragmas(DEFAULTS))
+    return conn
+
+
+def setup(path):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.executemany(
+        'INSERT INTO concert (name, date) VALUES (?, ?)',
+        [(f'Concert {i}', f'2030-{i % 12 + 1:02d}-{i % 28 + 1:02d}')
+         for i in range(CONCERTS)])
+    conn.commit()
+    conn.close()
+
+
+def worker(path, tuned, kind, seconds, results):
+    conn = connect(path, tuned)
+    done = errors = 0
+    deadline = time.perf_counter() + seconds
+    i = os.getpid()
+    while time.perf_counter() < deadline:
+        i += 1
+        try:
+            if kind == 'read':
+                conn.execute(READ, ('2030-06-01',)).fetchall()
+            else:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(WRITE, (i % CONCERTS + 1,))
+                conn.execute('COMMIT')
+            done += 1
+        except sqlite3.OperationalError:
+            errors += 1
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+    results.put((kind, done, errors))
+
+
+def run(tuned, readers, writers, seconds):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.db')
+    setup(path)
+    connect(path, tuned).close()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(path, tuned, kind, seconds, results))
+        for kind in ['read'] * readers + ['write'] * writers]
+    for process in processes:
+        process.start()
+    totals = {'read': [0, 0], 'write': [0, 0]}
+    for _ in processes:
+        kind, done, errors = results.get()
+        totals[kind][0] += done
+        totals[kind][1] += errors
+    for process in processes:
+        process.join()
+    return {kind: (done / seconds, errors)
+            for kind, (done, errors) in totals.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{args.readers} readers, {args.writers} writers, '
+          f'{args.seconds:g}s each')
+    for label, tuned in [('defaults', False), ('tuned', True)]:
+        totals = run(tuned, args.readers, args.writers, args.seconds)
+        reads, read_errors = totals['read']
+        writes, write_errors = totals['write']
+        print(f'{label:>8}: {reads:8.0f} reads/s  {writes:8.0f} writes/s  '
+              f'({read_errors + write_errors} busy errors)')
+
+
+if __name__ == '__main__':
+    main()
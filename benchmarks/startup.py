@@ -0,0 +1,73 @@
+"""Worker boot time: imports, `create_app()` and the first request.
+
+    python benchmarks/startup.py [--runs 10] [--budget-ms 1500]
+
+Each run starts a fresh interpreter, as a gunicorn worker or a test run
+would, and times importing the app's modules, building the app and
+serving a first request that doesn't touch the database. The medians are
+printed; with `--budget-ms` the script exits with status 1 when a median
+boot takes longer.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in each fresh interpreter and prints its timings as JSON
+PROBE = '''
+import json, time
+started = time.perf_counter()
+from concert_app.factory import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'total_ms': (served - started) * 1000,
+}))
+'''
+
+
+def run_once():
+    environment = dict(os.environ)
+    environment.setdefault('SECRET_KEY', 'startup-benchmark')
+    # A database that doesn't exist: startup must not need one
+    environment.setdefault('DATABASE_URL', 'sqlite:////nonexistent/boot.db')
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT, env=environment,
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float,
+                        help='Fail when the median boot is slower.')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    for name in ['import_ms', 'create_app_ms', 'first_request_ms',
+                 'total_ms']:
+        values = [run[name] for run in runs]
+        print(f'{name:>18}: median {statistics.median(values):7.1f}ms  '
+              f'max {max(values):7.1f}ms')
+
+    median = statistics.median(run['total_ms'] for run in runs)
+    if args.budget_ms is not None and median > args.budget_ms:
+        print(f'Median boot {median:.1f}ms is over the '
+              f'{args.budget_ms:g}ms budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+from datetime import datetime, timezone
+import json
+
+from flask import Blueprint, Response, request, jsonify, abort, stream_with_context
+
+from concert_app.models import Artist, Concert, User, user_artist, user_concert
+from concert_app.pagination import keyset_paginate
+from concert_app.routing import use_replica
+from concert_app.extensions import db
+
+api = Blueprint("api", __name__, url_prefix='/api/v1')
+
+# The API is read-only, so every request can read from a replica
+api.before_request(use_replica)
+
+# Largest page a client may ask for
+MAX_PER_PAGE = 100
+
+# Rows fetched per round trip from the server-side cursor during exports
+EXPORT_BATCH = 1000
+
+ARTIST_COLUMNS = [Artist.id, Artist.name, Artist.hometown, Artist.genre,
+                  Artist.biography, Artist.image, Artist.updated_at]
+
+CONCERT_COLUMNS = [Concert.id, Concert.name, Concert.price, Concert.venue,
+                   Concert.address, Concert.date, Concert.image,
+                   Concert.artist_id, Concert.updated_at]
+
+##########################################
+#           Helpers                      #
+##########################################
+
+
+def serialize(row, columns):
+    """Turn a row selected with `columns` into a JSON-ready dict."""
+    item = {}
+    for column, value in zip(columns, row):
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        elif value is not None and not isinstance(value, (int, float)):
+            value = str(value)
+        item[column.key] = value
+    return item
+
+
+def updated_since():
+    """Parse the `updated_since` argument, if given, as naive UTC.
+
+    Timestamps with an offset (`+02:00`, `Z`) are converted to UTC, as
+    `updated_at` columns are; ones without are taken to be UTC already.
+    """
+    value = request.args.get('updated_since')
+    if value is None:
+        return None
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description='updated_since must be an ISO 8601 timestamp')
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def json_page(query, columns, key_columns):
+    """Return one keyset-paginated page of `query` as JSON."""
+    per_page = min(max(request.args.get('limit', 50, type=int), 1),
+                   MAX_PER_PAGE)
+    page = keyset_paginate(query, key_columns,
+                           after=request.args.get('after'), per_page=per_page)
+    return jsonify(items=[serialize(row, columns) for row in page.items],
+                   next=page.next_cursor)
+
+
+def ndjson_export(query, columns):
+    """Stream every row of `query` as newline-delimited JSON.
+
+    Rows come from a server-side cursor `EXPORT_BATCH` at a time and each
+    batch is sent as one chunk, so memory use doesn't grow with the export.
+    """
+    def generate():
+        lines = []
+        for row in query.yield_per(EXPORT_BATCH):
+            lines.append(json.dumps(serialize(row, columns)))
+            if len(lines) == EXPORT_BATCH:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def artists_query():
+    query = db.session.query(*ARTIST_COLUMNS)
+    since = updated_since()
+    if since:
+        query = query.filter(Artist.updated_at >= since)
+    return query
+
+
+def concerts_query():
+    query = db.session.query(*CONCERT_COLUMNS)
+    since = updated_since()
+    if since:
+        query = query.filter(Concert.updated_at >= since)
+    return query
+
+
+def pairs_query(parent, pairs, key, since):
+    """Return the (parent id, username) rows of `pairs`, in key order.
+
+    With `since`, every parent updated since then is listed in full, and
+    one left with no rows at all gets a single row with a null username,
+    so a sync replacing the lists of changed parents sees it emptied.
+    """
+    if since is None:
+        columns = [pairs.c[key], User.username]
+        query = (db.session.query(*columns).select_from(pairs)
+                 .join(User, User.id == pairs.c.user_id)
+                 .order_by(pairs.c[key], pairs.c.user_id))
+        return query, columns
+    columns = [parent.id.label(key), User.username]
+    query = (db.session.query(*columns)
+             .outerjoin(pairs, pairs.c[key] == parent.id)
+             .outerjoin(User, User.id == pairs.c.user_id)
+             .filter(parent.updated_at >= since)
+             .order_by(parent.id, pairs.c.user_id))
+    return query, columns
+
+
+def fans_query():
+    # Favouriting touches the artist, so updated artists have changed fans
+    return pairs_query(Artist, user_artist, 'artist_id', updated_since())
+
+
+def attendees_query():
+    # Attending touches the concert, so updated concerts have changed guests
+    return pairs_query(Concert, user_concert, 'concert_id', updated_since())
+
+##########################################
+#           Routes                       #
+##########################################
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def error(e):
+    return jsonify(error=e.description), e.code
+
+
+@api.route('/artists')
+def artists():
+    """Page through artists by id"""
+    return json_page(artists_query(), ARTIST_COLUMNS, [Artist.id])
+
+
+@api.route('/artists.ndjson')
+def export_artists():
+    """Export every artist"""
+    return ndjson_export(artists_query().order_by(Artist.id), ARTIST_COLUMNS)
+
+
+@api.route('/concerts')
+def concerts():
+    """Page through concerts by id"""
+    return json_page(concerts_query(), CONCERT_COLUMNS, [Concert.id])
+
+
+@api.route('/concerts.ndjson')
+def export_concerts():
+    """Export every concert"""
+    return ndjson_export(concerts_query().order_by(Concert.id),
+                         CONCERT_COLUMNS)
+
+
+@api.route('/artists/<int:artist_id>/fans')
+def artist_fans(artist_id):
+    """Page through an artist's fans"""
+    Artist.query.get_or_404(artist_id)
+    columns = [User.id, User.username]
+    query = (db.session.query(*columns).join(user_artist)
+             .filter(user_artist.c.artist_id == artist_id))
+    return json_page(query, columns, [User.id])
+
+
+@api.route('/concerts/<int:concert_id>/attendees')
+def concert_attendees(concert_id):
+    """Page through a concert's guests"""
+    Concert.query.get_or_404(concert_id)
+    columns = [User.id, User.username]
+    query = (db.session.query(*columns).join(user_concert)
+             .filter(user_concert.c.concert_id == concert_id))
+    return json_page(query, columns, [User.id])
+
+
+@api.route('/fans.ndjson')
+def export_fans():
+    """Export every (artist, fan) pair"""
+    return ndjson_export(*fans_query())
+
+
+@api.route('/attendees.ndjson')
+def export_attendees():
+    """Export every (concert, guest) pair"""
+    return ndjson_export(*attendees_query())
@@ -0,0 +1,174 @@
+import json
+import unittest
+from datetime import date, datetime, timedelta
+
+from concert_app.identity import identities
+from concert_app.extensions import db, cache
+from concert_app.factory import create_app
+from concert_app.models import Concert, Artist, User
+
+"""
+Run these tests with:
+python3 -m unittest concert_app.api.tests
+"""
+
+app = create_app()
+
+#################################################
+# Setup
+#################################################
+
+
+def new_concerts(count):
+    # Creates one artist playing `count` concerts
+    artist = Artist(
+        name='Band',
+        hometown='Calgary',
+        genre='Punk',
+        biography='Punk band from Calgary'
+    )
+    for i in range(count):
+        db.session.add(Concert(
+            name=f'Show {i}',
+            price=10,
+            venue='The venue',
+            address='123 Main Street',
+            date=date.today() + timedelta(days=i),
+            artist_playing=artist
+        ))
+    db.session.commit()
+
+
+def read_ndjson(response):
+    return [json.loads(line) for line in
+            response.get_data(as_text=True).splitlines()]
+
+#################################################
+# Tests
+#################################################
+
+
+class ApiTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['DEBUG'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        identities.clear()
+
+    def test_concert_pages(self):
+        """Test walking every concert page with the next cursor."""
+        new_concerts(7)
+        names, url = [], '/api/v1/concerts?limit=3'
+        while url:
+            page = self.app.get(url).get_json()
+            names += [item['name'] for item in page['items']]
+            url = (page['next']
+                   and f'/api/v1/concerts?limit=3&after={page["next"]}')
+        self.assertEqual(names, [f'Show {i}' for i in range(7)])
+
+        item = self.app.get('/api/v1/concerts').get_json()['items'][0]
+        self.assertEqual(item['artist_id'], 1)
+        self.assertEqual(item['date'], date.today().isoformat())
+
+    def test_ndjson_export_streams(self):
+        """Test that exports are streamed one batch per chunk."""
+        new_concerts(5)
+        response = self.app.get('/api/v1/concerts.ndjson')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([row['id'] for row in read_ndjson(response)],
+                         [1, 2, 3, 4, 5])
+
+    def test_updated_since(self):
+        """Test that incremental syncs only see changed rows."""
+        new_concerts(3)
+        since = datetime.utcnow()
+        concert = Concert.query.get(2)
+        concert.name = 'Renamed'
+        db.session.commit()
+
+        rows = read_ndjson(self.app.get(
+            f'/api/v1/concerts.ndjson?updated_since={since.isoformat()}'))
+        self.assertEqual([row['name'] for row in rows], ['Renamed'])
+
+        response = self.app.get('/api/v1/concerts?updated_since=yesterday')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.get_json())
+
+    def test_updated_since_with_offset(self):
+        """Test that timestamps with a UTC offset are compared in UTC."""
+        new_concerts(2)
+        since = datetime.utcnow()
+        Concert.query.get(2).name = 'Renamed'
+        db.session.commit()
+
+        for stamp in [since.isoformat() + 'Z',
+                      (since + timedelta(hours=2)).isoformat() + '+02:00']:
+            rows = read_ndjson(self.app.get(
+                '/api/v1/concerts.ndjson',
+                query_string={'updated_since': stamp}))
+            self.assertEqual([row['name'] for row in rows], ['Renamed'],
+                             stamp)
+        rows = read_ndjson(self.app.get(
+            '/api/v1/concerts.ndjson', query_string={
+                'updated_since': (since + timedelta(hours=1)).isoformat()
+                + '+00:00'}))
+        self.assertEqual(rows, [])
+
+    def test_updated_since_shows_emptied_lists(self):
+        """Test that losing the last fan or guest reaches incremental syncs."""
+        new_concerts(2)
+        user = User(username='laurel1', password='x')
+        db.session.add(user)
+        db.session.commit()
+        user.favourite(1)
+        user.attend(1)
+        user.attend(2)
+        db.session.commit()
+        since = datetime.utcnow()
+        user.unfavourite(1)
+        user.unattend(1)
+        db.session.commit()
+
+        query = {'updated_since': since.isoformat()}
+        self.assertEqual(
+            read_ndjson(self.app.get('/api/v1/fans.ndjson',
+                                     query_string=query)),
+            [{'artist_id': 1, 'username': None}])
+        self.assertEqual(
+            read_ndjson(self.app.get('/api/v1/attendees.ndjson',
+                                     query_string=query)),
+            [{'concert_id': 1, 'username': None}])
+        self.assertEqual(
+            read_ndjson(self.app.get('/api/v1/attendees.ndjson')),
+            [{'concert_id': 2, 'username': 'laurel1'}])
+
+    def test_fans_and_attendees(self):
+        """Test listing and exporting relationship rows."""
+        new_concerts(1)
+        user = User(username='laurel1', password='x')
+        db.session.add(user)
+        db.session.commit()
+        user.favourite(1)
+        user.attend(1)
+        db.session.commit()
+
+        fans = self.app.get('/api/v1/artists/1/fans').get_json()
+        self.assertEqual(fans['items'], [{'id': 1, 'username': 'laurel1'}])
+        self.assertEqual(read_ndjson(self.app.get('/api/v1/fans.ndjson')),
+                         [{'artist_id': 1, 'username': 'laurel1'}])
+        self.assertEqual(
+            read_ndjson(self.app.get('/api/v1/attendees.ndjson')),
+            [{'concert_id': 1, 'username': 'laurel1'}])
+        response = self.app.get('/api/v1/concerts/9/attendees')
+        self.assertEqual(response.status_code, 404)
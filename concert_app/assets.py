@@ -0,0 +1,155 @@
+"""Fingerprinted, precompressed static files.
+
+    flask assets build
+
+copies every file in `static/` to `static/dist/` under a name carrying a
+hash of its contents (`style.css` becomes `dist/style.1a2b3c4d5e6f.css`),
+writes gzip and brotli copies of the text files next to it, and records the
+names in `static/dist/manifest.json`. With a manifest in place,
+`url_for('static', filename='style.css')` gives the fingerprinted URL,
+which is served with a year-long `immutable` cache lifetime and, when the
+browser accepts it, straight from the `.br` or `.gz` file. A changed file
+gets a new name, so browsers never need to revalidate.
+
+Without a build (in development) URLs and caching are Flask's defaults.
+Older fingerprinted files are left in place so pages rendered before a
+deploy keep working.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup, with_appcontext
+
+# Built files go in this folder of the static folder
+DIST = 'dist'
+
+MANIFEST = 'manifest.json'
+
+# Files worth compressing
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.html', '.map'}
+
+# Precompressed copies, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# How long browsers keep a fingerprinted file
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+def fingerprint(name, data):
+    """Return `name` with a hash of `data` before its extension."""
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build(static_folder):
+    """Fingerprint and precompress `static_folder`; return the manifest."""
+    import brotli
+
+    dist = os.path.join(static_folder, DIST)
+    manifest = {}
+    for directory, folders, names in os.walk(static_folder):
+        if os.path.abspath(directory) == os.path.abspath(static_folder):
+            # Don't build the build
+            folders[:] = [folder for folder in folders if folder != DIST]
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, static_folder).replace(
+                os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            hashed = f'{DIST}/{fingerprint(relative, data)}'
+            manifest[relative] = hashed
+            target = os.path.join(static_folder, hashed)
+            _write(target, data)
+
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            for encoded, extension in [
+                    (brotli.compress(data, quality=11), '.br'),
+                    (gzip.compress(data, 9, mtime=0), '.gz')]:
+                if len(encoded) < len(data):
+                    _write(target + extension, encoded)
+
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(app):
+    """Read the build's manifest, if there is one, into `app`."""
+    path = os.path.join(app.static_folder, DIST, MANIFEST)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+    app.extensions['assets'] = manifest
+    app.extensions['assets_built'] = set(manifest.values())
+
+
+def _fingerprinted_url(endpoint, values):
+    if endpoint == 'static':
+        manifest = current_app.extensions['assets']
+        hashed = manifest.get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+
+
+def serve_static(filename):
+    """Flask's static view, plus caching and encodings for built files."""
+    app = current_app
+    if filename not in app.extensions['assets_built']:
+        return app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    served, encoding = filename, None
+    for name, extension in ENCODINGS:
+        if (request.accept_encodings[name] and os.path.exists(
+                os.path.join(app.static_folder, filename + extension))):
+            served, encoding = filename + extension, name
+            break
+    response = send_from_directory(app.static_folder, served,
+                                   mimetype=mimetype, cache_timeout=MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Serve built static files and point `url_for('static')` at them."""
+    load_manifest(app)
+    app.url_defaults(_fingerprinted_url)
+    app.view_functions['static'] = serve_static
+
+
+assets_cli = AppGroup('assets', help='Build the static files.')
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build_command():
+    """Fingerprint and precompress every static file."""
+    static_folder = current_app.static_folder
+    manifest = build(static_folder)
+    load_manifest(current_app)
+    for name, hashed in sorted(manifest.items()):
+        sizes = [f'{os.path.getsize(os.path.join(static_folder, hashed))}']
+        for encoding, extension in ENCODINGS:
+            path = os.path.join(static_folder, hashed + extension)
+            if os.path.exists(path):
+                sizes.append(f'{encoding} {os.path.getsize(path)}')
+        click.echo(f'{name} -> {hashed} ({", ".join(sizes)} bytes)')
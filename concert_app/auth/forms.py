@@ -1,22 +1,20 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
-from wtforms.validators import DataRequired, Length, ValidationError
+from wtforms.validators import DataRequired, Length
 from concert_app.models import User
-from concert_app.extensions import bcrypt
+from concert_app.auth.passwords import check_password
+
+USERNAME_TAKEN = 'That username is taken. Please choose a different one.'
 
 
 class SignUpForm(FlaskForm):
+    # Uniqueness is left to the unique index on username_lower; the view
+    # reports the IntegrityError with USERNAME_TAKEN
     username = StringField('Username',
                            validators=[DataRequired(), Length(min=3, max=50)])
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Sign Up')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user:
-            raise ValidationError(
-                'That username is taken. Please choose a different one.')
-
 
 class LoginForm(FlaskForm):
     username = StringField('Username',
@@ -24,14 +22,23 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Log In')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if not user:
-            raise ValidationError(
-                'No user with that username. Please try again.')
+    def validate(self):
+        """Look the user up once and check the password against it.
 
-    def validate_password(self, password):
-        user = User.query.filter_by(username=self.username.data).first()
-        if user and not bcrypt.check_password_hash(
-                user.password, password.data):
-            raise ValidationError('Password doesn\'t match. Please try again.')
+        The matching user is kept on `self.user` for the view.
+        """
+        self.user = None
+        if not super().validate():
+            return False
+        user = User.query.filter_by(
+            username_lower=self.username.data.lower()).first()
+        if user is None:
+            self.username.errors.append(
+                'No user with that username. Please try again.')
+            return False
+        if not check_password(user.password, self.password.data):
+            self.password.errors.append(
+                'Password doesn\'t match. Please try again.')
+            return False
+        self.user = user
+        return True
@@ -0,0 +1,57 @@
+"""Password hashing with a configurable bcrypt work factor.
+
+`BCRYPT_LOG_ROUNDS` sets the cost of new hashes. Hashes made at a different
+cost are still accepted, and `needs_rehash` tells the login view to replace
+them, so changing the setting migrates users as they log in.
+
+bcrypt releases the GIL while it works, so hashing runs on a small bounded
+pool (`BCRYPT_MAX_THREADS`). A burst of logins then queues for the pool
+instead of tying up every core and every worker thread at once, and
+requests that don't hash keep being served.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from concert_app.extensions import bcrypt
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=current_app.config['BCRYPT_MAX_THREADS'],
+                    thread_name_prefix='bcrypt')
+    return _pool
+
+
+def _rounds():
+    return current_app.config['BCRYPT_LOG_ROUNDS']
+
+
+def hash_password(password):
+    """Return the bcrypt hash of `password` at the configured cost."""
+    hashed = _executor().submit(
+        bcrypt.generate_password_hash, password, _rounds()).result()
+    return hashed.decode('utf-8')
+
+
+def check_password(password_hash, password):
+    """Return True if `password` matches `password_hash`."""
+    return _executor().submit(
+        bcrypt.check_password_hash, password_hash, password).result()
+
+
+def needs_rehash(password_hash):
+    """Return True if `password_hash` was made at a different cost."""
+    try:
+        cost = int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost != _rounds()
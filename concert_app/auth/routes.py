@@ -1,10 +1,12 @@
 from flask import Blueprint, request, render_template, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required
+from sqlalchemy.exc import IntegrityError
 
 from concert_app.models import User
-from concert_app.auth.forms import SignUpForm, LoginForm
+from concert_app.auth.forms import SignUpForm, LoginForm, USERNAME_TAKEN
+from concert_app.auth.passwords import hash_password, needs_rehash
 
-from concert_app.extensions import db, bcrypt
+from concert_app.extensions import db
 
 auth = Blueprint("auth", __name__)
 
@@ -14,17 +16,20 @@ def signup():
     print('in signup')
     form = SignUpForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(
-            form.password.data).decode('utf-8')
         user = User(
             username=form.username.data,
-            password=hashed_password
+            password=hash_password(form.password.data)
         )
         db.session.add(user)
-        db.session.commit()
-        flash('Account Created.')
-        print('created')
-        return redirect(url_for('auth.login'))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            form.username.errors.append(USERNAME_TAKEN)
+        else:
+            flash('Account Created.')
+            print('created')
+            return redirect(url_for('auth.login'))
     print(form.errors)
     return render_template('signup.html', form=form)
 
@@ -33,7 +38,10 @@ def signup():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
+        user = form.user
+        if needs_rehash(user.password):
+            user.password = hash_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=True)
         next_page = request.args.get('next')
         return redirect(next_page if next_page else url_for('main.homepage'))
@@ -1,10 +1,14 @@
 import os
+import time
 from unittest import TestCase
-import app
 
+from contextlib import contextmanager
 from datetime import date
+from sqlalchemy import event
 
-from concert_app.extensions import app, db, bcrypt
+from concert_app.identity import identities
+from concert_app.extensions import db, bcrypt, cache
+from concert_app.factory import create_app
 from concert_app.models import Concert, Artist, User
 
 """
@@ -12,6 +16,8 @@ Run these tests with the command:
 python3 -m unittest concert_app.auth.tests
 """
 
+app = create_app()
+
 #################################################
 # Setup
 #################################################
@@ -48,9 +54,26 @@ def new_concert():
     db.session.commit()
 
 
+@contextmanager
+def count_queries():
+    # Collects every SQL statement run inside the block
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def create_user():
     # Creates a user with username 'laurel1' and password of 'password'
-    password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+    password_hash = bcrypt.generate_password_hash(
+        'password', app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
     user = User(username='laurel1', password=password_hash)
     db.session.add(user)
     db.session.commit()
@@ -70,9 +93,15 @@ class AuthTests(TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
         self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
         db.drop_all()
         db.create_all()
+        cache.clear()
+        identities.clear()
 
     def test_signup(self):
         create_user()
@@ -149,3 +178,70 @@ class AuthTests(TestCase):
         response = self.app.get('/')
         response_text = response.get_data(as_text=True)
         self.assertIn('login', response_text)
+
+    def test_signup_username_case_insensitive(self):
+        create_user()
+        post_data = {
+            'username': 'Laurel1',
+            'password': 'password',
+        }
+        response = self.app.post('/signup', data=post_data)
+        response_text = response.get_data(as_text=True)
+        self.assertIn(
+            'That username is taken. Please choose a different one.', response_text)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_login_any_case(self):
+        create_user()
+        response = login(self.app, 'LAUREL1', 'password')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Log Out', response_text)
+
+    def test_login_single_user_lookup(self):
+        """Test that a login POST looks the user up exactly once."""
+        create_user()
+        post_data = {
+            'username': 'laurel1',
+            'password': 'password',
+        }
+        with count_queries() as statements:
+            response = self.app.post('/login', data=post_data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(statements), 1)
+
+    def test_login_rehashes_when_cost_changes(self):
+        """Test that an old-cost hash is replaced on the next login."""
+        password_hash = bcrypt.generate_password_hash(
+            'password', 5).decode('utf-8')
+        db.session.add(User(username='laurel1', password=password_hash))
+        db.session.commit()
+
+        login(self.app, 'laurel1', 'password')
+        user = User.query.filter_by(username='laurel1').one()
+        self.assertNotEqual(user.password, password_hash)
+        self.assertEqual(user.password.split('$')[2], '04')
+
+        # The new hash still works, and isn't replaced again
+        logout(self.app)
+        login(self.app, 'laurel1', 'password')
+        self.assertEqual(
+            User.query.filter_by(username='laurel1').one().password,
+            user.password)
+
+    def test_login_throughput(self):
+        """Benchmark login POSTs at the test work factor."""
+        create_user()
+        post_data = {
+            'username': 'laurel1',
+            'password': 'password',
+        }
+        logins = 50
+        started = time.perf_counter()
+        for _ in range(logins):
+            response = self.app.post('/login', data=post_data)
+            self.assertEqual(response.status_code, 302)
+            self.app.get('/logout')
+        elapsed = time.perf_counter() - started
+        self.assertGreater(
+            logins / elapsed, 10,
+            f'BCRYPT_LOG_ROUNDS={app.config["BCRYPT_LOG_ROUNDS"]}')
@@ -0,0 +1,342 @@
+"""Rendered page and fragment cache.
+
+Cached values are keyed by the version numbers of the data they were built
+from. A page listing concerts depends on the `concerts` namespace, so once a
+route that changes concerts calls `cache.bump('concerts')`, every cached
+page and fragment built from the old data is simply never looked up again
+and ages out of the LRU.
+
+Backends, chosen with `CACHE_TYPE`:
+
+* `memory` - a per-process LRU. Fastest, but each gunicorn worker has its
+  own copy and only sees its own version bumps. Bumps made by CLI commands
+  (`flask import`, `flask counters reconcile`, `flask trending aggregate`,
+  ...) never reach the web workers, which keep serving the old pages until
+  they expire; a warning is logged when that happens.
+* `sqlite` - a local SQLite file shared by every worker on the box.
+* `null` - caches nothing.
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import (
+    current_app, has_request_context, make_response, request, session)
+from flask_login import current_user
+from markupsafe import Markup
+
+from concert_app.routing import use_primary
+
+logger = logging.getLogger('concert_app.cache')
+
+
+class NullBackend(object):
+    """Backend that never stores anything."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def version(self, namespace):
+        return 0
+
+    def bumped_at(self, namespace):
+        return 0
+
+    def bump(self, *namespaces):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryBackend(object):
+    """Size-bounded, thread-safe in-process LRU with per-entry expiry."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bumped_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def bumped_at(self, namespace):
+        return self._bumped_at.get(namespace, 0)
+
+    def bump(self, *namespaces):
+        now = time.time()
+        with self._lock:
+            for namespace in namespaces:
+                self._versions[namespace] = (
+                    self._versions.get(namespace, 0) + 1)
+                self._bumped_at[namespace] = now
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._bumped_at.clear()
+
+
+class SQLiteBackend(object):
+    """LRU stored in a SQLite file so every local worker shares one cache.
+
+    Versions live in their own table so they are never evicted; losing one
+    would make stale entries reachable again.
+    """
+
+    # Only refresh an entry's LRU position when it is older than this
+    TOUCH_INTERVAL = 5
+
+    # Check the size bound on every Nth write
+    EVICT_EVERY = 50
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._connect()
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL);'
+            'CREATE INDEX IF NOT EXISTS ix_entries_accessed'
+            ' ON entries (accessed);'
+            'CREATE TABLE IF NOT EXISTS versions ('
+            ' namespace TEXT PRIMARY KEY, version INTEGER NOT NULL);'
+            # Apart from versions, so older cache files keep working
+            'CREATE TABLE IF NOT EXISTS bumps ('
+            ' namespace TEXT PRIMARY KEY, bumped_at REAL NOT NULL);')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            'SELECT value, expires, accessed FROM entries WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        if expires < now:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        if accessed < now - self.TOUCH_INTERVAL:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                         (now, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO entries (key, value, expires, accessed) '
+            'VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+             now + ttl, now))
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        conn.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+        (count,) = conn.execute('SELECT count(*) FROM entries').fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                'DELETE FROM entries WHERE key IN (SELECT key FROM entries '
+                'ORDER BY accessed LIMIT ?)', (count - self.max_entries,))
+
+    def version(self, namespace):
+        row = self._connect().execute(
+            'SELECT version FROM versions WHERE namespace = ?',
+            (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def bumped_at(self, namespace):
+        row = self._connect().execute(
+            'SELECT bumped_at FROM bumps WHERE namespace = ?',
+            (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, *namespaces):
+        conn = self._connect()
+        now = time.time()
+        # One transaction, however many namespaces
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO versions (namespace, version) VALUES (?, 1) '
+                'ON CONFLICT (namespace) DO UPDATE SET version = version + 1',
+                [(namespace,) for namespace in namespaces])
+            conn.executemany(
+                'INSERT OR REPLACE INTO bumps (namespace, bumped_at) '
+                'VALUES (?, ?)',
+                [(namespace, now) for namespace in namespaces])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute('DELETE FROM entries')
+        conn.execute('DELETE FROM versions')
+        conn.execute('DELETE FROM bumps')
+
+
+class Cache(object):
+    """Versioned page and fragment cache configured from the app config."""
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.default_ttl = 300
+        self._warned_local_bump = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_TYPE', 'memory')
+        app.config.setdefault('CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_PATH', None)
+
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        cache_type = app.config['CACHE_TYPE']
+        max_entries = app.config['CACHE_MAX_ENTRIES']
+        if cache_type == 'memory':
+            self.backend = MemoryBackend(max_entries)
+        elif cache_type == 'sqlite':
+            path = app.config['CACHE_PATH'] or os.path.join(
+                app.instance_path, 'cache.sqlite')
+            self.backend = SQLiteBackend(path, max_entries)
+        elif cache_type == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE {cache_type!r}')
+
+    def bump(self, *namespaces):
+        """Invalidate everything built from any of `namespaces`."""
+        self.backend.bump(*namespaces)
+        # Outside a request this is a CLI command or a job, not a web worker
+        if (isinstance(self.backend, MemoryBackend)
+                and not has_request_context() and not self._warned_local_bump):
+            self._warned_local_bump = True
+            logger.warning(
+                'CACHE_TYPE is memory, so web workers will not see that %s '
+                'changed and keep serving cached pages for up to %ss. Use '
+                'CACHE_TYPE=sqlite to share invalidations between processes.',
+                ', '.join(namespaces[:3])
+                + (f' and {len(namespaces) - 3} more'
+                   if len(namespaces) > 3 else ''),
+                self.default_ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def key(self, name, namespaces):
+        """Build a cache key for `name` tied to the current versions."""
+        versions = ','.join(f'{namespace}={self.backend.version(namespace)}'
+                            for namespace in namespaces)
+        return f'{name}|{versions}'
+
+    def read_fresh_after_bumps(self, namespaces):
+        """Read from the primary if any of `namespaces` changed moments ago.
+
+        A replica may not have the change yet, and what's rendered now is
+        stored under the new versions for everyone, so for
+        `READ_YOUR_WRITES_SECONDS` after a bump misses aren't served from
+        replicas.
+        """
+        if not current_app.config.get('REPLICA_BINDS'):
+            return
+        since = time.time() - current_app.config['READ_YOUR_WRITES_SECONDS']
+        if any(self.backend.bumped_at(namespace) > since
+               for namespace in namespaces):
+            use_primary()
+
+    def fragment(self, name, namespaces, render, ttl=None):
+        """Return the cached HTML for `name`, calling `render` on a miss."""
+        key = self.key(f'fragment:{name}', namespaces)
+        html = self.backend.get(key)
+        if html is None:
+            self.read_fresh_after_bumps(namespaces)
+            html = render()
+            self.backend.set(key, str(html), ttl or self.default_ttl)
+        return Markup(html)
+
+    def cached_page(self, *namespaces, ttl=None):
+        """Serve the decorated view from the cache for anonymous visitors.
+
+        Only successful GETs by visitors who are not logged in and have no
+        pending flash messages are cached, since those are the only pages
+        that look the same for everyone.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (request.method != 'GET' or '_flashes' in session
+                        or current_user.is_authenticated):
+                    return view(*args, **kwargs)
+
+                key = self.key(f'page:{request.full_path}', namespaces)
+                cached = self.backend.get(key)
+                if cached is not None:
+                    body, status, headers = cached
+                    response = make_response(body, status, headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response.make_conditional(request)
+
+                self.read_fresh_after_bumps(namespaces)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    headers = [(name, value)
+                               for name, value in response.headers
+                               if name.lower() != 'set-cookie']
+                    self.backend.set(
+                        key, (response.get_data(), 200, headers),
+                        ttl or self.default_ttl)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
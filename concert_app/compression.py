@@ -0,0 +1,126 @@
+"""Gzip compression of dynamic responses.
+
+`Compress` wraps the WSGI app and gzips HTML, JSON and other text responses
+for clients that send `Accept-Encoding: gzip`. Responses with a known
+length are compressed whole once they are at least `COMPRESS_MIN_BYTES`
+long; streamed responses (no Content-Length, e.g. the NDJSON exports) are
+compressed chunk by chunk, each chunk flushed as it is produced, so
+streaming still delivers rows as they are read.
+
+A compressed response is a different representation of the page, so its
+strong ETag gets a `-gzip` suffix. The suffix is taken off again before
+the app sees `If-None-Match`, so conditional GETs still answer 304.
+"""
+import gzip
+import re
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+from werkzeug.wsgi import ClosingIterator
+
+# Content types worth compressing
+COMPRESSIBLE = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/calendar',
+    'application/json', 'application/x-ndjson', 'application/javascript',
+    'image/svg+xml',
+}
+
+ETAG_SUFFIX = '-gzip'
+
+_SUFFIXED_ETAG = re.compile(re.escape(ETAG_SUFFIX) + '"')
+
+
+class Compress(object):
+    """WSGI middleware gzipping text responses."""
+
+    def __init__(self, app, min_bytes=1024, level=6):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if environ['REQUEST_METHOD'] == 'HEAD' or not accepted['gzip']:
+            return self.app(environ, start_response)
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        unsuffixed = _SUFFIXED_ETAG.sub('"', if_none_match)
+        if unsuffixed != if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = unsuffixed
+
+        # Headers are held back until the body shows what to send
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return _no_write
+
+        body = self.app(environ, capture)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+        code = int(status.split(None, 1)[0])
+
+        # The client's copy was the compressed one
+        if code == 304 and unsuffixed != if_none_match:
+            _suffix_etag(headers)
+        if not self.compressible(code, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return body
+
+        _suffix_etag(headers)
+        headers.set('Content-Encoding', 'gzip')
+        vary = headers.get('Vary')
+        headers.set('Vary', f'{vary}, Accept-Encoding' if vary
+                    else 'Accept-Encoding')
+        if 'Content-Length' in headers:
+            try:
+                data = gzip.compress(b''.join(body), self.level)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            headers.set('Content-Length', str(len(data)))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [data]
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return ClosingIterator(self.stream(body),
+                               getattr(body, 'close', None))
+
+    def compressible(self, code, headers):
+        if code < 200 or code in (204, 304) or 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        mimetype = parse_options_header(headers.get('Content-Type', ''))[0]
+        if mimetype not in COMPRESSIBLE:
+            return False
+        length = headers.get('Content-Length')
+        return length is None or int(length) >= self.min_bytes
+
+    def stream(self, body):
+        # 31: gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for chunk in body:
+            data = compressor.compress(chunk) + compressor.flush(
+                zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def _suffix_etag(headers):
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/') and etag.endswith('"'):
+        headers.set('ETag', etag[:-1] + ETAG_SUFFIX + '"')
+
+
+def _no_write(data):
+    raise RuntimeError('Compress does not support the WSGI write() callable')
+
+
+def init_app(app):
+    """Compress `app`'s text responses."""
+    app.config.setdefault('COMPRESS_MIN_BYTES', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.wsgi_app = Compress(app.wsgi_app, app.config['COMPRESS_MIN_BYTES'],
+                            app.config['COMPRESS_LEVEL'])
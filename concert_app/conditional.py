@@ -0,0 +1,76 @@
+"""Conditional GET support (ETag / Last-Modified / 304 Not Modified).
+
+A view decorated with `conditional(validators)` first calls
+`validators(**view_args)`, which runs one cheap query for the modification
+timestamps of everything the page shows. The ETag and Last-Modified headers
+are derived from those timestamps alone, so a client that already has the
+current page gets a 304 without the template ever being rendered.
+"""
+import hashlib
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+
+def validators_for(stamps):
+    """Return the (etag, last_modified) pair for a list of timestamps.
+
+    Logged in visitors see their own name, button states and unread count,
+    so their identity, last modification and unread count are part of the
+    validators too.
+    """
+    user_id = unread = None
+    if current_user.is_authenticated:
+        user_id = current_user.get_id()
+        unread = current_user.unread_count()
+        stamps = stamps + [current_user.updated_at]
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    fingerprint = repr((current_app.config['ETAG_SALT'], request.full_path,
+                        user_id, unread, stamps))
+    etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+    last_modified = max(stamps).replace(microsecond=0) if stamps else None
+    return etag, last_modified
+
+
+def is_not_modified(etag, last_modified):
+    """Return True if the request's validators match the current page."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return bool(last_modified and request.if_modified_since
+                and last_modified <= request.if_modified_since)
+
+
+def conditional(validators):
+    """Answer conditional GETs for the decorated view from `validators`.
+
+    `validators` is called with the view's arguments and returns a list of
+    the timestamps the page depends on, or None if the page doesn't exist
+    (the view is then left to produce its 404).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flash messages make the body differ from the cached copy
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            stamps = validators(**kwargs)
+            if stamps is None:
+                return view(*args, **kwargs)
+            etag, last_modified = validators_for(stamps)
+
+            if is_not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.vary.add('Cookie')
+            response.cache_control.no_cache = True
+            if current_user.is_authenticated:
+                response.cache_control.private = True
+            return response
+        return wrapper
+    return decorator
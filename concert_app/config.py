@@ -2,6 +2,8 @@
 from dotenv import load_dotenv
 import os
 
+from concert_app.database import engine_options
+
 load_dotenv()
 
 class Config(object):
@@ -10,3 +12,73 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Comma separated read replica URLs; safe GETs read from one of them
+    REPLICA_URLS = [url.strip() for url in
+                    os.getenv('DATABASE_REPLICA_URLS', '').split(',')
+                    if url.strip()]
+    REPLICA_BINDS = [f'replica{number}'
+                     for number in range(1, len(REPLICA_URLS) + 1)]
+    SQLALCHEMY_BINDS = dict(zip(REPLICA_BINDS, REPLICA_URLS)) or None
+    # How long a visitor's reads stay on the primary after they write
+    READ_YOUR_WRITES_SECONDS = float(
+        os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+    # Pool size, recycling, pre-ping and statement timeout: see
+    # concert_app/database.py for the DB_* variables
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+
+    # Pragmas for every file-backed SQLite connection
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024))
+
+    # SQL statements slower than this are written to the slow query log
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', 100))
+    SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG')
+    # One JSON line per request with its SQL totals
+    QUERY_LOG = os.getenv('QUERY_LOG')
+
+    # Page and fragment cache: 'memory' (per process), 'sqlite' (shared by
+    # every worker on the box, stored at CACHE_PATH) or 'null'. Use sqlite
+    # when CLI commands or cron change data the web workers cache
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'memory')
+    CACHE_PATH = os.getenv('CACHE_PATH')
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 1000))
+    CACHE_DEFAULT_TTL = int(os.getenv('CACHE_DEFAULT_TTL', 300))
+
+    # Artist and concert image thumbnails: where they are cached (default
+    # instance/images), how big the cache may grow, and limits on fetching
+    # the originals
+    IMAGE_CACHE_PATH = os.getenv('IMAGE_CACHE_PATH')
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES',
+                                          512 * 1024 * 1024))
+    IMAGE_FETCH_TIMEOUT = float(os.getenv('IMAGE_FETCH_TIMEOUT', 5))
+    IMAGE_MAX_SOURCE_BYTES = int(os.getenv('IMAGE_MAX_SOURCE_BYTES',
+                                           10 * 1024 * 1024))
+    # Only public addresses are fetched, plus these networks (comma
+    # separated, e.g. an internal image host)
+    IMAGE_FETCH_ALLOWED_NETWORKS = [
+        network for network in
+        os.getenv('IMAGE_FETCH_ALLOWED_NETWORKS', '').split(',') if network]
+
+    # Text responses at least this long are gzipped for clients that
+    # accept it (streamed responses always are), at this zlib level
+    COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+    COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+    # Mixed into every ETag; change it on deploy when templates change
+    ETAG_SALT = os.getenv('ETAG_SALT', '')
+
+    # How long a logged in user's identity is reused before it's reloaded
+    # (0 turns the cache off), and how many users each process remembers.
+    # With CACHE_TYPE=sqlite changes made by other processes show at once
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+    USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+
+    # bcrypt cost for new password hashes; older hashes are upgraded on
+    # login. Lower it (min 4) only for tests.
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    # Most password hashes computed at once per process
+    BCRYPT_MAX_THREADS = int(os.getenv('BCRYPT_MAX_THREADS', 2))
@@ -0,0 +1,60 @@
+"""Denormalised fan and attendee counts.
+
+`Artist.fan_count` and `Concert.attendee_count` mirror the number of rows in
+`user_artist` / `user_concert`, so lists can show and sort by popularity
+without counting joins. `Membership` adjusts them in the same transaction
+as the row it adds or removes; anything that writes those tables in bulk
+(seeding, migrations, manual SQL) should reconcile afterwards:
+
+    flask counters reconcile
+
+which recounts every row and repairs the ones that drifted.
+"""
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select
+
+from concert_app.extensions import db, cache
+from concert_app.models import Artist, Concert, user_artist, user_concert
+
+# (model, counter column, join table, join table column)
+COUNTERS = [
+    (Artist, 'fan_count', user_artist, 'artist_id'),
+    (Concert, 'attendee_count', user_concert, 'concert_id'),
+]
+
+
+def reconcile(conn):
+    """Recount every counter, returning {table name: rows repaired}."""
+    now = datetime.utcnow()
+    repaired = {}
+    for model, column, rows, key in COUNTERS:
+        table = model.__table__
+        counted = (select([func.count()]).select_from(rows)
+                   .where(rows.c[key] == table.c.id).as_scalar())
+        result = conn.execute(
+            table.update().where(table.c[column] != counted)
+            .values({column: counted, 'updated_at': now}))
+        repaired[table.name] = result.rowcount
+    return repaired
+
+
+counters_cli = AppGroup(
+    'counters', help='Maintain the fan and attendee counts.')
+
+
+@counters_cli.command('reconcile')
+@with_appcontext
+def reconcile_command():
+    """Recount fans and attendees and repair any drift."""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        repaired = reconcile(conn)
+    if any(repaired.values()):
+        cache.bump('artists', 'concerts')
+    for table, count in repaired.items():
+        click.echo(f'Repaired {count} {table} counts')
+    click.echo(f'Reconciled in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,118 @@
+"""Database engine tuning.
+
+`engine_options()` builds `SQLALCHEMY_ENGINE_OPTIONS` from environment
+variables: pool size and overflow, pool timeout, connection recycling,
+pre-ping and (on Postgres) a per-statement timeout. Pool sizing is left out
+for SQLite, whose pools don't take those arguments.
+
+`init_app(app)` makes every new SQLite connection (other than in-memory
+ones) run in WAL mode with the pragmas from the `SQLITE_*` settings, so
+gunicorn workers can read while another one writes instead of queueing
+behind the rollback journal.
+"""
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+
+# Applied to each new SQLite connection, in this order
+PRAGMAS = [
+    ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+    ('synchronous', 'SQLITE_SYNCHRONOUS'),
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT_MS'),
+    ('mmap_size', 'SQLITE_MMAP_SIZE'),
+    ('cache_size', 'SQLITE_CACHE_SIZE'),
+]
+
+DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    # 256 MiB of the file is memory mapped
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+    # Negative sizes are KiB: 64 MiB of page cache per connection
+    'SQLITE_CACHE_SIZE': -64 * 1024,
+}
+
+# The pragmas in force, set by `init_app`
+_pragmas = []
+
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else None
+
+
+def engine_options(uri):
+    """Return the SQLAlchemy engine options for `uri` from the environment.
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE are
+    seconds or counts, DB_POOL_PRE_PING is 0/1 (on by default) and
+    DB_STATEMENT_TIMEOUT_MS aborts longer statements on Postgres.
+    """
+    options = {
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') not in ('0', ''),
+    }
+    if not uri:
+        return options
+    backend = make_url(uri).get_backend_name()
+    if backend == 'sqlite':
+        return options
+
+    for option, name in [('pool_size', 'DB_POOL_SIZE'),
+                         ('max_overflow', 'DB_MAX_OVERFLOW'),
+                         ('pool_timeout', 'DB_POOL_TIMEOUT'),
+                         ('pool_recycle', 'DB_POOL_RECYCLE')]:
+        value = _env_int(name)
+        if value is not None:
+            options[option] = value
+    # Managed databases drop idle connections; recycle before they do
+    options.setdefault('pool_recycle', 1800)
+
+    timeout = _env_int('DB_STATEMENT_TIMEOUT_MS')
+    if timeout and backend == 'postgresql':
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+def sqlite_pragmas(config):
+    """Return the (pragma, value) pairs configured in `config`."""
+    pragmas = []
+    for pragma, name in PRAGMAS:
+        value = config.get(name, DEFAULTS[name])
+        if value is not None and value != '':
+            pragmas.append((pragma, value))
+    return pragmas
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    """Run `pragmas` on a new file-backed SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        # In-memory databases have no file name and can't use WAL
+        files = [row[2] for row in cursor.execute('PRAGMA database_list')
+                 if row[1] == 'main']
+        if not files or not files[0]:
+            return
+        for pragma, value in pragmas:
+            cursor.execute(f'PRAGMA {pragma}={value}')
+    finally:
+        cursor.close()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    if _pragmas and isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection, _pragmas)
+
+
+def init_app(app):
+    """Apply the configured pragmas to every new SQLite connection."""
+    for name, value in DEFAULTS.items():
+        app.config.setdefault(name, value)
+    _pragmas[:] = sqlite_pragmas(app.config)
+
+    if not event.contains(Engine, 'connect', _on_connect):
+        event.listen(Engine, 'connect', _on_connect)
@@ -1,44 +1,24 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+"""Extension instances, bound to an app by `create_app()`.
+
+Nothing here needs an app: models, views and helpers import these objects
+freely, and `concert_app.factory.create_app` calls their `init_app`.
+"""
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from concert_app.config import Config
-import os
-
-app = Flask(__name__)
-app.config.from_object(Config)
-
-db = SQLAlchemy(app)
+from concert_app.cache import Cache
+from concert_app.images import ImageCache
+from concert_app.routing import RoutingSQLAlchemy
 
-###########################
-# Authentication
-###########################
+# Sessions can read from replicas, see routing.py
+db = RoutingSQLAlchemy()
 
-#  Authentication Set up code
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
-login_manager.init_app(app)
-
-from .models import User
-
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(user_id)
-
-
-bcrypt = Bcrypt(app)
-
-#  Main Blueprint
-
-from concert_app.main.routes import main
-app.register_blueprint(main)
 
-with app.app_context():
-    db.create_all()
+bcrypt = Bcrypt()
 
-# Auth Blueprint
-from concert_app.auth.routes import auth
-app.register_blueprint(auth)
+# Rendered page and fragment cache
+cache = Cache()
 
-with app.app_context():
-    db.create_all()
+# Resized copies of remote artist and concert images
+image_cache = ImageCache()
@@ -0,0 +1,86 @@
+"""Application factory.
+
+`create_app()` configures an app, binds the extensions and registers the
+blueprints and CLI commands. It never touches the database, so importing
+and starting the app (a gunicorn worker, a test module) costs the same on
+any schema. Tables are created and upgraded with:
+
+    flask db upgrade
+
+Startup is timed and logged; `benchmarks/startup.py` measures it in fresh
+interpreters.
+"""
+import time
+
+from flask import Flask
+
+from concert_app import (
+    assets, compression, database, identity, instrumentation)
+from concert_app.config import Config
+from concert_app.extensions import (
+    bcrypt, cache, db, image_cache, login_manager)
+
+
+def create_app(config=Config):
+    """Return a new app configured from the `config` object."""
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # WAL mode and pragmas for SQLite connections
+    database.init_app(app)
+    db.init_app(app)
+    # Per-request query counts, timings and slow query log
+    instrumentation.init_app(app)
+
+    # Logged in users are served from a short-lived identity cache
+    login_manager.init_app(app)
+    login_manager.user_loader(identity.load_user)
+    identity.identities.init_app(app)
+    bcrypt.init_app(app)
+    cache.init_app(app)
+    # Thumbnail proxy at /image/..., see images.py
+    image_cache.init_app(app)
+    # Fingerprinted static URLs after `flask assets build`
+    assets.init_app(app)
+    # Gzip for HTML and JSON responses
+    compression.init_app(app)
+
+    from concert_app.main.routes import main
+    from concert_app.auth.routes import auth
+    from concert_app.api.routes import api
+    app.register_blueprint(main)
+    app.register_blueprint(auth)
+    app.register_blueprint(api)
+
+    from concert_app.assets import assets_cli
+    from concert_app.counters import counters_cli
+    from concert_app.images import images_cli
+    from concert_app.importer import import_command
+    from concert_app.jobs import jobs_cli
+    from concert_app.migrations import db_cli
+    from concert_app.recommendations import recommendations_cli
+    from concert_app.seed import seed_command
+    from concert_app.trending import trending_cli
+    # `flask db upgrade` applies versioned schema migrations
+    app.cli.add_command(db_cli)
+    # `flask import` bulk loads artists and concerts
+    app.cli.add_command(import_command)
+    # `flask recommendations rebuild` recomputes "Fans also like"
+    app.cli.add_command(recommendations_cli)
+    # `flask counters reconcile` repairs fan and attendee counts
+    app.cli.add_command(counters_cli)
+    # `flask trending aggregate` folds activity into the trending lists
+    app.cli.add_command(trending_cli)
+    # `flask jobs work` runs queued background jobs, e.g. notifications
+    app.cli.add_command(jobs_cli)
+    # `flask images evict` keeps the thumbnail cache under its size limit
+    app.cli.add_command(images_cli)
+    # `flask assets build` fingerprints and precompresses static files
+    app.cli.add_command(assets_cli)
+    # `flask seed` generates a synthetic catalogue for benchmarks
+    app.cli.add_command(seed_command)
+
+    app.logger.debug('App created in %.1fms',
+                     (time.perf_counter() - started) * 1000)
+    return app
@@ -0,0 +1,132 @@
+"""Geohashes and distances for finding concerts near a point.
+
+A geohash names a cell of a grid laid over the globe; every extra character
+splits the cell into 32, and points in the same cell share the same prefix.
+Concerts store the geohash of their location in an ordinary indexed string
+column, so "everything in this cell" is a range scan on any database:
+
+    geohash >= 'c2b2' AND geohash < 'c2b3'
+
+`cover(lat, lon, radius_km)` returns the few cell prefixes that together
+contain a circle, and `distance_km` is then used to drop the corners and
+sort what the cells held.
+"""
+from math import asin, ceil, cos, isfinite, radians, sin, sqrt
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Stored precision: 9 characters is a cell of roughly 5 x 5 metres
+PRECISION = 9
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Kilometres per degree of latitude
+KM_PER_DEGREE = 111.195
+
+# Most cells `cover` steps across each way, whatever the precision
+MAX_STEPS = 8
+
+
+def encode(lat, lon, precision=PRECISION):
+    """Return the geohash of (`lat`, `lon`) with `precision` characters."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Return the (height, width) in degrees of a cell at `precision`."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points, in kilometres."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = (sin((lat2 - lat1) / 2) ** 2
+         + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """Return (south, west, north, east) around a circle, in degrees.
+
+    West and east are not wrapped, so a box crossing the antimeridian has
+    west < -180 or east > 180; one reaching round the globe is -180 to 180.
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    # Longitude degrees shrink towards the poles
+    dlon = radius_km / (KM_PER_DEGREE * max(cos(radians(lat)), 0.01))
+    if dlon >= 180:
+        west, east = -180.0, 180.0
+    else:
+        west, east = lon - dlon, lon + dlon
+    return max(lat - dlat, -90.0), west, min(lat + dlat, 90.0), east
+
+
+def longitude_spans(west, east):
+    """Split a (west, east) range into ranges within -180 to 180."""
+    if west < -180:
+        return [(west + 360, 180.0), (-180.0, east)]
+    if east > 180:
+        return [(west, 180.0), (-180.0, east - 360)]
+    return [(west, east)]
+
+
+def _steps(low, high, step):
+    # low, low + step, ... up to and including high
+    count = min(int(ceil((high - low) / step)), MAX_STEPS)
+    return [min(low + i * step, high) for i in range(count)] + [high]
+
+
+def cover(lat, lon, radius_km):
+    """Return geohash prefixes whose cells together contain the circle.
+
+    The longest prefixes for which the circle's bounding box spans at most
+    three cells each way are used, so there are never more than nine (18
+    across the antimeridian) and they hold little beyond the box.
+    """
+    if not all(isfinite(value) for value in (lat, lon, radius_km)):
+        raise ValueError('Coordinates and radius must be finite numbers')
+    south, west, north, east = bounding_box(lat, lon, radius_km)
+    spans = longitude_spans(west, east)
+    widest = max(span_east - span_west for span_west, span_east in spans)
+    precision = PRECISION
+    while precision > 1:
+        height, width = cell_size(precision)
+        if north - south <= 2 * height and widest <= 2 * width:
+            break
+        precision -= 1
+    height, width = cell_size(precision)
+
+    cells = set()
+    for y in _steps(south, north, height):
+        for span_west, span_east in spans:
+            for x in _steps(span_west, span_east, width):
+                cells.add(encode(y, x, precision))
+    return sorted(cells)
+
+
+def prefix_range(prefix):
+    """Return (low, high) such that low <= geohash < high matches `prefix`."""
+    # Increment the last character, carrying past 'z'
+    stripped = prefix.rstrip(BASE32[-1])
+    if not stripped:
+        return prefix, None
+    last = stripped[-1]
+    return prefix, stripped[:-1] + BASE32[BASE32.index(last) + 1]
@@ -0,0 +1,71 @@
+"""iCalendar (RFC 5545) feeds of concerts.
+
+`feed(name, concerts, url_for_concert)` yields a VCALENDAR in chunks, one
+VEVENT per concert, so a view can stream it as rows arrive. Concerts are
+all-day events on their date; the UID only depends on the concert, so
+calendar apps update an event in place when the concert changes.
+"""
+from datetime import timedelta
+
+PRODID = '-//Discover Music//Concerts//EN'
+
+# Longest content line, in octets, before it is folded
+LINE_OCTETS = 75
+
+
+def escape(text):
+    """Escape `text` for use as a TEXT property value."""
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Split `line` into CRLF-terminated lines of at most LINE_OCTETS."""
+    data = line.encode('utf-8')
+    lines, start, limit = [], 0, LINE_OCTETS
+    while len(data) - start > limit:
+        end = start + limit
+        # Never split a UTF-8 sequence
+        while data[end] & 0xC0 == 0x80:
+            end -= 1
+        lines.append(data[start:end].decode('utf-8'))
+        # Continuation lines start with a space, which counts
+        start, limit = end, LINE_OCTETS - 1
+    lines.append(data[start:].decode('utf-8'))
+    return '\r\n '.join(lines) + '\r\n'
+
+
+def vevent(concert, url):
+    """Return the VEVENT of a concert row, linking to `url`."""
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:concert-{concert.id}@discover-music',
+        f'DTSTAMP:{concert.updated_at:%Y%m%dT%H%M%SZ}',
+        f'DTSTART;VALUE=DATE:{concert.date:%Y%m%d}',
+        f'DTEND;VALUE=DATE:{concert.date + timedelta(days=1):%Y%m%d}',
+        f'SUMMARY:{escape(concert.name)}',
+        f'LOCATION:{escape(f"{concert.venue}, {concert.address}")}',
+        f'URL:{url}',
+    ]
+    if concert.latitude is not None and concert.longitude is not None:
+        lines.append(f'GEO:{concert.latitude:.6f};{concert.longitude:.6f}')
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
+
+
+def feed(name, concerts, url_for_concert, batch_size=100):
+    """Yield a calendar named `name` of `concerts`, in chunks."""
+    yield ''.join(fold(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{escape(name)}',
+    ])
+    events = []
+    for concert in concerts:
+        events.append(vevent(concert, url_for_concert(concert.id)))
+        if len(events) == batch_size:
+            yield ''.join(events)
+            events = []
+    yield ''.join(events) + fold('END:VCALENDAR')
@@ -0,0 +1,223 @@
+"""Cached identities for logged in users.
+
+Flask-Login asks for the current user on every request a logged in visitor
+makes. Rather than loading a `User` each time, `load_user` keeps a small
+`Identity` record per user in a bounded, per-process LRU for up to
+`USER_CACHE_TTL` seconds and hands views a `UserIdentity` proxy over it.
+
+The proxy knows the user's id, name and `updated_at`; everything else is
+loaded the first time a view asks for it:
+
+* `is_attending` / `is_favourite` read the user's concert and artist ids,
+  fetched once and kept on the cached record (POSTs ask the database).
+* `attending` / `favourites` load the full `User` from the database.
+* `unread_count` counts unread notifications once and keeps the count.
+
+A commit that changes a user (see `models.user_changed`) drops their
+record in this process and bumps their `user:<id>` version in the page
+cache backend. Records remember the version they were loaded at, so with
+the shared `sqlite` backend other processes reload on their next request
+without asking the database. With the per-process `memory` backend they
+notice within the TTL, which is why POSTs always load a fresh identity
+before they change anything.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from flask_login import UserMixin
+from sqlalchemy import event, select
+
+from concert_app.extensions import cache, db
+from concert_app.models import (
+    Membership, User, user_artist, user_changed, user_concert)
+
+
+class Identity(object):
+    """What is cached about one user."""
+
+    __slots__ = ('id', 'username', 'updated_at', 'version', 'concert_ids',
+                 'artist_ids', 'unread')
+
+    def __init__(self, id, username, updated_at, version=0):
+        self.id = id
+        self.username = username
+        self.updated_at = updated_at
+        # The user's cache version when the record was loaded
+        self.version = version
+        # Filled in the first time they're needed
+        self.concert_ids = None
+        self.artist_ids = None
+        self.unread = None
+
+
+class IdentityCache(object):
+    """Size-bounded, thread-safe LRU of `Identity` records with expiry."""
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_MAX_ENTRIES', 10000)
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.max_entries = app.config['USER_CACHE_MAX_ENTRIES']
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, identity = entry
+            if expires < time.time():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def set(self, identity):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[identity.id] = (time.time() + self.ttl, identity)
+            self._entries.move_to_end(identity.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identities = IdentityCache()
+
+
+class UserIdentity(Membership, UserMixin):
+    """Stand-in for `User` as `current_user`, backed by an `Identity`."""
+
+    def __init__(self, identity, fresh=False):
+        self._identity = identity
+        # Fresh identities check membership straight against the database
+        self._fresh = fresh
+        self._user = None
+
+    @property
+    def id(self):
+        return self._identity.id
+
+    @property
+    def username(self):
+        return self._identity.username
+
+    @property
+    def updated_at(self):
+        return self._identity.updated_at
+
+    @property
+    def user(self):
+        """The full `User` row, loaded on first use."""
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    @property
+    def attending(self):
+        return self.user.attending
+
+    @property
+    def favourites(self):
+        return self.user.favourites
+
+    def is_attending(self, concert_id):
+        """Return True if the user is attending the given concert."""
+        identity = self._identity
+        if self._fresh:
+            return super().is_attending(concert_id)
+        if identity.concert_ids is None:
+            identity.concert_ids = frozenset(
+                row[0] for row in db.session.execute(
+                    select([user_concert.c.concert_id])
+                    .where(user_concert.c.user_id == self.id)))
+        return int(concert_id) in identity.concert_ids
+
+    def is_favourite(self, artist_id):
+        """Return True if the artist is in the user's favourites."""
+        identity = self._identity
+        if self._fresh:
+            return super().is_favourite(artist_id)
+        if identity.artist_ids is None:
+            identity.artist_ids = frozenset(
+                row[0] for row in db.session.execute(
+                    select([user_artist.c.artist_id])
+                    .where(user_artist.c.user_id == self.id)))
+        return int(artist_id) in identity.artist_ids
+
+    def unread_count(self):
+        """Return the user's unread notifications, counting to UNREAD_MAX."""
+        identity = self._identity
+        if self._fresh:
+            return super().unread_count()
+        if identity.unread is None:
+            identity.unread = super().unread_count()
+        return identity.unread
+
+    def __str__(self):
+        return f'{self.username}'
+
+    def __repr__(self):
+        return f'{self.username}'
+
+
+def load_user(user_id):
+    """Return the `UserIdentity` for `user_id`, or None if there's no user."""
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    # Anything that changes data decides from a fresh identity
+    fresh = request.method not in ('GET', 'HEAD')
+    # Read before the row, so a change committed in between isn't missed
+    version = cache.backend.version(user_namespace(user_id))
+    identity = None if fresh else identities.get(user_id)
+    # Changed since it was cached, maybe by another process
+    if identity is None or identity.version != version:
+        row = db.session.query(User.id, User.username, User.updated_at) \
+            .filter(User.id == user_id).first()
+        if row is None:
+            identities.forget(user_id)
+            return None
+        identity = Identity(*row, version=version)
+        identities.set(identity)
+    return UserIdentity(identity, fresh)
+
+
+def user_namespace(user_id):
+    """Return the cache namespace versioning the identity of `user_id`."""
+    return f'user:{user_id}'
+
+
+def _bump_changed_users(session):
+    changed = session.info.pop('changed_users', ())
+    for user_id in changed:
+        identities.forget(user_id)
+    if changed:
+        cache.bump(*[user_namespace(user_id) for user_id in sorted(changed)])
+
+
+def _forget_changed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        identities.forget(user_id)
+
+
+event.listen(db.session, 'after_commit', _bump_changed_users)
+event.listen(db.session, 'after_rollback', _forget_changed_users)
+event.listen(User, 'after_update',
+             lambda mapper, connection, target: user_changed(target.id))
@@ -0,0 +1,346 @@
+"""Thumbnails of artist and concert images, served from a local cache.
+
+Artists and concerts link to artwork on other sites, often megabytes of
+it. Pages instead point at this app's `/image/<size>.<format>` URLs (see
+`thumbnail_url` and the `_image.html` macro), which carry the source URL
+and a signature so the proxy only fetches URLs the app itself handed out.
+
+On the first request for a source it is downloaded once and stored, and
+each size is resized on demand into WebP or JPEG. Files are addressed by
+content: the original is stored under the SHA-256 of its bytes, a small
+pointer file maps each source URL to that hash, and thumbnails are named
+after the hash and size. Two URLs with the same picture share every file,
+and a thumbnail URL never changes meaning, so responses are cached by
+browsers for a year (`immutable`). Once the cache is over
+`IMAGE_CACHE_MAX_BYTES`, the least recently used files are deleted by
+
+    flask images evict --every 600
+
+Source URLs are typed in by users, so the signature doesn't make them
+safe to fetch. Only hosts resolving to public addresses are fetched
+(plus `IMAGE_FETCH_ALLOWED_NETWORKS`), the connection goes to the
+address that was checked, and every redirect is checked the same way.
+"""
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import time
+import urllib.parse
+
+import click
+from flask import Blueprint, abort, current_app, request, send_file, url_for
+from flask.cli import AppGroup, with_appcontext
+
+# Bounding boxes (width, height) of each size; thumbnails keep the aspect
+# ratio of the original and are never enlarged
+SIZES = {
+    'card': (1000, 250),
+    'detail': (400, 2000),
+}
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+QUALITY = 80
+
+# Largest image decoded, in pixels; bigger ones are refused
+MAX_PIXELS = 50 * 1000 * 1000
+
+# How long browsers keep a thumbnail
+MAX_AGE = 365 * 24 * 60 * 60
+
+# Redirects followed when fetching a source image
+MAX_REDIRECTS = 3
+
+REDIRECTS = {301, 302, 303, 307, 308}
+
+
+class ImageError(Exception):
+    """The source image could not be fetched or decoded."""
+
+
+class ImageCache(object):
+    """Content-addressed disk cache of source images and thumbnails."""
+
+    def __init__(self, app=None):
+        self.path = None
+        self.max_bytes = 0
+        self.allowed_networks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_CACHE_PATH', None)
+        app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        app.config.setdefault('IMAGE_FETCH_TIMEOUT', 5)
+        app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('IMAGE_FETCH_ALLOWED_NETWORKS', [])
+
+        self.path = app.config['IMAGE_CACHE_PATH'] or os.path.join(
+            app.instance_path, 'images')
+        self.max_bytes = app.config['IMAGE_CACHE_MAX_BYTES']
+        self.timeout = app.config['IMAGE_FETCH_TIMEOUT']
+        self.max_source_bytes = app.config['IMAGE_MAX_SOURCE_BYTES']
+        self.allowed_networks = [
+            ipaddress.ip_network(network)
+            for network in app.config['IMAGE_FETCH_ALLOWED_NETWORKS']]
+        app.extensions['image_cache'] = self
+        app.jinja_env.globals['thumbnail_url'] = thumbnail_url
+        app.register_blueprint(images)
+
+    def _file(self, kind, name):
+        return os.path.join(self.path, kind, name[:2], name)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Reads count as use for eviction
+        os.utime(path)
+        return data
+
+    def _write(self, path, data):
+        # Written aside and renamed so readers never see half a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def source(self, url):
+        """Return (content hash, bytes) of `url`, fetching it on a miss."""
+        pointer = self._file('urls', _digest(url.encode('utf-8')))
+        content_hash = self._read(pointer)
+        if content_hash is not None:
+            content_hash = content_hash.decode('ascii')
+            data = self._read(self._file('sources', content_hash))
+            if data is not None:
+                return content_hash, data
+
+        data = self.fetch(url)
+        content_hash = _digest(data)
+        self._write(self._file('sources', content_hash), data)
+        self._write(pointer, content_hash.encode('ascii'))
+        return content_hash, data
+
+    def fetch(self, url):
+        """Download `url`, refusing anything but a small public http(s) file."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            try:
+                port = parts.port or (443 if scheme == 'https' else 80)
+            except ValueError:
+                port = None
+            if scheme not in ('http', 'https') or not parts.hostname or not port:
+                raise ImageError(f'Not an http(s) URL: {url}')
+            address = self.resolve(parts.hostname, port)
+            connection_class = (_PinnedHTTPSConnection if scheme == 'https'
+                                else _PinnedHTTPConnection)
+            connection = connection_class(parts.hostname, port, address,
+                                          timeout=self.timeout)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                location = response.getheader('Location')
+                if response.status in REDIRECTS and location:
+                    url = urllib.parse.urljoin(url, location)
+                    continue
+                if response.status != 200:
+                    raise ImageError(f'{url} answered {response.status}')
+                data = response.read(self.max_source_bytes + 1)
+            except (OSError, http.client.HTTPException) as error:
+                raise ImageError(f'Could not fetch {url}: {error}')
+            finally:
+                connection.close()
+            if len(data) > self.max_source_bytes:
+                raise ImageError(f'{url} is larger than '
+                                 f'{self.max_source_bytes} bytes')
+            return data
+        raise ImageError(f'Too many redirects fetching {url}')
+
+    def resolve(self, host, port):
+        """Return an address of `host`, which must only have public ones."""
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM)]
+        except (OSError, UnicodeError) as error:
+            raise ImageError(f'Could not resolve {host}: {error}')
+        for address in addresses:
+            ip = ipaddress.ip_address(address)
+            if not (ip.is_global or any(ip in network
+                                        for network in self.allowed_networks)):
+                raise ImageError(f'{host} resolves to a non-public address')
+        return addresses[0]
+
+    def thumbnail(self, url, size, format):
+        """Return the path of the `size` thumbnail of `url` in `format`."""
+        pointer = self._read(self._file('urls', _digest(url.encode('utf-8'))))
+        if pointer is not None:
+            path = self._file('thumbnails',
+                              f'{pointer.decode("ascii")}-{size}.{format}')
+            if os.path.exists(path):
+                os.utime(path)
+                return path
+
+        content_hash, data = self.source(url)
+        path = self._file('thumbnails', f'{content_hash}-{size}.{format}')
+        if not os.path.exists(path):
+            self._write(path, resize(data, SIZES[size], FORMATS[format][0]))
+        return path
+
+    def evict(self):
+        """Delete the least recently used files until under the limit.
+
+        Returns (files deleted, bytes left).
+        """
+        files, total = [], 0
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        files.sort()
+        deleted = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            deleted += 1
+            total -= size
+        return deleted, total
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP to `address`, already checked, rather than a new lookup of host."""
+
+    def __init__(self, host, port, address, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS to `address`, verifying the certificate of `host`."""
+
+    def __init__(self, host, port, address, **kwargs):
+        super().__init__(host, port, context=ssl.create_default_context(),
+                         **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port),
+                                        self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def resize(data, box, format):
+    """Shrink image `data` to fit `box` and encode it as `format`."""
+    # Imported here so starting the app doesn't load Pillow
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs can be decoded at a fraction of their size, much faster
+        image.draft('RGB', box)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(box)
+        if image.mode not in ('RGB', 'RGBA') or format == 'JPEG':
+            image = image.convert('RGBA' if format == 'WEBP' else 'RGB')
+        output = io.BytesIO()
+        image.save(output, format, quality=QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError(f'Could not read image: {error}')
+    return output.getvalue()
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _signature(url):
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(key, b'image:' + url.encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def thumbnail_url(url, size, format='jpg'):
+    """Return the proxy URL of the `size` thumbnail of image `url`."""
+    if not url:
+        return None
+    url = str(url)
+    return url_for('images.thumbnail', size=size, format=format, src=url,
+                   sig=_signature(url))
+
+##########################################
+#           Routes                       #
+##########################################
+
+images = Blueprint('images', __name__)
+
+
+@images.route('/image/<size>.<format>')
+def thumbnail(size, format):
+    """A resized copy of a signed source image"""
+    url = request.args.get('src', '')
+    if (size not in SIZES or format not in FORMATS or not hmac.compare_digest(
+            request.args.get('sig', ''), _signature(url))):
+        abort(404)
+
+    try:
+        path = current_app.extensions['image_cache'].thumbnail(
+            url, size, format)
+    except ImageError as error:
+        current_app.logger.warning('Image proxy: %s', error)
+        abort(502)
+    response = send_file(path, mimetype=FORMATS[format][1],
+                         cache_timeout=MAX_AGE, add_etags=False)
+    # The file name is its content hash; mtimes move as the LRU is touched
+    response.set_etag(os.path.basename(path))
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+images_cli = AppGroup('images', help='Maintain the image cache.')
+
+
+@images_cli.command('evict')
+@click.option('--every', type=float,
+              help='Keep running, evicting every this many seconds.')
+@with_appcontext
+def evict_command(every):
+    """Delete the least recently used images over IMAGE_CACHE_MAX_BYTES."""
+    image_cache = current_app.extensions['image_cache']
+    while True:
+        started = time.perf_counter()
+        deleted, left = image_cache.evict()
+        click.echo(f'Evicted {deleted} files, {left} bytes left '
+                   f'in {time.perf_counter() - started:.2f}s')
+        if every is None:
+            break
+        time.sleep(every)
@@ -0,0 +1,284 @@
+"""Bulk import of artists and concerts.
+
+    flask import artists artists.csv
+    flask import concerts shows.ndjson --batch-size 1000 --dry-run
+
+Rows are read one at a time from CSV, NDJSON or a JSON array, validated
+with the same rules as `ArtistForm` / `ConcertForm`, and written in batches
+of multi-row INSERTs (plus one executemany UPDATE for rows that already
+exist), one transaction per batch. Artists are matched by name and concerts
+by (artist, name, date), so importing the same file twice changes nothing.
+Concerts may carry `latitude` and `longitude` columns to show up in nearby
+searches.
+"""
+import csv
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from werkzeug.datastructures import MultiDict
+
+from concert_app.extensions import db, cache
+from concert_app.main.forms import ArtistForm, ConcertForm
+from concert_app.models import Artist, Concert, location_geohash
+
+FORMATS = ('csv', 'json', 'ndjson')
+
+# How much of a JSON file is read at a time
+JSON_CHUNK = 64 * 1024
+
+##########################################
+#           Readers                      #
+##########################################
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+
+def read_ndjson(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_json(path):
+    """Yield the objects of a top-level JSON array without loading it all."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer, position = f.read(JSON_CHUNK).lstrip(), 0
+        if not buffer.startswith('['):
+            raise click.ClickException(f'{path} is not a JSON array')
+        position = 1
+        while True:
+            # Skip whitespace and separators before the next value
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer):
+                    break
+                chunk = f.read(JSON_CHUNK)
+                if not chunk:
+                    return
+                buffer, position = chunk, 0
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = f.read(JSON_CHUNK)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield item
+            position = end
+
+
+READERS = {'csv': read_csv, 'json': read_json, 'ndjson': read_ndjson}
+
+##########################################
+#           Validation                   #
+##########################################
+
+
+def as_formdata(row):
+    return MultiDict({key: '' if value is None else str(value)
+                      for key, value in row.items()})
+
+
+def validate_artist(row):
+    """Return (values, errors) for one artist row."""
+    form = ArtistForm(formdata=as_formdata(row), meta={'csrf': False})
+    if not form.validate():
+        return None, form.errors
+    return dict(name=form.name.data, hometown=form.hometown.data,
+                genre=form.genre.data, biography=form.biography.data,
+                image=form.image.data or None), None
+
+
+def validate_concert(row):
+    """Return (values, errors) for one concert row.
+
+    The artist is resolved separately by name, so the form's artist field
+    (which expects an artist id) is left out.
+    """
+    form = ConcertForm(formdata=as_formdata(row), meta={'csrf': False})
+    del form['artist_playing']
+    errors = {} if form.validate() else dict(form.errors)
+    artist = row.get('artist') or row.get('artist_playing')
+    if not artist:
+        errors['artist'] = ['Every concert needs an artist name.']
+    if errors:
+        return None, errors
+    return dict(name=form.name.data, price=form.price.data,
+                venue=form.venue.data, address=form.address.data,
+                date=form.date.data, image=form.image.data or None,
+                latitude=form.latitude.data, longitude=form.longitude.data,
+                geohash=location_geohash(form.latitude.data,
+                                         form.longitude.data),
+                artist=artist), None
+
+##########################################
+#           Writers                      #
+##########################################
+
+
+class Importer(object):
+    """Validates rows and upserts them in batches."""
+
+    def __init__(self, kind, batch_size, dry_run):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.inserted = self.updated = self.invalid = 0
+        # Artist name -> id, shared by every batch. Names aren't unique in
+        # the table, so the oldest artist with a name wins.
+        self.artist_ids = {}
+        for name, id in db.session.query(Artist.name, Artist.id).order_by(
+                Artist.id):
+            self.artist_ids.setdefault(name, id)
+
+    def run(self, rows):
+        if self.kind == 'artists':
+            validate = validate_artist
+        else:
+            validate = validate_concert
+        batch = []
+        for number, row in enumerate(rows, start=1):
+            values, errors = validate(row)
+            if errors:
+                self.invalid += 1
+                click.echo(f'Row {number}: {errors}', err=True)
+                continue
+            batch.append(values)
+            if len(batch) == self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        now = datetime.utcnow()
+        if self.kind == 'artists':
+            inserts, updates = self.split_artists(batch, now)
+            table = Artist.__table__
+        else:
+            inserts, updates = self.split_concerts(batch, now)
+            table = Concert.__table__
+
+        if inserts:
+            db.session.execute(table.insert().values(inserts))
+        if updates:
+            # Bound names can't clash with the column names being SET
+            columns = [key for key in updates[0] if key != 'id']
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('_id'))
+                .values({key: bindparam(f'_{key}') for key in columns}),
+                [{f'_{key}': value for key, value in row.items()}
+                 for row in updates])
+        self.inserted += len(inserts)
+        self.updated += len(updates)
+
+        if self.dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+            if self.kind == 'artists' and inserts:
+                self.remember_new_artists([row['name'] for row in inserts])
+
+    def split_artists(self, batch, now):
+        inserts, updates, seen = [], [], {}
+        for values in batch:
+            values['updated_at'] = now
+            if values['name'] in self.artist_ids:
+                updates.append(dict(values, id=self.artist_ids[values['name']]))
+            elif values['name'] in seen:
+                # Repeated in the same batch: the last row wins
+                seen[values['name']].update(values)
+            else:
+                seen[values['name']] = values
+                inserts.append(values)
+        return inserts, updates
+
+    def remember_new_artists(self, names):
+        rows = (db.session.query(Artist.name, Artist.id)
+                .filter(Artist.name.in_(names)))
+        for name, id in rows:
+            self.artist_ids.setdefault(name, id)
+
+    def split_concerts(self, batch, now):
+        resolved = []
+        for values in batch:
+            artist_id = self.artist_ids.get(values.pop('artist'))
+            if artist_id is None:
+                self.invalid += 1
+                click.echo(f'Unknown artist for concert {values["name"]!r}',
+                           err=True)
+                continue
+            values.update(artist_id=artist_id, updated_at=now)
+            resolved.append(values)
+
+        # Narrow with plain IN lists (indexed on artist_id), then match
+        # the exact (artist, name, date) keys here
+        existing = {}
+        if resolved:
+            rows = (db.session.query(Concert.id, Concert.artist_id,
+                                     Concert.name, Concert.date)
+                    .filter(Concert.artist_id.in_(
+                        list({v['artist_id'] for v in resolved})))
+                    .filter(Concert.name.in_(
+                        list({v['name'] for v in resolved}))))
+            existing = {(artist_id, name, date): id
+                        for id, artist_id, name, date in rows}
+
+        inserts, updates, seen = [], [], {}
+        for values in resolved:
+            key = (values['artist_id'], values['name'], values['date'])
+            if key in existing:
+                updates.append(dict(values, id=existing[key]))
+            elif key in seen:
+                seen[key].update(values)
+            else:
+                seen[key] = values
+                inserts.append(values)
+        return inserts, updates
+
+
+@click.command('import')
+@click.argument('kind', type=click.Choice(['artists', 'concerts']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(FORMATS),
+              help='File format; guessed from the extension by default.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Rows per INSERT and per transaction.')
+@click.option('--dry-run', is_flag=True,
+              help='Validate and resolve everything, then roll back.')
+@with_appcontext
+def import_command(kind, path, file_format, batch_size, dry_run):
+    """Bulk import artists or concerts from a CSV, JSON or NDJSON file."""
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in READERS:
+        raise click.BadParameter(f'Unknown format {file_format!r}',
+                                 param_hint='--format')
+
+    started = time.perf_counter()
+    importer = Importer(kind, batch_size, dry_run)
+    with current_app.test_request_context():
+        importer.run(READERS[file_format](path))
+    elapsed = time.perf_counter() - started
+
+    if not dry_run and (importer.inserted or importer.updated):
+        cache.bump(kind)
+    total = importer.inserted + importer.updated + importer.invalid
+    click.echo(f'{"Would import" if dry_run else "Imported"} {kind}: '
+               f'{importer.inserted} inserted, {importer.updated} updated, '
+               f'{importer.invalid} invalid in {elapsed:.2f}s '
+               f'({total / elapsed if elapsed else 0:.0f} rows/s)')
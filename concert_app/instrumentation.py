@@ -0,0 +1,182 @@
+"""Per-request SQL instrumentation.
+
+Every statement run through SQLAlchemy during a request is counted and
+timed. When the request finishes the totals are sent back in a
+`Server-Timing` header and written as one JSON log line to the
+`concert_app.sql` logger, which goes to the file named by `QUERY_LOG` when
+that is set. A streamed body is still being sent after the headers, so its
+line is written once the response is closed. Statements slower than `SLOW_QUERY_THRESHOLD_MS`
+are also written to the `concert_app.sql.slow` logger, which goes to the
+file named by `SLOW_QUERY_LOG` when that is set.
+"""
+import json
+import logging
+import os
+from time import perf_counter
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('concert_app.sql')
+slow_logger = logging.getLogger('concert_app.sql.slow')
+
+# Longest SQL snippet copied into log lines
+STATEMENT_PREVIEW = 500
+
+# Where a request's `QueryStats` are kept in its WSGI environ
+STATS_KEY = 'concert_app.query_stats'
+
+
+class QueryStats(object):
+    """SQL totals for a single request."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed >= self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+
+
+def current_stats():
+    """Return the `QueryStats` of the active request, if there is one.
+
+    They are kept in the WSGI environ rather than on `g`, because
+    `stream_with_context` runs a streamed body in a new app context.
+    """
+    if not has_request_context():
+        return None
+    return request.environ.setdefault(STATS_KEY, QueryStats())
+
+
+def _preview(statement):
+    return ' '.join(statement.split())[:STATEMENT_PREVIEW]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+    if context is not None:
+        context._query_timed = True
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute. Errors raised
+    # later, while fetching rows, come after its start was already popped
+    conn = exception_context.connection
+    context = exception_context.execution_context
+    if conn is None or not conn.info.get('query_start'):
+        return
+    if context is None or getattr(context, '_query_timed', False):
+        conn.info['query_start'].pop()
+        if context is not None:
+            context._query_timed = False
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    if context is not None:
+        context._query_timed = False
+    stats = current_stats()
+    if stats is None:
+        return
+    stats.record(statement, elapsed)
+
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD_MS'] / 1000.0
+    if elapsed >= threshold:
+        slow_logger.warning(json.dumps({
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'duration_ms': round(elapsed * 1000, 2),
+            'statement': _preview(statement),
+        }))
+
+
+def _start_request():
+    request.environ[STATS_KEY] = QueryStats()
+
+
+def _log_request(line, stats):
+    request_ms = (perf_counter() - stats.started) * 1000
+    line.update({
+        'queries': stats.count,
+        'db_ms': round(stats.total * 1000, 2),
+        'slowest_ms': round(stats.slowest * 1000, 2),
+        'slowest_statement': (_preview(stats.slowest_statement)
+                              if stats.slowest_statement else None),
+        'request_ms': round(request_ms, 2),
+    })
+    logger.info(json.dumps(line))
+
+
+def _finish_request(response):
+    stats = current_stats()
+    request_ms = (perf_counter() - stats.started) * 1000
+    db_ms = stats.total * 1000
+    slowest_ms = stats.slowest * 1000
+
+    # For a streamed body these are the totals before the first chunk
+    response.headers['Server-Timing'] = (
+        f'db;dur={db_ms:.2f};desc="{stats.count} queries", '
+        f'db-slowest;dur={slowest_ms:.2f}, '
+        f'app;dur={request_ms:.2f}')
+    line = {
+        'endpoint': request.endpoint,
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+    }
+    if response.is_streamed:
+        response.call_on_close(lambda: _log_request(line, stats))
+    else:
+        _log_request(line, stats)
+    return response
+
+
+def _log_to(log, path):
+    """Add a file handler for `path` to `log`, once per file.
+
+    The loggers are shared by every app in the process (tests and scripts
+    create several), and a handler per app would write each line again.
+    """
+    path = os.path.abspath(path)
+    for handler in log.handlers:
+        if getattr(handler, 'baseFilename', None) == path:
+            return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    log.addHandler(handler)
+
+
+def init_app(app):
+    """Hook query timing into every SQLAlchemy engine and into `app`."""
+    app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', 100)
+    app.config.setdefault('SLOW_QUERY_LOG', None)
+    app.config.setdefault('QUERY_LOG', None)
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    # Unconfigured loggers pass on WARNING and up only
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    if app.config['QUERY_LOG']:
+        _log_to(logger, app.config['QUERY_LOG'])
+    if app.config['SLOW_QUERY_LOG']:
+        _log_to(slow_logger, app.config['SLOW_QUERY_LOG'])
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,207 @@
+"""Durable background jobs in the app's own database.
+
+A view calls `enqueue(kind, **payload)` before it commits, so the job is
+saved in the same transaction as the change it follows up on: it exists
+exactly when that change does, and the view never waits for it to run.
+Workers run jobs with the handler registered for their kind:
+
+    flask jobs work --threads 4
+
+Each worker thread claims the oldest due job by locking it for `LEASE`.
+A job that raises is retried with exponential backoff, up to
+`MAX_ATTEMPTS` times, and one with no registered handler fails at once; one whose worker died is picked up again when the
+lease runs out. A job can therefore run more than once, so handlers must
+be idempotent.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import or_, select
+
+from concert_app.extensions import db
+from concert_app.models import job
+
+logger = logging.getLogger('concert_app.jobs')
+
+# How long a claimed job is left to its worker before others may retry it
+LEASE = timedelta(minutes=10)
+
+MAX_ATTEMPTS = 5
+
+# Seconds an idle worker waits before looking for jobs again
+POLL_SECONDS = 1.0
+
+# Finished jobs are deleted after this long
+KEEP_FINISHED = timedelta(days=7)
+
+# kind: handler, filled in by @handler
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for `kind` jobs."""
+    def decorator(function):
+        HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+def enqueue(kind, **payload):
+    """Add a job to the session's transaction; it runs after the commit."""
+    now = datetime.utcnow()
+    db.session.execute(job.insert().values(
+        kind=kind, payload=json.dumps(payload), attempts=0, run_at=now,
+        created_at=now))
+
+
+def backoff(attempts):
+    """Delay before retrying a job that has failed `attempts` times."""
+    return timedelta(seconds=2 ** attempts)
+
+
+def claim(worker):
+    """Lock the oldest due job for `worker`; return it, or None if idle."""
+    now = datetime.utcnow()
+    unfinished = job.c.finished_at.is_(None)
+    unlocked = or_(job.c.locked_until.is_(None), job.c.locked_until < now)
+    due = (select([job.c.id]).where(unfinished)
+           .where(job.c.run_at <= now).where(unlocked)
+           .order_by(job.c.run_at, job.c.id).limit(1))
+    # Postgres hands each worker a different row; SQLite has one writer,
+    # and the conditional UPDATE below settles any race
+    if db.engine.dialect.name == 'postgresql':
+        due = due.with_for_update(skip_locked=True)
+    while True:
+        job_id = db.session.execute(due).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        # Another worker may have claimed it since; then try the next one
+        claimed = db.session.execute(
+            job.update().where(job.c.id == job_id)
+            .where(unfinished).where(unlocked)
+            .values(locked_by=worker, locked_until=now + LEASE,
+                    attempts=job.c.attempts + 1)).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.execute(
+                job.select().where(job.c.id == job_id)).first()
+
+
+def run_next(worker):
+    """Run one due job; return False when there was none."""
+    claimed = claim(worker)
+    if claimed is None:
+        return False
+    mine = (job.c.id == claimed.id) & (job.c.locked_by == worker)
+    function = HANDLERS.get(claimed.kind)
+    if function is None:
+        # Retrying will not register a handler, so fail it now
+        logger.error('Job %s has unknown kind %r', claimed.id, claimed.kind)
+        db.session.execute(job.update().where(mine).values(
+            locked_by=None, locked_until=None, finished_at=datetime.utcnow(),
+            error=f'unknown kind {claimed.kind!r}'))
+        db.session.commit()
+        return True
+    try:
+        function(**json.loads(claimed.payload))
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        logger.exception('Job %s (%s) failed on attempt %s', claimed.id,
+                         claimed.kind, claimed.attempts)
+        now = datetime.utcnow()
+        values = dict(locked_by=None, locked_until=None, error=repr(error))
+        if claimed.attempts >= MAX_ATTEMPTS:
+            values['finished_at'] = now
+        else:
+            values['run_at'] = now + backoff(claimed.attempts)
+        db.session.execute(job.update().where(mine).values(**values))
+    else:
+        db.session.execute(job.update().where(mine).values(
+            locked_by=None, locked_until=None, error=None,
+            finished_at=datetime.utcnow()))
+    db.session.commit()
+    return True
+
+
+def prune():
+    """Delete jobs that finished more than KEEP_FINISHED ago."""
+    db.session.execute(job.delete().where(
+        job.c.finished_at < datetime.utcnow() - KEEP_FINISHED))
+    db.session.commit()
+
+
+def work(app, threads=1, once=False):
+    """Run jobs on `threads` worker threads.
+
+    With `once`, each thread stops when it finds no due job; otherwise
+    they poll until interrupted.
+    """
+    stop = threading.Event()
+    name = f'{socket.gethostname()}:{os.getpid()}'
+
+    def loop(worker):
+        with app.app_context():
+            try:
+                while not stop.is_set():
+                    if not run_next(worker):
+                        if once:
+                            break
+                        stop.wait(POLL_SECONDS)
+            finally:
+                db.session.remove()
+
+    workers = [threading.Thread(target=loop, args=(f'{name}:{number}',),
+                                daemon=True)
+               for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+jobs_cli = AppGroup('jobs', help='Run background jobs.')
+
+
+@jobs_cli.command('work')
+@click.option('--threads', default=4, show_default=True,
+              help='Jobs run at once.')
+@click.option('--once', is_flag=True,
+              help='Exit once no job is due instead of waiting for more.')
+@with_appcontext
+def work_command(threads, once):
+    """Run queued jobs."""
+    prune()
+    started = time.perf_counter()
+    work(current_app._get_current_object(), threads, once)
+    click.echo(f'Worked for {time.perf_counter() - started:.2f}s')
+
+
+@jobs_cli.command('status')
+@with_appcontext
+def status_command():
+    """Count queued, running and failed jobs."""
+    now = datetime.utcnow()
+    c = job.c
+    queued = db.session.query(job).filter(
+        c.finished_at.is_(None), c.locked_by.is_(None)).count()
+    running = db.session.query(job).filter(
+        c.finished_at.is_(None), c.locked_until >= now).count()
+    failed = db.session.query(job).filter(
+        c.finished_at.isnot(None), c.error.isnot(None)).count()
+    click.echo(f'{queued} queued, {running} running, {failed} failed')
@@ -1,10 +1,60 @@
+from flask import url_for
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SubmitField, FloatField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
-from wtforms.validators import DataRequired, Length, NumberRange
+from markupsafe import Markup
+from wtforms import Field, StringField, SelectField, SubmitField, FloatField
+from wtforms.validators import (
+    DataRequired, Length, NumberRange, Optional, ValidationError)
+from wtforms.widgets import HiddenInput, html_params
 from concert_app.models import Artist, Concert, User
 from wtforms.fields.html5 import DateField
 
+
+# Largest id a database integer column holds
+MAX_ID = 2 ** 63 - 1
+
+
+class ArtistInput(object):
+    """Artist name box with autocomplete, submitting the artist's id."""
+
+    def __call__(self, field, **kwargs):
+        # The label points at the name box; the id travels in a hidden input
+        options, hidden = f'{field.id}-options', f'{field.id}-id'
+        name = field.data.name if field.data else ''
+        search = html_params(
+            type='search', id=field.id, list=options,
+            value=name, autocomplete='off', placeholder='Start typing a name',
+            data_autocomplete=url_for('main.artist_autocomplete'),
+            data_target=hidden, **kwargs)
+        return Markup(f'<input {search}><datalist id="{options}"></datalist>'
+                      f'{HiddenInput()(field, id=hidden)}')
+
+
+class ArtistField(Field):
+    """An artist, submitted by id and checked with one primary key lookup."""
+
+    widget = ArtistInput()
+
+    def _value(self):
+        return str(self.data.id) if self.data else ''
+
+    def process_formdata(self, valuelist):
+        self.data = None
+        if not valuelist or not valuelist[0].strip():
+            return
+        try:
+            artist_id = int(valuelist[0])
+        except ValueError:
+            artist_id = None
+        # Out of range ids can't exist, and drivers refuse to bind them
+        if artist_id is not None and 0 < artist_id <= MAX_ID:
+            self.data = Artist.query.get(artist_id)
+        if self.data is None:
+            raise ValueError('Please choose an artist from the list.')
+
+    def pre_validate(self, form):
+        if self.data is None and not self.process_errors:
+            raise ValidationError('Please choose an artist.')
+
 class ArtistForm(FlaskForm):
     """Form for adding/updating a new Artist."""
 
@@ -33,6 +83,20 @@ class ConcertForm(FlaskForm):
     address = StringField('Address', validators=[DataRequired(), Length(
         min=3, max=80, message="The address needs to be between 3 and 80 chars")])
     date = DateField('Concert Date', validators=[DataRequired()])
-    artist_playing = QuerySelectField('Artist Playing',
-                                         query_factory=lambda: Artist.query, allow_blank=True)
+    latitude = FloatField('Latitude', validators=[Optional(), NumberRange(
+        min=-90, max=90, message="Please enter a latitude between -90 and 90.")])
+    longitude = FloatField('Longitude', validators=[Optional(), NumberRange(
+        min=-180, max=180, message="Please enter a longitude between -180 and 180.")])
+    artist_playing = ArtistField('Artist Playing')
     submit = SubmitField('Submit')
+
+    def validate(self):
+        """Also require the coordinates to be given together."""
+        if not super().validate():
+            return False
+        if (self.latitude.data is None) != (self.longitude.data is None):
+            missing = self.latitude if self.latitude.data is None else self.longitude
+            missing.errors.append(
+                'Please enter both a latitude and a longitude, or neither.')
+            return False
+        return True
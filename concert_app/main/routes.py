@@ -1,38 +1,314 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash
+from flask import Blueprint, Response, request, render_template, redirect, url_for, flash, jsonify, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
-from datetime import date, datetime
-from concert_app.models import Artist, Concert, User
+from datetime import date, datetime, time, timezone
+from math import isfinite
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import joinedload
+from concert_app import geo, ical, notifications
+from concert_app.models import Artist, Concert, User, user_artist, user_concert
 from concert_app.main.forms import ArtistForm, ConcertForm
+from concert_app.conditional import conditional
+from concert_app.pagination import keyset_paginate
+from concert_app.recommendations import (
+    favourite_added, favourite_removed, similar_artists, suggested_artists)
+from concert_app.routing import replica_reads
+from concert_app.search import (
+    MAX_PAGE, search_artists, search_concerts, search_terms)
+from concert_app.trending import WINDOWS, trending_artists, trending_concerts
 
-from concert_app.extensions import app, db
+from concert_app.extensions import db, cache
 
 main = Blueprint("main", __name__)
 
+# Detail pages show at most this many fans/guests alongside the total count
+PEOPLE_SHOWN = 50
+
+# Artist and profile pages list at most this many concerts/artists
+LIST_SHOWN = 50
+
+# Artist suggestions returned by default, and at most
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 25
+
+# Nearby search radius in km by default, and at most
+NEARBY_KM = 25
+MAX_NEARBY_KM = 500
+
+# Concerts listed by the nearby search
+NEARBY_LIMIT = 50
+
+
+def first_and_count(query, limit):
+    """Return the first `limit` rows of `query` and its total row count.
+
+    The count is only run when the list was actually truncated.
+    """
+    items = query.limit(limit).all()
+    if len(items) < limit:
+        return items, len(items)
+    return items, query.order_by(None).count()
+
+
+def nearby_concerts(latitude, longitude, radius_km, limit=NEARBY_LIMIT):
+    """Return (concert, km) for upcoming concerts within `radius_km`.
+
+    The geohash cells covering the circle are read as index range scans,
+    the corners outside the circle are dropped here, and the closest
+    `limit` (soonest first at the same distance) are loaded in full.
+    """
+    ranges = []
+    for low, high in map(geo.prefix_range, geo.cover(latitude, longitude,
+                                                     radius_km)):
+        ranges.append(Concert.geohash >= low if high is None
+                      else and_(Concert.geohash >= low, Concert.geohash < high))
+    candidates = (db.session.query(Concert.id, Concert.date,
+                                   Concert.latitude, Concert.longitude)
+                  .filter(or_(*ranges))
+                  .filter(Concert.date >= date.today()))
+    nearby = []
+    for id, day, lat, lon in candidates:
+        km = geo.distance_km(latitude, longitude, lat, lon)
+        if km <= radius_km:
+            nearby.append((km, day, id))
+    nearby = sorted(nearby)[:limit]
+    if not nearby:
+        return []
+    concerts = {concert.id: concert for concert in Concert.query.filter(
+        Concert.id.in_([id for _, _, id in nearby]))}
+    return [(concerts[id], km) for km, _, id in nearby]
+
+##########################################
+#           Validators                   #
+##########################################
+
+# Each returns the modification times of everything its page shows, or
+# None when the page doesn't exist.
+
+def latest_concert_change(**kwargs):
+    return [db.session.query(func.max(Concert.updated_at)).scalar()]
+
+
+def midnight():
+    """Return when today began, as naive UTC like the `updated_at` stamps.
+
+    Upcoming lists start at `date.today()`, the server's local date, so
+    they change at local midnight, whatever that is in UTC.
+    """
+    return (datetime.combine(date.today(), time()).astimezone(timezone.utc)
+            .replace(tzinfo=None))
+
+
+def latest_upcoming_change(**kwargs):
+    # The upcoming list also changes at midnight when concerts drop off it
+    return latest_concert_change() + [midnight()]
+
+
+def latest_artist_change(**kwargs):
+    return [db.session.query(func.max(Artist.updated_at)).scalar()]
+
+
+def artist_changes(artist_id):
+    concerts_changed = (select([func.max(Concert.updated_at)])
+                        .where(Concert.artist_id == Artist.id)
+                        .as_scalar())
+    row = (db.session.query(Artist.updated_at, Artist.similar_changed_at,
+                            concerts_changed)
+           .filter(Artist.id == artist_id).first())
+    return list(row) if row else None
+
+
+def concert_changes(concert_id):
+    row = (db.session.query(Concert.updated_at, Artist.updated_at)
+           .join(Concert.artist_playing)
+           .filter(Concert.id == concert_id).first())
+    return list(row) if row else None
+
+
+def profile_changes(username):
+    favourites_changed = (select([func.max(Artist.updated_at)])
+                          .where(Artist.id == user_artist.c.artist_id)
+                          .where(user_artist.c.user_id == User.id)
+                          .as_scalar())
+    # Suggestions come from the neighbours of the favourites
+    suggestions_changed = (select([func.max(Artist.similar_changed_at)])
+                           .where(Artist.id == user_artist.c.artist_id)
+                           .where(user_artist.c.user_id == User.id)
+                           .as_scalar())
+    attending_changed = (select([func.max(Concert.updated_at)])
+                         .where(Concert.id == user_concert.c.concert_id)
+                         .where(user_concert.c.user_id == User.id)
+                         .as_scalar())
+    row = (db.session.query(User.updated_at, favourites_changed,
+                            suggestions_changed, attending_changed)
+           .filter(User.username == username).first())
+    return list(row) if row else None
+
+
+def calendar_changes(username):
+    today = date.today()
+    concerts_changed = (select([func.max(Concert.updated_at)])
+                        .where(Concert.id == user_concert.c.concert_id)
+                        .where(user_concert.c.user_id == User.id)
+                        .where(Concert.date >= today)
+                        .as_scalar())
+    # Not User.updated_at, which favourites and notifications move too
+    row = (db.session.query(User.attending_changed_at, concerts_changed)
+           .filter(User.username == username).first())
+    # Concerts drop off the feed as their day passes
+    return list(row) + [midnight()] if row else None
+
 ##########################################
 #           Routes                       #
 ##########################################
 
 @main.route('/')
+@replica_reads
+@cache.cached_page('concerts')
+@conditional(latest_upcoming_change)
 def homepage():
     """Homepage route"""
-    all_concerts = Concert.query.all()
-    print(all_concerts)
-    return render_template('home.html', all_concerts=all_concerts)
+    after, before = request.args.get('after'), request.args.get('before')
+
+    def render_grid():
+        upcoming = Concert.query.filter(Concert.date >= date.today())
+        page = keyset_paginate(upcoming, [Concert.date, Concert.id],
+                               after=after, before=before)
+        return render_template('_concert_grid.html', page=page)
+
+    grid = cache.fragment(f'home:{date.today()}:{after}:{before}',
+                          ['concerts'], render_grid)
+    return render_template('home.html', grid=grid)
 
 
 @main.route('/concert')
+@replica_reads
+@cache.cached_page('concerts', 'attendance')
+@conditional(latest_concert_change)
 def all_concerts():
-    """Concert route"""
-    all_concerts = Concert.query.all()
-    print(all_concerts)
-    return render_template('all_concerts.html', all_concerts=all_concerts)
+    """Concert route, by date or with ?sort=popular by attendees"""
+    after, before = request.args.get('after'), request.args.get('before')
+    sort = 'popular' if request.args.get('sort') == 'popular' else None
+
+    def render_grid():
+        dated = Concert.query.filter(Concert.date.isnot(None))
+        if sort:
+            page = keyset_paginate(dated, [Concert.attendee_count, Concert.id],
+                                   after=after, before=before,
+                                   descending=True)
+        else:
+            page = keyset_paginate(dated, [Concert.date, Concert.id],
+                                   after=after, before=before)
+        return render_template('_concert_grid.html', page=page, sort=sort)
+
+    if sort:
+        grid = cache.fragment(f'concerts:popular:{after}:{before}',
+                              ['concerts', 'attendance'], render_grid)
+    else:
+        grid = cache.fragment(f'concerts:{after}:{before}', ['concerts'],
+                              render_grid)
+    return render_template('all_concerts.html', grid=grid, sort=sort)
+
+@main.route('/concert/nearby')
+@replica_reads
+@cache.cached_page('concerts')
+def nearby():
+    """Upcoming concerts near a point, closest first"""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    radius = request.args.get('km', NEARBY_KM, type=float)
+    # NaN passes every range check, and would never end the cell cover
+    if not all(isfinite(value) for value in (latitude, longitude, radius)
+               if value is not None):
+        return render_template(
+            'nearby.html', latitude=None, longitude=None, radius=NEARBY_KM,
+            concerts=None, error='Please enter numbers.'), 400
+    radius = min(max(radius, 1), MAX_NEARBY_KM)
+    error, concerts = None, None
+    if latitude is not None and longitude is not None:
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            concerts = nearby_concerts(latitude, longitude, radius)
+        else:
+            error = ('Latitude must be between -90 and 90 and longitude '
+                     'between -180 and 180.')
+    elif 'lat' in request.args or 'lon' in request.args:
+        error = 'Please enter both a latitude and a longitude.'
+    return render_template('nearby.html', latitude=latitude,
+                           longitude=longitude, radius=radius,
+                           concerts=concerts, error=error)
 
 @main.route('/artist')
+@replica_reads
+@cache.cached_page('artists', 'favourites')
+@conditional(latest_artist_change)
 def all_artists():
-    """Artists route"""
-    all_artists = Artist.query.all()
-    print(all_artists)
-    return render_template('all_artists.html', all_artists=all_artists)
+    """Artists route, by name or with ?sort=popular by fans"""
+    after, before = request.args.get('after'), request.args.get('before')
+    sort = 'popular' if request.args.get('sort') == 'popular' else None
+
+    def render_grid():
+        if sort:
+            page = keyset_paginate(Artist.query, [Artist.fan_count, Artist.id],
+                                   after=after, before=before,
+                                   descending=True)
+        else:
+            page = keyset_paginate(Artist.query, [Artist.name, Artist.id],
+                                   after=after, before=before)
+        return render_template('_artist_grid.html', page=page, sort=sort)
+
+    if sort:
+        grid = cache.fragment(f'artists:popular:{after}:{before}',
+                              ['artists', 'favourites'], render_grid)
+    else:
+        grid = cache.fragment(f'artists:{after}:{before}', ['artists'],
+                              render_grid)
+    return render_template('all_artists.html', grid=grid, sort=sort)
+
+@main.route('/trending')
+@replica_reads
+@cache.cached_page('trending', 'artists', 'concerts', ttl=60)
+def trending():
+    """Concerts and artists gaining the most guests and fans"""
+    window = request.args.get('window')
+    if window not in WINDOWS:
+        window = '7d'
+    return render_template('trending.html', window=window, windows=WINDOWS,
+                           concerts=trending_concerts(window),
+                           artists=trending_artists(window))
+
+@main.route('/search')
+@replica_reads
+@cache.cached_page('artists', 'concerts')
+def search():
+    """Search artists and concerts"""
+    query = request.args.get('q', '').strip()
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_PAGE)
+    terms = search_terms(query)
+    artists = search_artists(terms, page) if terms else None
+    concerts = search_concerts(terms, page) if terms else None
+    return render_template('search.html', query=query, page=page,
+                           artists=artists, concerts=concerts)
+
+@main.route('/artist/autocomplete')
+@replica_reads
+def artist_autocomplete():
+    """Artists whose names start with `q`, as JSON"""
+    prefix = request.args.get('q', '').strip().lower()[:80]
+    limit = min(max(request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int),
+                    1), MAX_AUTOCOMPLETE_LIMIT)
+    artists = []
+    if prefix:
+        # A range rather than LIKE so the (name_lower, id) index is used
+        artists = (db.session.query(Artist.id, Artist.name, Artist.hometown)
+                   .filter(Artist.name_lower >= prefix,
+                           Artist.name_lower < prefix + '\U0010ffff')
+                   .order_by(Artist.name_lower, Artist.id)
+                   .limit(limit))
+    response = jsonify(artists=[
+        {'id': id, 'name': name, 'hometown': hometown}
+        for id, name, hometown in artists])
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 @main.route('/new_artist', methods=['GET', 'POST'])
 @login_required
@@ -50,6 +326,7 @@ def new_artist():
         )
         db.session.add(new_artist)
         db.session.commit()
+        cache.bump('artists')
 
         flash('New artist was created successfully.')
         return redirect(url_for('main.artist_detail', artist_id=new_artist.id))
@@ -70,10 +347,16 @@ def new_concert():
             venue=form.venue.data,
             address=form.address.data,
             date=form.date.data,
+            latitude=form.latitude.data,
+            longitude=form.longitude.data,
             artist_playing=form.artist_playing.data
         )
         db.session.add(new_concert)
+        # The id is needed for the job, which commits along with the concert
+        db.session.flush()
+        notifications.announce(new_concert.id)
         db.session.commit()
+        cache.bump('concerts')
 
         flash('New concert was created successfully.')
         return redirect(url_for('main.concert_detail', concert_id=new_concert.id))
@@ -81,10 +364,27 @@ def new_concert():
     return render_template('new_concert.html', form=form)
 
 @main.route('/artist/<artist_id>', methods=['GET', 'POST'])
+@replica_reads
+@cache.cached_page('artists', 'concerts', 'favourites')
+@conditional(artist_changes)
 def artist_detail(artist_id):
     """Artist details"""
-    artist = Artist.query.get(artist_id)
-    return render_template('artist_detail.html', artist=artist)
+    artist = Artist.query.get_or_404(artist_id)
+    concerts, concert_count = first_and_count(
+        Concert.query.filter(Concert.artist_id == artist.id)
+        .filter(Concert.date >= date.today())
+        .order_by(Concert.date, Concert.id), LIST_SHOWN)
+    fans, fan_count = first_and_count(
+        User.query.join(user_artist)
+        .filter(user_artist.c.artist_id == artist.id)
+        .order_by(User.username), PEOPLE_SHOWN)
+    is_favourite = (current_user.is_authenticated
+                    and current_user.is_favourite(artist.id))
+    return render_template('artist_detail.html', artist=artist,
+                           concerts=concerts, concert_count=concert_count,
+                           fans=fans, fan_count=fan_count,
+                           is_favourite=is_favourite,
+                           similar=similar_artists(artist.id))
 
 
 @main.route('/artist/<artist_id>/edit', methods=['GET', 'POST'])
@@ -97,6 +397,7 @@ def edit_artist(artist_id):
         form.populate_obj(artist)
         db.session.add(artist)
         db.session.commit()
+        cache.bump('artists')
   
         flash('Artist was updated successfully')
         return redirect(url_for('main.artist_detail',artist_id=artist.id))
@@ -105,10 +406,23 @@ def edit_artist(artist_id):
 
 
 @main.route('/concert/<concert_id>', methods=['GET', 'POST'])
+@replica_reads
+@cache.cached_page('concerts', 'artists', 'attendance')
+@conditional(concert_changes)
 def concert_detail(concert_id):
     """Concert details"""
-    concert = Concert.query.get(concert_id)
-    return render_template('concert_detail.html', concert=concert)
+    concert = (Concert.query
+               .options(joinedload(Concert.artist_playing))
+               .get_or_404(concert_id))
+    guests, guest_count = first_and_count(
+        User.query.join(user_concert)
+        .filter(user_concert.c.concert_id == concert.id)
+        .order_by(User.username), PEOPLE_SHOWN)
+    is_attending = (current_user.is_authenticated
+                    and current_user.is_attending(concert.id))
+    return render_template('concert_detail.html', concert=concert,
+                           guests=guests, guest_count=guest_count,
+                           is_attending=is_attending)
 
 
 @main.route('/concert/<concert_id>/edit', methods=['GET', 'POST'])
@@ -122,6 +436,7 @@ def edit_concert(concert_id):
         form.populate_obj(concert)
         db.session.add(concert)
         db.session.commit()
+        cache.bump('concerts')
 
         flash('Concert was updated successfully')
         return redirect(url_for('main.concert_detail', concert_id=concert.id))
@@ -129,22 +444,82 @@ def edit_concert(concert_id):
     return render_template('edit_concert.html', concert=concert, form=form)
 
 @main.route('/profile/<username>')
+@replica_reads
+@cache.cached_page('artists', 'concerts', 'attendance', 'favourites')
+@conditional(profile_changes)
 def profile(username):
-    user = User.query.filter_by(username=username).one()
-    return render_template('profile.html', user=user)
+    user = User.query.filter_by(username=username).first_or_404()
+    favourites, favourite_count = first_and_count(
+        Artist.query.join(user_artist)
+        .filter(user_artist.c.user_id == user.id)
+        .order_by(Artist.name, Artist.id), LIST_SHOWN)
+    attending, attending_count = first_and_count(
+        Concert.query.join(user_concert)
+        .filter(user_concert.c.user_id == user.id)
+        .filter(Concert.date >= date.today())
+        .order_by(Concert.date, Concert.id), LIST_SHOWN)
+    suggested = suggested_artists(artist.id for artist in favourites)
+    return render_template('profile.html', user=user, suggested=suggested,
+                           favourites=favourites,
+                           favourite_count=favourite_count,
+                           attending=attending,
+                           attending_count=attending_count)
+
+
+@main.route('/profile/<username>/calendar.ics')
+@replica_reads
+@conditional(calendar_changes)
+def calendar(username):
+    """The user's upcoming concerts as an iCalendar feed"""
+    user_id = (db.session.query(User.id)
+               .filter(User.username == username).first_or_404().id)
+    # Read in the order of the user_concert primary key, so rows stream
+    # without a sort; calendar apps order events themselves
+    concerts = (db.session.query(
+                    Concert.id, Concert.name, Concert.venue, Concert.address,
+                    Concert.date, Concert.latitude, Concert.longitude,
+                    Concert.updated_at)
+                .join(user_concert, user_concert.c.concert_id == Concert.id)
+                .filter(user_concert.c.user_id == user_id)
+                .filter(Concert.date >= date.today())
+                .order_by(user_concert.c.concert_id))
+
+    def concert_url(concert_id):
+        return url_for('main.concert_detail', concert_id=concert_id,
+                       _external=True)
+
+    return Response(
+        stream_with_context(ical.feed(f'{username} concerts', concerts,
+                                      concert_url)),
+        mimetype='text/calendar')
+
+
+@main.route('/notifications')
+@login_required
+def notifications_inbox():
+    """New concerts by the user's favourite artists"""
+    return render_template('notifications.html',
+                           inbox=notifications.inbox(current_user.id))
+
+@main.route('/notifications/read', methods=['POST'])
+@login_required
+def notifications_read():
+    """Mark all of the user's notifications read"""
+    notifications.mark_all_read(current_user.id)
+    db.session.commit()
+    return redirect(url_for('main.notifications_inbox'))
 
 
 @main.route('/attending/<concert_id>', methods=['POST'])
 @login_required
 def attending(concert_id):
     """Add concert to user attending list"""
-    concert = Concert.query.get(concert_id)
-    if concert in current_user.attending:
+    concert = Concert.query.get_or_404(concert_id)
+    if not current_user.attend(concert.id):
         flash('You are already attending this concert.')
     else:
-        current_user.attending.append(concert)
-        db.session.add(current_user)
         db.session.commit()
+        cache.bump('attendance')
         flash("Added concert to attending")
     return redirect(url_for('main.concert_detail', concert_id=concert.id))
 
@@ -152,13 +527,12 @@ def attending(concert_id):
 @login_required
 def unattend(concert_id):
     """Remove concert from user attending list"""
-    concert = Concert.query.get(concert_id)
-    if concert not in current_user.attending:
+    concert = Concert.query.get_or_404(concert_id)
+    if not current_user.unattend(concert.id):
         flash('This concert was not in your attending list.')
     else:
-        current_user.attending.remove(concert)
-        db.session.add(current_user)
         db.session.commit()
+        cache.bump('attendance')
         flash('Concert removed from your attending list.')
     return redirect(url_for('main.concert_detail', concert_id=concert.id))
 
@@ -166,13 +540,13 @@ def unattend(concert_id):
 @login_required
 def favourite(artist_id):
     """Add Artist to user favourite list"""
-    artist = Artist.query.get(artist_id)
-    if artist in current_user.favourites:
+    artist = Artist.query.get_or_404(artist_id)
+    if not current_user.favourite(artist.id):
         flash('This artist is already in your favourites.')
     else:
-        current_user.favourites.append(artist)
-        db.session.add(current_user)
+        favourite_added(current_user.id, artist.id)
         db.session.commit()
+        cache.bump('favourites')
         flash("Added artist to favourites.")
     return redirect(url_for('main.artist_detail', artist_id=artist.id))
 
@@ -180,12 +554,12 @@ def favourite(artist_id):
 @login_required
 def unfavourite(artist_id):
     """Remove Artist from user favourite list"""
-    artist = Artist.query.get(artist_id)
-    if artist not in current_user.favourites:
+    artist = Artist.query.get_or_404(artist_id)
+    if not current_user.unfavourite(artist.id):
         flash('This artist was not in your favourites.')
     else:
-        current_user.favourites.remove(artist)
-        db.session.add(current_user)
+        favourite_removed(current_user.id, artist.id)
         db.session.commit()
+        cache.bump('favourites')
         flash('Artist removed from your favourites list.')
     return redirect(url_for('main.artist_detail', artist_id=artist.id))
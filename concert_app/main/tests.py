@@ -1,16 +1,54 @@
+import gzip
+import html
+import io
+import ipaddress
+import json
+import logging
 import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import types
 import unittest
-import app
+from random import Random
 
-from datetime import date
-from concert_app.extensions import app, db, bcrypt
-from concert_app.models import Concert, Artist, User
+import brotli
+
+from contextlib import contextmanager
+from flask import url_for
+from werkzeug.http import http_date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.engine import Engine
+from PIL import Image
+from concert_app import (
+    assets, database, geo, images, jobs, models, notifications,
+    recommendations, trending)
+from concert_app.main import routes
+from concert_app.routing import PRIMARY_UNTIL, use_replica
+from concert_app.cache import (
+    Cache, MemoryBackend, NullBackend, SQLiteBackend)
+from concert_app.config import Config
+from concert_app.identity import identities
+from concert_app.images import ImageError, thumbnail_url
+from concert_app.extensions import db, bcrypt, cache, image_cache
+from concert_app.factory import create_app
+from concert_app.models import (
+    Concert, Artist, User, activity_bucket, activity_event,
+    artist_cooccurrence, job, location_geohash,
+    notification, user_artist, user_concert)
 
 """
 Run these tests with:
 python3 -m unittest concert_app.main.tests
 """
 
+app = create_app()
+
 #################################################
 # Setup
 #################################################
@@ -39,16 +77,94 @@ def new_concert():
         price='10',
         venue='The venue',
         address='123 Main Street',
-        date=date(2023, 7, 11),
+        date=date.today() + timedelta(days=30),
         artist_playing=artist
     )
     db.session.add(concert)
     db.session.commit()
 
 
+def new_artists(count):
+    # Creates `count` artists named 'Artist 00', 'Artist 01', ...
+    for i in range(count):
+        db.session.add(Artist(
+            name=f'Artist {i:02d}',
+            hometown='Calgary',
+            genre='Punk',
+            biography='Punk band from Calgary'
+        ))
+    db.session.commit()
+
+
+def new_catalogue(artists, concerts_per_artist, users):
+    # Bulk inserts a catalogue large enough for the query planner to care
+    db.session.execute(Artist.__table__.insert(), [
+        dict(id=a, name=f'Artist {a:05d}', hometown='Calgary', genre='Punk',
+             biography='Punk band from Calgary')
+        for a in range(1, artists + 1)])
+    # Concerts are spread over a 5 x 5 degree grid
+    db.session.execute(Concert.__table__.insert(), [
+        dict(name=f'Show {a}-{c}', price=10, venue='The venue',
+             address='123 Main Street', artist_id=a,
+             date=date.today() + timedelta(days=(a * c) % 400 - 100),
+             latitude=50 + a % 50 / 10, longitude=-115 + c * 0.5,
+             geohash=location_geohash(50 + a % 50 / 10, -115 + c * 0.5))
+        for a in range(1, artists + 1) for c in range(concerts_per_artist)])
+    db.session.execute(User.__table__.insert(), [
+        dict(id=u, username=f'user{u:05d}', password='x')
+        for u in range(1, users + 1)])
+    db.session.execute(user_artist.insert(), [
+        dict(user_id=u, artist_id=(u * 7) % artists + 1)
+        for u in range(1, users + 1)])
+    db.session.execute(user_concert.insert(), [
+        dict(user_id=u, concert_id=(u * 13) % (artists * concerts_per_artist) + 1)
+        for u in range(1, users + 1)])
+    db.session.commit()
+
+
+@contextmanager
+def full_table_scans():
+    # Collects the tables any statement in the block reads without an index
+    scans = []
+
+    def after_cursor_execute(conn, cursor, statement, parameters, *args):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            return
+        plan = conn.connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        for row in plan:
+            match = re.match(r'SCAN (?:TABLE )?(\w+)$', row[-1])
+            if match:
+                scans.append((match.group(1), statement))
+
+    engine = db.engine
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        yield scans
+    finally:
+        event.remove(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+@contextmanager
+def count_queries():
+    # Collects every SQL statement run inside the block
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def create_user():
     # Creates a user with username 'laurel1' and password of 'password'
-    password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+    password_hash = bcrypt.generate_password_hash(
+        'password', app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
     user = User(username='laurel1', password=password_hash)
     db.session.add(user)
     db.session.commit()
@@ -66,9 +182,15 @@ class MainTests(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
         self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
         db.drop_all()
         db.create_all()
+        cache.clear()
+        identities.clear()
 
     def test_homepage_logged_out(self):
         """Test that the concerts show up on the homepage."""
@@ -171,6 +293,146 @@ class MainTests(unittest.TestCase):
         self.assertIsNotNone(created_concert)
         self.assertEqual(created_concert.price, 25.0)
 
+    def test_new_concert_rejects_unknown_artist(self):
+        """Test that the artist id is checked before saving."""
+        create_user()
+        new_concert()
+        login(self.app, 'laurel1', 'password')
+        post_data = {
+            'name': 'Basement Dweller',
+            'price': '25',
+            'venue': 'Mikeys',
+            'address': '123 Street',
+            'date': '2023-01-12',
+            'artist_playing': 99
+        }
+        for artist_id in [99, '9' * 30, -2 ** 70]:
+            post_data['artist_playing'] = artist_id
+            response = self.app.post('/new_concert', data=post_data)
+            self.assertEqual(response.status_code, 200, artist_id)
+            self.assertIn('Please choose an artist from the list.',
+                          response.get_data(as_text=True))
+        self.assertEqual(Concert.query.count(), 1)
+
+    def test_new_concert_with_location(self):
+        """Test that coordinates are optional but must come in pairs."""
+        create_user()
+        new_concert()
+        login(self.app, 'laurel1', 'password')
+        post_data = {
+            'name': 'Basement Dweller',
+            'price': '25',
+            'venue': 'Mikeys',
+            'address': '123 Street',
+            'date': '2023-01-12',
+            'latitude': '51.0447',
+            'artist_playing': 1
+        }
+        response = self.app.post('/new_concert', data=post_data)
+        self.assertIn('Please enter both a latitude and a longitude',
+                      response.get_data(as_text=True))
+
+        post_data['longitude'] = '-114.0719'
+        self.app.post('/new_concert', data=post_data)
+        concert = Concert.query.filter_by(name='Basement Dweller').one()
+        self.assertEqual(concert.geohash, 'c3nfkhrku')
+
+        post_data.update(latitude='', longitude='')
+        self.app.post(f'/concert/{concert.id}/edit', data=post_data)
+        self.assertIsNone(Concert.query.get(concert.id).geohash)
+
+    def test_nearby_concerts(self):
+        """Test that upcoming concerts in range are listed closest first."""
+        new_concert()
+        soon = date.today() + timedelta(days=1)
+        places = [('Calgary Late', 51.0447, -114.0719, 20),
+                  ('Calgary Soon', 51.0447, -114.0719, 1),
+                  ('Banff', 51.1784, -115.5708, 1),
+                  ('Edmonton', 53.5461, -113.4938, 1),
+                  ('Calgary Past', 51.0447, -114.0719, -1)]
+        for name, latitude, longitude, days in places:
+            db.session.add(Concert(
+                name=name, price=10, venue='The venue', address='Street',
+                date=date.today() + timedelta(days=days), artist_id=1,
+                latitude=latitude, longitude=longitude))
+        db.session.commit()
+
+        response = self.app.get('/concert/nearby?lat=51.05&lon=-114.07&km=150')
+        names = re.findall(r'>([^<]+)</a>\s+at', response.get_data(as_text=True))
+        self.assertEqual(names, ['Calgary Soon', 'Calgary Late', 'Banff'])
+
+        response = self.app.get('/concert/nearby?lat=51.05&lon=-114.07&km=1000')
+        self.assertIn('Edmonton', response.get_data(as_text=True))
+        response = self.app.get('/concert/nearby?lat=0&lon=0')
+        self.assertIn('No upcoming concerts', response.get_data(as_text=True))
+        response = self.app.get('/concert/nearby?lat=91&lon=0')
+        self.assertIn('Latitude must be', response.get_data(as_text=True))
+
+    def test_nearby_rejects_non_finite_numbers(self):
+        """Test that NaN and infinity are refused rather than searched."""
+        for query in ['lat=0&lon=0&km=nan', 'lat=0&lon=0&km=inf',
+                      'lat=nan&lon=0', 'lat=0&lon=-inf']:
+            response = self.app.get(f'/concert/nearby?{query}')
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('Please enter numbers', response.get_data(as_text=True))
+        with self.assertRaises(ValueError):
+            geo.cover(0, 0, float('nan'))
+
+    def test_nearby_crosses_the_antimeridian(self):
+        """Test that concerts just across the date line are found."""
+        new_concert()
+        for name, longitude in [('Fiji East', 179.9), ('Samoa West', -179.9)]:
+            db.session.add(Concert(
+                name=name, price=10, venue='The venue', address='Street',
+                date=date.today() + timedelta(days=1), artist_id=1,
+                latitude=-17.0, longitude=longitude))
+        db.session.commit()
+
+        for longitude in (179.95, -179.95):
+            response = self.app.get(
+                f'/concert/nearby?lat=-17&lon={longitude}&km=50')
+            text = response.get_data(as_text=True)
+            self.assertIn('Fiji East', text)
+            self.assertIn('Samoa West', text)
+        # Near the pole the box goes round the globe
+        across = geo.encode(89.95, -170.0)
+        self.assertTrue(any(across.startswith(cell)
+                            for cell in geo.cover(89.9, 179.9, 50)))
+        self.assertLessEqual(len(geo.cover(0, 0, 20000)), 32)
+
+    def test_concert_form_does_not_list_artists(self):
+        """Test that the concert forms cost the same for any catalogue."""
+        create_user()
+        new_concert()
+        login(self.app, 'laurel1', 'password')
+        with count_queries() as few:
+            self.app.get('/concert/1/edit')
+        new_artists(30)
+        with count_queries() as many:
+            response = self.app.get('/concert/1/edit')
+        response_text = response.get_data(as_text=True)
+        self.assertNotIn('Artist 29', response_text)
+        self.assertIn('value="Band"', response_text)
+        self.assertEqual(len(many), len(few))
+
+    def test_artist_autocomplete(self):
+        """Test that suggestions match name prefixes, any case."""
+        new_artists(15)
+        new_concert()
+        response = self.app.get('/artist/autocomplete?q=ARTIST 1')
+        names = [artist['name'] for artist in response.get_json()['artists']]
+        self.assertEqual(names, [f'Artist {i}' for i in range(10, 15)])
+
+        response = self.app.get('/artist/autocomplete?q=a&limit=3')
+        names = [artist['name'] for artist in response.get_json()['artists']]
+        self.assertEqual(names, ['Artist 00', 'Artist 01', 'Artist 02'])
+
+        response = self.app.get('/artist/autocomplete?q=ban')
+        self.assertEqual(response.get_json()['artists'],
+                         [{'id': 16, 'name': 'Band', 'hometown': 'Calgary'}])
+        response = self.app.get('/artist/autocomplete?q=')
+        self.assertEqual(response.get_json()['artists'], [])
+
     def test_new_artist(self):
         """Test creating an artist."""
         # Create a user & login (so that the user can access the route)
@@ -206,6 +468,136 @@ class MainTests(unittest.TestCase):
         response_text = response.get_data(as_text=True)
         self.assertIn("laurel1", response_text)
 
+    def test_calendar_feed(self):
+        """Test that the feed lists upcoming attended concerts as events."""
+        new_concert()
+        create_user()
+        past = Concert(name='Oldfest', price=10, venue='Hall',
+                       address='1 Road', date=date.today() - timedelta(days=1),
+                       artist_id=1)
+        db.session.add(past)
+        db.session.commit()
+        user = User.query.filter_by(username='laurel1').one()
+        user.attend(1)
+        user.attend(past.id)
+        Concert.query.get(1).name = 'Funfest ' + 'é' * 80
+        db.session.commit()
+
+        response = self.app.get('/profile/laurel1/calendar.ics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/calendar')
+        feed = response.get_data(as_text=True)
+        self.assertTrue(feed.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(feed.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(feed.count('BEGIN:VEVENT'), 1)
+        self.assertNotIn('Oldfest', feed)
+        self.assertIn('LOCATION:The venue\\, 123 Main Street', feed)
+        day = date.today() + timedelta(days=30)
+        self.assertIn(f'DTSTART;VALUE=DATE:{day:%Y%m%d}', feed)
+        lines = feed.split('\r\n')
+        self.assertTrue(all(len(line.encode('utf-8')) <= 75
+                            for line in lines))
+        unfolded = feed.replace('\r\n ', '')
+        self.assertIn('SUMMARY:Funfest ' + 'é' * 80 + '\r\n', unfolded)
+
+        self.assertEqual(
+            self.app.get('/profile/nobody/calendar.ics').status_code, 404)
+
+    def test_calendar_feed_answers_conditional_get(self):
+        """Test that polling the feed costs one query until it changes."""
+        new_concert()
+        create_user()
+        user = User.query.filter_by(username='laurel1').one()
+        user.attend(1)
+        db.session.commit()
+        url = '/profile/laurel1/calendar.ics'
+        etag = self.app.get(url).headers['ETag']
+
+        with count_queries() as statements:
+            response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+        Concert.query.get(1).venue = 'The other venue'
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('The other venue', response.get_data(as_text=True))
+        etag = response.headers['ETag']
+
+        user.unattend(1)
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('VEVENT', response.get_data(as_text=True))
+
+    def test_last_modified_is_utc_on_any_server_timezone(self):
+        """Test that local midnight is never a future Last-Modified."""
+        new_concert()
+        create_user()
+        User.query.get(1).attend(1)
+        db.session.commit()
+        old_tz = os.environ.get('TZ')
+
+        def restore():
+            if old_tz is None:
+                os.environ.pop('TZ', None)
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+        self.addCleanup(restore)
+        # UTC+14, where local midnight is hours ahead of UTC's
+        os.environ['TZ'] = 'Etc/GMT-14'
+        time.tzset()
+        local_today = (datetime.utcnow() + timedelta(hours=14)).date()
+        self.assertEqual(
+            routes.midnight(),
+            datetime.combine(local_today, datetime.min.time())
+            - timedelta(hours=14))
+
+        for url in ['/', '/profile/laurel1/calendar.ics']:
+            response = self.app.get(url)
+            self.assertLessEqual(response.last_modified.replace(tzinfo=None),
+                                 datetime.utcnow(), url)
+            # Now is later than that, so the page hasn't changed since
+            response = self.app.get(url, headers={
+                'If-Modified-Since': http_date(datetime.utcnow())})
+            self.assertEqual(response.status_code, 304, url)
+
+    def test_calendar_feed_ignores_other_user_changes(self):
+        """Test that favourites and notifications keep the feed's ETag."""
+        new_concert()
+        create_user()
+        user_id = User.query.filter_by(username='laurel1').one().id
+        User.query.get(user_id).attend(1)
+        db.session.commit()
+        url = '/profile/laurel1/calendar.ics'
+        etag = self.app.get(url).headers['ETag']
+
+        User.query.get(user_id).favourite(1)
+        db.session.commit()
+        other = Concert(name='Otherfest', price=1, venue='Hall',
+                        address='2 Road',
+                        date=date.today() + timedelta(days=3), artist_id=1)
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        notifications.announce(other_id)
+        db.session.commit()
+        app.test_cli_runner().invoke(args=['jobs', 'work', '--once'])
+        self.assertEqual(
+            db.session.query(notification).filter_by(user_id=user_id).count(),
+            1)
+        notifications.mark_all_read(user_id)
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        User.query.get(user_id).attend(other_id)
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_attend_concert(self):
         # Login as the user laurel1
         new_concert()
@@ -239,3 +631,1600 @@ class MainTests(unittest.TestCase):
         user = User.query.filter_by(username='laurel1').one()
         concert = Concert.query.get(1)
         self.assertNotIn(concert, user.attending)
+
+    def test_homepage_hides_past_concerts(self):
+        """Test that the homepage only lists upcoming concerts."""
+        new_concert()
+        artist = Artist.query.get(1)
+        db.session.add(Concert(
+            name='Oldfest', price=5, venue='The venue',
+            address='123 Main Street', date=date(2020, 1, 1),
+            artist_playing=artist))
+        db.session.commit()
+
+        response_text = self.app.get('/').get_data(as_text=True)
+        self.assertIn('Funfest', response_text)
+        self.assertNotIn('Oldfest', response_text)
+
+        # Past concerts are still listed on the all concerts page
+        response_text = self.app.get('/concert').get_data(as_text=True)
+        self.assertIn('Oldfest', response_text)
+
+    def test_all_artists_pagination(self):
+        """Test walking the artist list forwards and back with cursors."""
+        new_artists(30)
+
+        response = self.app.get('/artist')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Artist 00', response_text)
+        self.assertIn('Artist 23', response_text)
+        self.assertNotIn('Artist 24', response_text)
+        self.assertNotIn('rel="prev"', response_text)
+        next_url = re.search(r'href="([^"]+)" rel="next"', response_text)
+
+        response_text = self.app.get(
+            html.unescape(next_url.group(1))).get_data(as_text=True)
+        self.assertIn('Artist 24', response_text)
+        self.assertIn('Artist 29', response_text)
+        self.assertNotIn('Artist 23', response_text)
+        self.assertNotIn('rel="next"', response_text)
+        prev_url = re.search(r'href="([^"]+)" rel="prev"', response_text)
+
+        response_text = self.app.get(
+            html.unescape(prev_url.group(1))).get_data(as_text=True)
+        self.assertIn('Artist 00', response_text)
+        self.assertIn('Artist 23', response_text)
+        self.assertNotIn('Artist 24', response_text)
+
+    def test_pagination_rejects_bad_cursor(self):
+        response = self.app.get('/concert?after=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_detail_pages_query_count(self):
+        """Test that detail pages run a fixed number of queries."""
+        new_concert()
+        create_user()
+        user = User.query.get(1)
+        concert = Concert.query.get(1)
+        user.attending.append(concert)
+        user.favourites.append(concert.artist_playing)
+        db.session.commit()
+
+        # validators + artist + concerts + fans + similar
+        with count_queries() as statements:
+            response = self.app.get('/artist/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('laurel1', response.get_data(as_text=True))
+        self.assertEqual(len(statements), 5)
+
+        # validators + concert joined with artist + guests
+        with count_queries() as statements:
+            response = self.app.get('/concert/1')
+        self.assertIn('laurel1', response.get_data(as_text=True))
+        self.assertEqual(len(statements), 3)
+
+        # validators + user + favourites + attending + suggestions
+        with count_queries() as statements:
+            response = self.app.get('/profile/laurel1')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Funfest', response_text)
+        self.assertIn('Band', response_text)
+        self.assertEqual(len(statements), 5)
+
+    def test_artist_detail_caps_fans(self):
+        """Test that a long fan list is truncated and counted in SQL."""
+        new_concert()
+        artist = Artist.query.get(1)
+        for i in range(60):
+            artist.fans.append(User(username=f'fan{i:02d}', password='x'))
+        db.session.commit()
+
+        with count_queries() as statements:
+            response = self.app.get('/artist/1')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('fan49', response_text)
+        self.assertNotIn('fan50', response_text)
+        self.assertIn('and 10 more', response_text)
+        self.assertEqual(len(statements), 6)
+
+    def test_artist_and_profile_cap_lists(self):
+        """Test that concert and favourite lists are upcoming and capped."""
+        new_concert()
+        create_user()
+        user = User.query.filter_by(username='laurel1').one()
+        artist = Artist.query.get(1)
+        concerts = [Concert(name=f'Gig {i:02d}', price=10, venue='Hall',
+                            address='1 Road', artist_playing=artist,
+                            date=date.today() + timedelta(days=i))
+                    for i in range(-1, 60)]
+        user.attending.extend(concerts)
+        user.favourites.extend(Artist(name=f'Act {i:02d}', hometown='x',
+                                      genre='x', biography='x')
+                               for i in range(55))
+        db.session.commit()
+
+        response_text = self.app.get('/artist/1').get_data(as_text=True)
+        self.assertNotIn('Gig -1', response_text)
+        self.assertIn('Gig 00', response_text)
+        self.assertNotIn('Gig 49', response_text)
+        # Funfest, in 30 days, is among the 61 upcoming
+        self.assertIn('and 11 more', response_text)
+
+        response_text = self.app.get('/profile/laurel1').get_data(
+            as_text=True)
+        self.assertNotIn('Gig -1', response_text)
+        self.assertIn('Gig 48', response_text)
+        self.assertIn('and 10 more', response_text)
+        self.assertIn('Act 49', response_text)
+        self.assertNotIn('Act 50', response_text)
+        self.assertIn('and 5 more', response_text)
+
+    def test_missing_artist_is_404(self):
+        response = self.app.get('/artist/99')
+        self.assertEqual(response.status_code, 404)
+
+    def test_server_timing_header(self):
+        """Test that responses report their SQL totals."""
+        new_concert()
+        response = self.app.get('/concert/1')
+        server_timing = response.headers['Server-Timing']
+        self.assertIn('desc="3 queries"', server_timing)
+        self.assertIn('db-slowest;dur=', server_timing)
+
+    def test_slow_query_log(self):
+        """Test that queries over the threshold are logged with the endpoint."""
+        new_concert()
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        try:
+            with self.assertLogs('concert_app.sql.slow') as logs:
+                self.app.get('/concert/1')
+        finally:
+            app.config['SLOW_QUERY_THRESHOLD_MS'] = 100
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('"endpoint": "main.concert_detail"', logs.output[0])
+
+    def test_streamed_statements_are_counted(self):
+        """Test that statements run while a body streams are logged."""
+        new_concert()
+        with self.assertLogs('concert_app.sql', logging.INFO) as logs, \
+                count_queries() as statements:
+            response = self.app.get('/api/v1/concerts.ndjson')
+            self.assertTrue(response.is_streamed)
+            self.assertIn('"id": 1', response.get_data(as_text=True))
+            response.close()
+        before_body = int(re.search(
+            r'"(\d+) queries"', response.headers['Server-Timing']).group(1))
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['endpoint'], 'api.export_concerts')
+        self.assertEqual(line['queries'], len(statements))
+        self.assertGreater(line['queries'], before_body)
+
+    def test_failed_statement_leaves_no_timer(self):
+        """Test that a statement that raises is not left on the timer stack."""
+        connection = db.session.connection()
+        with self.assertRaises(Exception):
+            db.session.execute('SELECT * FROM no_such_table')
+        self.assertEqual(connection.info['query_start'], [])
+        db.session.rollback()
+
+    def test_attend_twice_keeps_one_row(self):
+        """Test that attending inserts if absent and is never duplicated."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        self.app.post('/attending/1')
+        with count_queries() as statements:
+            response = self.app.post('/attending/1', follow_redirects=True)
+        self.assertIn('You are already attending this concert.',
+                      response.get_data(as_text=True))
+        self.assertIn("Can't Attend", response.get_data(as_text=True))
+        self.assertTrue(any('ON CONFLICT DO NOTHING' in statement
+                            for statement in statements))
+        self.assertEqual(
+            db.session.query(user_concert).filter_by(concert_id=1).count(), 1)
+
+    def test_membership_changes_only_when_rows_change(self):
+        """Test that a lost race or a repeated removal changes nothing."""
+        new_concert()
+        create_user()
+        user = User.query.get(1)
+        # As if another request added them between check and insert
+        user.favourite(1)
+        user.attend(1)
+        db.session.commit()
+        self.assertFalse(user.favourite(1))
+        self.assertFalse(user.attend(1))
+        db.session.commit()
+        self.assertEqual(Artist.query.get(1).fan_count, 1)
+        self.assertEqual(Concert.query.get(1).attendee_count, 1)
+
+        self.assertTrue(user.unfavourite(1))
+        self.assertTrue(user.unattend(1))
+        db.session.commit()
+        stamps = [model.query.get(1).updated_at
+                  for model in (User, Artist, Concert)]
+        self.assertFalse(user.unfavourite(1))
+        self.assertFalse(user.unattend(1))
+        db.session.commit()
+        self.assertEqual([model.query.get(1).updated_at
+                          for model in (User, Artist, Concert)], stamps)
+        self.assertEqual(Artist.query.get(1).fan_count, 0)
+        self.assertEqual(db.session.query(activity_event).count(), 4)
+
+    def test_favourite_and_unfavourite(self):
+        """Test adding and removing a favourite artist."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        response = self.app.post('/favourite/1', follow_redirects=True)
+        self.assertIn('Unfavourite', response.get_data(as_text=True))
+        self.assertEqual(
+            db.session.query(user_artist).filter_by(artist_id=1).count(), 1)
+
+        self.app.post('/unfavourite/1')
+        self.assertEqual(
+            db.session.query(user_artist).filter_by(artist_id=1).count(), 0)
+
+    def test_counters_follow_attendance_and_favourites(self):
+        """Test that fan and attendee counts change with their rows."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/favourite/1')
+        self.app.post('/attending/1')
+        self.app.post('/attending/1')
+        self.assertEqual(Artist.query.get(1).fan_count, 1)
+        self.assertEqual(Concert.query.get(1).attendee_count, 1)
+
+        self.app.post('/unfavourite/1')
+        self.app.post('/unattend/1')
+        self.assertEqual(Artist.query.get(1).fan_count, 0)
+        self.assertEqual(Concert.query.get(1).attendee_count, 0)
+
+    def test_popular_sort(self):
+        """Test that lists sort by counters, most popular first."""
+        new_catalogue(artists=30, concerts_per_artist=1, users=60)
+        self.app.get('/artist?sort=popular')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['counters', 'reconcile'])
+        self.assertIn('Repaired 30 artist counts', result.output)
+
+        expected = [name for name, in db.session.query(Artist.name)
+                    .order_by(Artist.fan_count.desc(), Artist.id.desc())]
+        names = []
+        url = '/artist?sort=popular'
+        while url:
+            response_text = self.app.get(url).get_data(as_text=True)
+            names += re.findall(r'(Artist \d+)\s+<br />', response_text)
+            next_url = re.search(r'href="([^"]+)" rel="next"', response_text)
+            url = html.unescape(next_url.group(1)) if next_url else None
+        self.assertEqual(names, expected)
+        self.assertIn('2 fans', self.app.get('/artist?sort=popular')
+                      .get_data(as_text=True))
+
+        db.session.execute(user_concert.delete().where(
+            user_concert.c.concert_id == 2))
+        db.session.commit()
+        result = runner.invoke(args=['counters', 'reconcile'])
+        self.assertIn('Repaired 1 concert counts', result.output)
+        self.assertIn('Repaired 0 artist counts', result.output)
+        response = self.app.get('/concert?sort=popular')
+        self.assertIn('2 going', response.get_data(as_text=True))
+
+    def test_routes_do_not_scan_tables(self):
+        """Test that read routes use indexes on a large catalogue."""
+        new_catalogue(artists=500, concerts_per_artist=10, users=2000)
+        db.session.execute('ANALYZE')
+
+        urls = ['/', '/concert', '/artist', '/artist/250', '/concert/2500',
+                '/artist?sort=popular', '/concert?sort=popular',
+                '/profile/user01000', '/artist/autocomplete?q=artist 1',
+                '/concert/nearby?lat=52.5&lon=-113&km=50',
+                '/trending?window=30d', '/profile/user01000/calendar.ics']
+        with full_table_scans() as scans:
+            for url in urls:
+                response = self.app.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                next_url = re.search(r'href="([^"]+)" rel="next"',
+                                     response.get_data(as_text=True))
+                if next_url:
+                    self.app.get(html.unescape(next_url.group(1)))
+        self.assertEqual(scans, [])
+
+    def test_search(self):
+        """Test that search ranks artists and concerts by relevance."""
+        new_concert()
+        create_user()
+        db.session.add(Artist(name='Calgary Punks', hometown='Calgary',
+                              genre='Punk', biography='Loud'))
+        db.session.commit()
+
+        response_text = self.app.get('/search?q=calgary').get_data(
+            as_text=True)
+        # The artist named Calgary ranks above the one from Calgary
+        self.assertLess(response_text.index('Calgary Punks'),
+                        response_text.index('Band'))
+        self.assertIn('No concerts match', response_text)
+
+        # Prefix matches work across concert columns
+        response_text = self.app.get('/search?q=main+stre').get_data(
+            as_text=True)
+        self.assertIn('Funfest', response_text)
+
+    def test_search_index_follows_edits(self):
+        """Test that editing an artist updates the search index."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        self.app.post('/artist/1/edit', data={
+            'name': 'Renamed', 'hometown': 'Calgary', 'genre': 'Punk',
+            'biography': 'Loud'})
+        response_text = self.app.get('/search?q=renamed').get_data(
+            as_text=True)
+        self.assertIn('/artist/1', response_text)
+        response_text = self.app.get('/search?q=band').get_data(
+            as_text=True)
+        self.assertNotIn('/artist/1', response_text)
+
+    def test_anonymous_pages_are_cached(self):
+        """Test that repeat anonymous hits skip the database."""
+        new_concert()
+        create_user()
+
+        for url in ['/', '/concert', '/artist', '/concert/1', '/artist/1',
+                    '/profile/laurel1']:
+            self.assertEqual(self.app.get(url).headers['X-Cache'], 'MISS')
+            with count_queries() as statements:
+                response = self.app.get(url)
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertEqual(statements, [], url)
+
+    def test_writes_invalidate_cached_pages(self):
+        """Test that the write routes bump the versions pages depend on."""
+        new_concert()
+        create_user()
+        self.assertIn('does not have anyone attending',
+                      self.app.get('/concert/1').get_data(as_text=True))
+
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/attending/1')
+        self.app.post('/concert/1/edit', data={
+            'name': 'Funfest Two', 'price': '10', 'venue': 'The venue',
+            'address': '123 Main Street', 'date': '2099-01-01',
+            'artist_playing': 1})
+        logout(self.app)
+
+        response = self.app.get('/concert/1')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn('laurel1', response.get_data(as_text=True))
+        self.assertIn('Funfest Two',
+                      self.app.get('/').get_data(as_text=True))
+
+    def test_logged_in_lists_use_fragment_cache(self):
+        """Test that logged in users get the cached list fragment."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        self.app.get('/concert')
+        with count_queries() as statements:
+            response = self.app.get('/concert')
+        self.assertIn('Funfest', response.get_data(as_text=True))
+        self.assertFalse(any('ORDER BY concert.date' in statement
+                             for statement in statements))
+
+    def test_conditional_get(self):
+        """Test that unchanged pages are answered with 304 before rendering."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        for url in ['/', '/concert', '/artist', '/concert/1', '/artist/1',
+                    '/profile/laurel1']:
+            response = self.app.get(url)
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+            with count_queries() as statements:
+                response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.headers['ETag'], etag)
+            # Only the validators query ran; the user was cached
+            self.assertEqual(len(statements), 1, url)
+
+            response = self.app.get(url, headers={
+                'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 304, url)
+
+    def test_changes_update_validators(self):
+        """Test that attending a concert changes its ETag."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+
+        etag = self.app.get('/concert/1').headers['ETag']
+        # Follow the redirect so the flash message is consumed
+        self.app.post('/attending/1', follow_redirects=True)
+        response = self.app.get('/concert/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_cached_pages_answer_conditional_get(self):
+        """Test that anonymous cache hits also honour If-None-Match."""
+        new_concert()
+        etag = self.app.get('/concert/1').headers['ETag']
+        with count_queries() as statements:
+            response = self.app.get('/concert/1',
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(statements, [])
+
+    def test_logged_in_pages_cost_no_extra_queries(self):
+        """Test that a cached identity makes logged in pages as cheap."""
+        new_concert()
+        create_user()
+        backend, cache.backend = cache.backend, NullBackend()
+        try:
+            anonymous = {}
+            for url in ['/', '/concert/1']:
+                with count_queries() as statements:
+                    self.app.get(url)
+                anonymous[url] = len(statements)
+
+            login(self.app, 'laurel1', 'password')
+            for url in ['/', '/concert/1']:
+                self.app.get(url)
+                with count_queries() as statements:
+                    response = self.app.get(url)
+                self.assertIn('laurel1 Profile',
+                              response.get_data(as_text=True))
+                self.assertEqual(len(statements), anonymous[url], url)
+        finally:
+            cache.backend = backend
+
+    def test_cached_identity_follows_changes(self):
+        """Test that attending drops the cached identity."""
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+        response = self.app.get('/concert/1')
+        self.assertIn('Attend this Concert', response.get_data(as_text=True))
+
+        self.app.post('/attending/1', follow_redirects=True)
+        response = self.app.get('/concert/1')
+        self.assertIn("Can't Attend", response.get_data(as_text=True))
+        self.assertEqual(
+            identities.get(1).updated_at,
+            User.query.get(1).updated_at)
+
+    def test_cached_identity_follows_other_processes(self):
+        """Test that a change made elsewhere is seen on the next request."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'cache.sqlite')
+        backend, cache.backend = cache.backend, SQLiteBackend(path, 100)
+        self.addCleanup(setattr, cache, 'backend', backend)
+        new_concert()
+        create_user()
+        login(self.app, 'laurel1', 'password')
+        response = self.app.get('/artist/1')
+        self.assertIn('Favourite', response.get_data(as_text=True))
+        with count_queries() as statements:
+            self.app.get('/')
+        self.assertFalse(any('user.username' in statement
+                             for statement in statements))
+
+        # As another worker would, with its own connection to the cache
+        with db.engine.begin() as conn:
+            conn.execute(user_artist.insert().values(user_id=1, artist_id=1))
+        SQLiteBackend(path, 100).bump('user:1')
+        response = self.app.get('/artist/1')
+        self.assertIn('Unfavourite', response.get_data(as_text=True))
+
+
+class ReplicaTests(unittest.TestCase):
+    """Read replica routing, with two SQLite files as primary and replica."""
+
+    def setUp(self):
+        # Requests here must not share the test's app context (and with
+        # it the session and its routing), so it's only held for setup
+        self.context = app.app_context()
+        self.context.push()
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {name: app.config[name] for name in
+                       ['SQLALCHEMY_BINDS', 'REPLICA_BINDS',
+                        'READ_YOUR_WRITES_SECONDS']}
+        primary = os.path.join(self.tmpdir, 'primary.db')
+        replica = os.path.join(self.tmpdir, 'replica.db')
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{primary}'
+        app.config['SQLALCHEMY_BINDS'] = {'replica1': f'sqlite:///{replica}'}
+        app.config['REPLICA_BINDS'] = ['replica1']
+        self.app = app.test_client()
+        db.create_all()
+        cache.clear()
+        identities.clear()
+        self.backend, cache.backend = cache.backend, NullBackend()
+
+        new_concert()
+        create_user()
+        # The replica starts as a copy of the primary...
+        source, target = sqlite3.connect(primary), sqlite3.connect(replica)
+        source.backup(target)
+        source.close()
+        target.close()
+        # ...then falls behind it
+        db.session.execute(Concert.__table__.update().values(
+            name='Funfest Reloaded'))
+        db.session.commit()
+        self.context.pop()
+
+    def tearDown(self):
+        cache.backend = self.backend
+        with app.app_context():
+            db.get_engine(app, 'replica1').dispose()
+            db.engine.dispose()
+        app.config.update(self.config)
+        shutil.rmtree(self.tmpdir)
+
+    def test_safe_reads_use_replica(self):
+        response = self.app.get('/concert/1')
+        self.assertIn('Funfest', response.get_data(as_text=True))
+        self.assertNotIn('Funfest Reloaded', response.get_data(as_text=True))
+        response = self.app.get('/api/v1/concerts')
+        self.assertEqual(response.get_json()['items'][0]['name'], 'Funfest')
+
+    def test_writes_use_primary(self):
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/attending/1')
+        with app.app_context():
+            primary = db.session.execute('SELECT count(*) FROM user_concert')
+            self.assertEqual(primary.scalar(), 1)
+            replica = db.get_engine(app, 'replica1').execute(
+                'SELECT count(*) FROM user_concert')
+            self.assertEqual(replica.scalar(), 0)
+
+    def test_textual_writes_use_primary(self):
+        """Test that a lone INSERT ... ON CONFLICT isn't sent to a replica."""
+        with app.test_request_context('/'):
+            use_replica()
+            self.assertTrue(models._insert_row(
+                user_artist, user_id=1, artist_id=1))
+            db.session.commit()
+            db.session.remove()
+        with app.app_context():
+            primary = db.session.execute('SELECT count(*) FROM user_artist')
+            self.assertEqual(primary.scalar(), 1)
+            replica = db.get_engine(app, 'replica1').execute(
+                'SELECT count(*) FROM user_artist')
+            self.assertEqual(replica.scalar(), 0)
+
+    def test_read_your_writes(self):
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/attending/1', follow_redirects=True)
+        # Right after their own write the visitor reads from the primary
+        response = self.app.get('/concert/1')
+        self.assertIn('Funfest Reloaded', response.get_data(as_text=True))
+
+        # Once the window has passed they're back on the replica
+        with self.app.session_transaction() as session:
+            session[PRIMARY_UNTIL] = time.time() - 1
+        response = self.app.get('/concert/1')
+        self.assertNotIn('Funfest Reloaded', response.get_data(as_text=True))
+
+    def test_pages_cached_after_a_bump_come_from_primary(self):
+        """Test that a lagging replica isn't cached under new versions."""
+        cache.backend = MemoryBackend(max_entries=100)
+        # As the request that renamed the concert would have
+        cache.bump('concerts')
+        for _ in range(2):
+            response = self.app.get('/concert/1')
+            self.assertIn('Funfest Reloaded', response.get_data(as_text=True))
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+        # Long after a bump, misses are read from the replica again
+        app.config['READ_YOUR_WRITES_SECONDS'] = 0
+        cache.bump('artists')
+        response = self.app.get('/concert/1')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertNotIn('Funfest Reloaded', response.get_data(as_text=True))
+
+
+class RecommendationTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        identities.clear()
+        new_catalogue(artists=12, concerts_per_artist=1, users=30)
+        db.session.execute(user_artist.delete())
+        db.session.commit()
+
+    def favourite(self, user_id, artist_id):
+        db.session.execute(user_artist.insert().values(
+            user_id=user_id, artist_id=artist_id))
+        recommendations.favourite_added(user_id, artist_id)
+
+    def unfavourite(self, user_id, artist_id):
+        db.session.execute(user_artist.delete().where(
+            (user_artist.c.user_id == user_id)
+            & (user_artist.c.artist_id == artist_id)))
+        recommendations.favourite_removed(user_id, artist_id)
+
+    def matrix(self):
+        return sorted(tuple(row) for row in db.session.execute(
+            artist_cooccurrence.select()))
+
+    def test_incremental_updates_match_rebuild(self):
+        """Test that favourite by favourite gives the rebuilt matrix."""
+        random = Random(16)
+        favourites = set()
+        for _ in range(300):
+            pair = (random.randint(1, 30), random.randint(1, 12))
+            if pair in favourites:
+                favourites.remove(pair)
+                self.unfavourite(*pair)
+            else:
+                favourites.add(pair)
+                self.favourite(*pair)
+        db.session.commit()
+        incremental = self.matrix()
+
+        result = app.test_cli_runner().invoke(
+            args=['recommendations', 'rebuild'])
+        self.assertIn('Rebuilt', result.output)
+        self.assertEqual(self.matrix(), incremental)
+        counts = db.session.execute(
+            'SELECT artist_id, count(*) FROM artist_neighbour '
+            'GROUP BY artist_id').fetchall()
+        self.assertTrue(counts)
+        self.assertTrue(all(count <= recommendations.NEIGHBOURS
+                            for _, count in counts))
+
+    def test_heavy_users_match_rebuild(self):
+        """Test that crossing MAX_USER_FAVOURITES counts as rebuild does."""
+        self.addCleanup(setattr, recommendations, 'MAX_USER_FAVOURITES',
+                        recommendations.MAX_USER_FAVOURITES)
+        recommendations.MAX_USER_FAVOURITES = 3
+        self.test_incremental_updates_match_rebuild()
+        favourites = db.session.execute(
+            'SELECT count(*) FROM user_artist GROUP BY user_id').fetchall()
+        self.assertTrue(any(count > 3 for count, in favourites))
+
+    def test_rescore_without_fan_count(self):
+        """Test that a pair without its diagonal cells is still scored."""
+        db.session.execute(artist_cooccurrence.insert().values(
+            artist_id=1, other_id=2, together=1))
+        recommendations._rescore([1], [2])
+        self.assertEqual(recommendations.similar_artists(1),
+                         [Artist.query.get(2)])
+
+    def test_neighbour_changes_revalidate_pages(self):
+        """Test that other fans' favourites change the ETags."""
+        self.favourite(1, 1)
+        db.session.commit()
+        artist_etag = self.app.get('/artist/2').headers['ETag']
+        profile_etag = self.app.get('/profile/user00001').headers['ETag']
+
+        self.favourite(2, 1)
+        self.favourite(2, 2)
+        db.session.commit()
+        cache.bump('favourites')
+        response = self.app.get('/artist/2')
+        self.assertNotEqual(response.headers['ETag'], artist_etag)
+        self.assertIn('Artist 00001', response.get_data(as_text=True))
+        response = self.app.get('/profile/user00001')
+        self.assertNotEqual(response.headers['ETag'], profile_etag)
+        self.assertIn('Artist 00002', response.get_data(as_text=True))
+
+        artist_etag = self.app.get('/artist/2').headers['ETag']
+        app.test_cli_runner().invoke(args=['recommendations', 'rebuild'])
+        self.assertNotEqual(self.app.get('/artist/2').headers['ETag'],
+                            artist_etag)
+
+    def test_fans_also_like(self):
+        """Test the detail page and profile suggestions."""
+        for user_id in (1, 2):
+            self.favourite(user_id, 1)
+            self.favourite(user_id, 2)
+        self.favourite(2, 3)
+        self.favourite(3, 1)
+        db.session.commit()
+
+        self.assertEqual(recommendations.similar_artists(1),
+                         [Artist.query.get(2), Artist.query.get(3)])
+        response = self.app.get('/artist/1')
+        self.assertIn('Fans also like', response.get_data(as_text=True))
+        self.assertIn('Artist 00002', response.get_data(as_text=True))
+
+        response = self.app.get('/profile/user00003')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('You might also like', response_text)
+        self.assertIn('Artist 00002', response_text)
+
+    def test_favourite_route_updates_neighbours(self):
+        """Test that the favourite routes keep the neighbours current."""
+        create_user()
+        self.favourite(1, 1)
+        db.session.commit()
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/favourite/1')
+        self.app.post('/favourite/2')
+        self.assertEqual(recommendations.similar_artists(2),
+                         [Artist.query.get(1)])
+
+        self.app.post('/unfavourite/2')
+        self.assertEqual(recommendations.similar_artists(2), [])
+        self.assertNotIn((2, 2, 1), self.matrix())
+
+
+class TrendingTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app = app.test_client()
+        self.runner = app.test_cli_runner()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        identities.clear()
+        new_catalogue(artists=12, concerts_per_artist=1, users=30)
+
+    def log(self, subject, subject_id, change=1, age=timedelta(0), id=None):
+        db.session.execute(activity_event.insert().values(
+            id=id, user_id=1, subject=subject, subject_id=subject_id,
+            change=change, created_at=datetime.utcnow() - age))
+
+    def buckets(self):
+        # Buckets whose events cancel out may be kept at 0 or skipped
+        return sorted(tuple(row) for row in db.session.execute(
+            activity_bucket.select().where(activity_bucket.c.score != 0)))
+
+    def test_routes_log_activity(self):
+        """Test that attending and favouriting trend once aggregated."""
+        create_user()
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/favourite/3')
+        self.app.post('/attending/5')
+        self.app.post('/attending/6')
+        self.app.post('/unattend/6')
+        for user_id in (1, 2):
+            User.query.get(user_id).favourite(4)
+        db.session.commit()
+        self.assertEqual(db.session.query(activity_event).count(), 6)
+        self.assertEqual(trending.trending_artists('24h'), [])
+
+        result = self.runner.invoke(args=['trending', 'aggregate'])
+        self.assertIn('Aggregated 6 events', result.output)
+        self.assertEqual(trending.trending_artists('24h'),
+                         [(Artist.query.get(4), 2), (Artist.query.get(3), 1)])
+        self.assertEqual(trending.trending_concerts('7d'),
+                         [(Concert.query.get(5), 1)])
+
+        with count_queries() as statements:
+            response = self.app.get('/trending?window=24h')
+        self.assertIn('Artist 00004', response.get_data(as_text=True))
+        self.assertIn('2 new fans', response.get_data(as_text=True))
+        self.assertFalse([statement for statement in statements
+                          if 'activity_event' in statement])
+
+        result = self.runner.invoke(args=['trending', 'aggregate'])
+        self.assertIn('Aggregated 0 events', result.output)
+
+    def test_windows(self):
+        """Test that each window sums only its own buckets."""
+        self.log('artist', 1, age=timedelta(hours=1))
+        self.log('artist', 2, age=timedelta(days=3))
+        self.log('artist', 3, age=timedelta(days=20))
+        self.log('artist', 4, age=timedelta(days=45))
+        db.session.commit()
+        trending.aggregate(db.engine)
+
+        def ids(window):
+            return [artist.id for artist, _
+                    in trending.trending_artists(window)]
+        self.assertEqual(ids('24h'), [1])
+        self.assertEqual(ids('7d'), [1, 2])
+        self.assertEqual(ids('30d'), [1, 2, 3])
+        # Folded events past their retention are pruned
+        self.assertEqual(db.session.query(activity_event).count(), 3)
+
+    def test_late_commits_are_folded(self):
+        """Test that an event committed behind a folded one still counts."""
+        # On PostgreSQL a lower id can commit after a higher one is folded
+        self.log('artist', 1, id=100)
+        db.session.commit()
+        self.assertEqual(trending.aggregate(db.engine), 1)
+        self.log('artist', 2, id=50)
+        self.log('artist', 2, id=51)
+        db.session.commit()
+        self.assertEqual(trending.aggregate(db.engine), 2)
+        self.assertEqual(
+            [(artist.id, score)
+             for artist, score in trending.trending_artists('24h')],
+            [(2, 2), (1, 1)])
+
+    def test_aggregation_resumes_after_failure(self):
+        """Test that a failed batch is redone and nothing counts twice."""
+        random = Random(21)
+        for _ in range(50):
+            self.log(random.choice(['artist', 'concert']),
+                     random.randint(1, 12), random.choice([1, 1, -1]),
+                     timedelta(hours=random.randint(0, 72)))
+        db.session.commit()
+
+        with self.assertRaises(ZeroDivisionError):
+            with db.engine.begin() as conn:
+                trending.aggregate_batch(conn, batch_size=7)
+                1 / 0
+        self.assertEqual(self.buckets(), [])
+        with db.engine.begin() as conn:
+            self.assertEqual(trending.aggregate_batch(conn, 7), 7)
+        self.assertEqual(trending.aggregate(db.engine, batch_size=7), 43)
+        self.assertEqual(trending.aggregate(db.engine), 0)
+        in_batches = self.buckets()
+
+        db.session.execute(activity_bucket.delete())
+        db.session.execute(activity_event.update().values(folded_at=None))
+        db.session.commit()
+        self.assertEqual(trending.aggregate(db.engine), 50)
+        self.assertEqual(self.buckets(), in_batches)
+
+
+    def test_overlap_is_retried_on_the_next_tick(self):
+        """Test that --every keeps running when another job overlaps."""
+        self.log('artist', 1)
+        db.session.commit()
+        aggregate, calls, ticks = trending.aggregate, [], []
+
+        class Stop(Exception):
+            pass
+
+        def overlapping(engine, batch_size):
+            calls.append(batch_size)
+            if len(calls) == 1:
+                raise trending.AggregationOverlap('Another job is folding.')
+            return aggregate(engine, batch_size)
+
+        def sleep(seconds):
+            ticks.append(seconds)
+            if len(ticks) == 2:
+                raise Stop()
+        self.addCleanup(setattr, trending, 'aggregate', aggregate)
+        self.addCleanup(setattr, trending, 'time', trending.time)
+        trending.aggregate = overlapping
+        trending.time = types.SimpleNamespace(
+            perf_counter=time.perf_counter, sleep=sleep)
+
+        result = self.runner.invoke(
+            args=['trending', 'aggregate', '--every', '5'])
+        self.assertIsInstance(result.exception, Stop)
+        self.assertIn('Another job is folding. Trying again in 5s.',
+                      result.output)
+        self.assertIn('Aggregated 1 events', result.output)
+        self.assertEqual(ticks, [5, 5])
+
+
+class NotificationTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app = app.test_client()
+        self.runner = app.test_cli_runner()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        identities.clear()
+        # Users 2, 14 and 26 are fans of artist 3
+        new_catalogue(artists=12, concerts_per_artist=1, users=30)
+        create_user()
+        login(self.app, 'laurel1', 'password')
+        self.app.post('/favourite/3')
+
+    def announce(self):
+        self.app.post('/new_concert', data={
+            'name': 'Basement Dweller',
+            'price': '25',
+            'venue': 'Mikeys',
+            'address': '123 Street',
+            'date': '2023-01-12',
+            'artist_playing': 3
+        })
+        return Concert.query.filter_by(name='Basement Dweller').one().id
+
+    def notified(self):
+        return sorted(row.user_id for row in
+                      db.session.execute(notification.select()))
+
+    def test_new_concert_queues_fan_out(self):
+        """Test that fans are notified by the worker, not the request."""
+        with count_queries() as statements:
+            concert_id = self.announce()
+        self.assertFalse([statement for statement in statements
+                          if 'notification' in statement
+                          and 'count' not in statement])
+        self.assertEqual(db.session.query(job).count(), 1)
+        self.assertEqual(self.notified(), [])
+
+        result = self.runner.invoke(
+            args=['jobs', 'work', '--once', '--threads', '1'])
+        self.assertIn('Worked for', result.output)
+        self.assertEqual(self.notified(), [2, 14, 26, 31])
+        self.assertEqual(
+            db.session.query(notification).filter_by(
+                concert_id=concert_id).count(), 4)
+        result = self.runner.invoke(args=['jobs', 'status'])
+        self.assertIn('0 queued, 0 running, 0 failed', result.output)
+
+    def test_fan_out_is_idempotent(self):
+        """Test that a job run again, in any batch size, adds nothing."""
+        concert_id = self.announce()
+        with count_queries() as statements:
+            self.assertEqual(notifications.notify_fans(concert_id, 3), 4)
+        # One INSERT ... SELECT per batch, not a row list sent per fan
+        inserts = [statement for statement in statements
+                   if statement.startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertTrue(all('SELECT' in statement for statement in inserts))
+        self.assertEqual(notifications.notify_fans(concert_id, 2), 4)
+        self.assertEqual(self.notified(), [2, 14, 26, 31])
+
+    def test_failed_jobs_are_retried(self):
+        """Test that a failing job backs off and gives up at MAX_ATTEMPTS."""
+        calls = []
+
+        @jobs.handler('flaky')
+        def flaky(fail_times):
+            calls.append(fail_times)
+            if len(calls) <= fail_times:
+                raise RuntimeError('flaky')
+        self.addCleanup(jobs.HANDLERS.pop, 'flaky')
+
+        jobs.enqueue('flaky', fail_times=1)
+        db.session.commit()
+        with self.assertLogs('concert_app.jobs', 'ERROR'):
+            self.assertTrue(jobs.run_next('test'))
+        row = db.session.execute(job.select()).first()
+        self.assertIsNone(row.finished_at)
+        self.assertEqual(row.attempts, 1)
+        self.assertIn('flaky', row.error)
+        # Not due again until the backoff has passed
+        self.assertFalse(jobs.run_next('test'))
+
+        db.session.execute(job.update().values(run_at=datetime.utcnow()))
+        db.session.commit()
+        self.assertTrue(jobs.run_next('test'))
+        row = db.session.execute(job.select()).first()
+        self.assertIsNotNone(row.finished_at)
+        self.assertIsNone(row.error)
+
+        db.session.execute(job.delete())
+        jobs.enqueue('flaky', fail_times=100)
+        db.session.commit()
+        for _ in range(jobs.MAX_ATTEMPTS):
+            db.session.execute(job.update().values(run_at=datetime.utcnow()))
+            db.session.commit()
+            with self.assertLogs('concert_app.jobs', 'ERROR'):
+                self.assertTrue(jobs.run_next('test'))
+        row = db.session.execute(job.select()).first()
+        self.assertEqual(row.attempts, jobs.MAX_ATTEMPTS)
+        self.assertIsNotNone(row.finished_at)
+        result = self.runner.invoke(args=['jobs', 'status'])
+        self.assertIn('0 queued, 0 running, 1 failed', result.output)
+
+    def test_unknown_job_kind_fails_at_once(self):
+        """Test that a job nothing can handle is not retried."""
+        jobs.enqueue('no-such-kind')
+        db.session.commit()
+        with self.assertLogs('concert_app.jobs', 'ERROR'):
+            self.assertTrue(jobs.run_next('test'))
+        row = db.session.execute(job.select()).first()
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNotNone(row.finished_at)
+        self.assertIn('no-such-kind', row.error)
+
+    def test_unread_count(self):
+        """Test that the nav shows unread notifications until read."""
+        concert_id = self.announce()
+        self.assertNotIn('Notifications (',
+                         self.app.get('/').get_data(as_text=True))
+        self.runner.invoke(args=['jobs', 'work', '--once'])
+
+        response = self.app.get('/notifications')
+        self.assertIn('Notifications (1)', response.get_data(as_text=True))
+        self.assertIn(f'/concert/{concert_id}',
+                      response.get_data(as_text=True))
+
+        self.app.post('/notifications/read')
+        response = self.app.get('/notifications')
+        self.assertNotIn('Notifications (', response.get_data(as_text=True))
+        self.assertIn('Basement Dweller', response.get_data(as_text=True))
+
+        db.session.execute(Concert.__table__.insert(), [
+            dict(name=f'Encore {c}', price=10, venue='The venue',
+                 address='123 Main Street', artist_id=3, date=date.today())
+            for c in range(150)])
+        db.session.execute(notification.insert().from_select(
+            ['user_id', 'concert_id', 'created_at'],
+            db.select([db.literal(31), Concert.id, db.func.now()])
+            .where(Concert.name.like('Encore %'))))
+        db.session.commit()
+        identities.clear()
+        self.assertIn('Notifications (99+)',
+                      self.app.get('/').get_data(as_text=True))
+
+
+class ImportTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.runner = app.test_cli_runner()
+        self.tmpdir = tempfile.mkdtemp()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_import_artists_csv(self):
+        path = self.write('artists.csv', (
+            'name,hometown,genre,biography,image\n'
+            'Band,Calgary,Punk,Punk band from Calgary,\n'
+            'Other Band,Edmonton,Rock,Rock band,\n'
+            'X,Nowhere,Rock,Name is too short,\n'))
+        result = self.runner.invoke(
+            args=['import', 'artists', path, '--batch-size', '1'])
+        self.assertIn('2 inserted, 0 updated, 1 invalid', result.output)
+        self.assertEqual(Artist.query.count(), 2)
+
+        # Importing again updates in place
+        result = self.runner.invoke(args=['import', 'artists', path])
+        self.assertIn('0 inserted, 2 updated', result.output)
+        self.assertEqual(Artist.query.count(), 2)
+
+    def test_import_concerts_json(self):
+        db.session.add(Artist(name='Band', hometown='Calgary', genre='Punk',
+                              biography='Punk band from Calgary'))
+        db.session.commit()
+        concerts = [dict(name=f'Show {i}', price=10, venue='The venue',
+                         address='123 Main Street', date='2099-01-0%d' % i,
+                         artist='Band') for i in range(1, 6)]
+        concerts.append(dict(concerts[0], artist='Nobody'))
+        path = self.write('concerts.json', json.dumps(concerts, indent=2))
+
+        result = self.runner.invoke(
+            args=['import', 'concerts', path, '--dry-run'])
+        self.assertIn('Would import concerts: 5 inserted', result.output)
+        self.assertEqual(Concert.query.count(), 0)
+
+        result = self.runner.invoke(args=['import', 'concerts', path])
+        self.assertIn('5 inserted, 0 updated, 1 invalid', result.output)
+        self.assertIn('rows/s', result.output)
+        self.assertEqual(Concert.query.get(5).artist_playing.name, 'Band')
+        self.assertIsNone(Concert.query.get(5).geohash)
+
+        lines = '\n'.join(json.dumps(dict(c, price=20, latitude=51.0447,
+                                           longitude=-114.0719))
+                          for c in concerts[:2])
+        path = self.write('concerts.ndjson', lines)
+        result = self.runner.invoke(args=['import', 'concerts', path])
+        self.assertIn('0 inserted, 2 updated', result.output)
+        self.assertEqual(Concert.query.get(1).price, 20)
+        self.assertEqual(Concert.query.get(1).geohash, 'c3nfkhrku')
+
+    def test_read_json_across_chunks(self):
+        from concert_app import importer
+        items = [{'name': 'x' * 50, 'n': i} for i in range(100)]
+        path = self.write('big.json', json.dumps(items))
+        chunk, importer.JSON_CHUNK = importer.JSON_CHUNK, 64
+        try:
+            self.assertEqual(list(importer.read_json(path)), items)
+        finally:
+            importer.JSON_CHUNK = chunk
+
+
+class SeedTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.runner = app.test_cli_runner()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+
+    def test_seed(self):
+        """Test that seeding is repeatable and skewed towards a few rows."""
+        args = ['seed', '--artists', '50', '--concerts', '500',
+                '--users', '300']
+        result = self.runner.invoke(args=args)
+        self.assertIn('Done', result.output)
+        self.assertEqual(Concert.query.count(), 500)
+        fans = [count for count, in db.session.query(func.count())
+                .select_from(user_artist).group_by(user_artist.c.artist_id)
+                .order_by(func.count().desc())]
+        self.assertGreater(fans[0], 5 * fans[len(fans) // 2])
+        self.assertTrue(Concert.query.filter(Concert.geohash.isnot(None))
+                        .count())
+        self.assertTrue(trending.trending_artists('30d'))
+        first = [tuple(row) for row in db.session.query(user_concert)]
+
+        result = self.runner.invoke(args=args)
+        self.assertIn('already has data', result.output)
+        db.drop_all()
+        db.create_all()
+        self.runner.invoke(args=args)
+        self.assertEqual([tuple(row) for row in db.session.query(user_concert)],
+                         first)
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def backends(self):
+        return [MemoryBackend(max_entries=3),
+                SQLiteBackend(os.path.join(self.tmpdir, 'cache.sqlite'),
+                              max_entries=3)]
+
+    def test_lru_eviction(self):
+        for backend in self.backends():
+            backend.EVICT_EVERY = 1
+            for key in 'abc':
+                backend.set(key, key.upper(), ttl=60)
+            # Touch 'a' so 'b' is the least recently used entry
+            time.sleep(0.01)
+            backend.TOUCH_INTERVAL = 0
+            self.assertEqual(backend.get('a'), 'A')
+            backend.set('d', 'D', ttl=60)
+            self.assertIsNone(backend.get('b'), backend)
+            self.assertEqual(backend.get('a'), 'A')
+            self.assertEqual(backend.get('d'), 'D')
+
+    def test_ttl_expiry(self):
+        for backend in self.backends():
+            backend.set('a', 'A', ttl=-1)
+            self.assertIsNone(backend.get('a'))
+
+    def test_versions(self):
+        for backend in self.backends():
+            self.assertEqual(backend.version('concerts'), 0)
+            backend.bump('concerts')
+            backend.bump('concerts')
+            self.assertEqual(backend.version('concerts'), 2)
+
+    def test_memory_bumps_outside_requests_warn(self):
+        """Test that commands bumping a per-process cache are warned once."""
+        local = Cache()
+        local.backend = MemoryBackend(max_entries=3)
+        with app.test_request_context('/'):
+            with self.assertNoLogs('concert_app.cache'):
+                local.bump('concerts')
+        with self.assertLogs('concert_app.cache', 'WARNING') as logs:
+            local.bump('artists', 'concerts')
+        self.assertIn('web workers will not see that artists, concerts',
+                      logs.output[0])
+        with self.assertNoLogs('concert_app.cache'):
+            local.bump('trending')
+
+        shared = Cache()
+        shared.backend = self.backends()[1]
+        with self.assertNoLogs('concert_app.cache'):
+            shared.bump('concerts')
+
+
+@contextmanager
+def stub_origin(files):
+    # Serves `files` ({path: bytes, or a URL to redirect to}) over HTTP on
+    # localhost; yields the base URL and the list of paths requested
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            body = files.get(self.path)
+            if isinstance(body, str):
+                self.send_response(302)
+                self.send_header('Location', body)
+                self.end_headers()
+                return
+            self.send_response(200 if body else 404)
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}', requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def png(width, height):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'purple').save(output, 'PNG')
+    return output.getvalue()
+
+
+class ImageTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        path, max_bytes = image_cache.path, image_cache.max_bytes
+        networks = image_cache.allowed_networks
+        image_cache.path = self.tmpdir
+        # The stub origin runs on loopback
+        image_cache.allowed_networks = [ipaddress.ip_network('127.0.0.1/32')]
+        self.addCleanup(setattr, image_cache, 'path', path)
+        self.addCleanup(setattr, image_cache, 'max_bytes', max_bytes)
+        self.addCleanup(setattr, image_cache, 'allowed_networks', networks)
+
+    def image_urls(self, url):
+        response_text = self.app.get(url).get_data(as_text=True)
+        return [html.unescape(src) for src in
+                re.findall(r'(?:src|srcset)="(/image/[^"]+)"', response_text)]
+
+    def test_thumbnails(self):
+        """Test that pages link to resized, cached copies of images."""
+        with stub_origin({'/band.png': png(1200, 800)}) as (origin, requested):
+            new_artists(1)
+            Artist.query.get(1).image = origin + '/band.png'
+            db.session.commit()
+
+            webp, jpeg = self.image_urls('/artist')
+            response = self.app.get(webp)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/webp')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size,
+                             (375, 250))
+            response = self.app.get(jpeg)
+            self.assertEqual(response.mimetype, 'image/jpeg')
+            self.assertEqual(self.app.get(
+                jpeg, headers={'If-None-Match': response.headers['ETag']}
+            ).status_code, 304)
+
+            webp, jpeg = self.image_urls('/artist/1')
+            response = self.app.get(jpeg)
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size,
+                             (400, 267))
+            # Fetched from the origin only once for every size and format
+            self.assertEqual(requested, ['/band.png'])
+
+    def test_same_image_is_stored_once(self):
+        """Test that two URLs of the same image share their files."""
+        image = png(300, 300)
+        with stub_origin({'/a.png': image, '/b.png': image}) as (origin, _):
+            paths = [image_cache.thumbnail(origin + name, 'card', 'jpg')
+                     for name in ['/a.png', '/b.png']]
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.tmpdir, 'sources'))), 1)
+
+    def test_rejects_unsigned_and_broken_images(self):
+        """Test that only signed URLs are fetched and failures are 502s."""
+        with stub_origin({'/notes.txt': b'not an image'}) as (origin, requested):
+            with app.test_request_context():
+                url = thumbnail_url(origin + '/notes.txt', 'card')
+                missing = thumbnail_url(origin + '/missing.png', 'card')
+            self.assertEqual(self.app.get(url.replace('notes', 'other'))
+                             .status_code, 404)
+            self.assertEqual(self.app.get(url.replace('card', 'huge'))
+                             .status_code, 404)
+            self.assertEqual(requested, [])
+            self.assertEqual(self.app.get(url).status_code, 502)
+            self.assertEqual(self.app.get(missing).status_code, 502)
+
+    def test_refuses_private_addresses(self):
+        """Test that only public hosts are fetched, redirects included."""
+        image_cache.allowed_networks = []
+        for url in ['http://169.254.169.254/latest/meta-data',
+                    'http://localhost:5432/', 'http://10.0.0.1/a.png',
+                    'http://[::1]/a.png', 'file:///etc/passwd',
+                    'http://127.0.0.1:99999/']:
+            with self.assertRaises(ImageError, msg=url):
+                image_cache.fetch(url)
+
+        image_cache.allowed_networks = [ipaddress.ip_network('127.0.0.1/32')]
+        with stub_origin({'/band.png': png(10, 10),
+                          '/moved.png': '/band.png',
+                          '/metadata.png': 'http://169.254.169.254/',
+                          '/loop.png': '/loop.png'}) as (origin, requested):
+            self.assertEqual(image_cache.fetch(origin + '/moved.png'),
+                             png(10, 10))
+            with self.assertRaises(ImageError):
+                image_cache.fetch(origin + '/metadata.png')
+            with self.assertRaises(ImageError):
+                image_cache.fetch(origin + '/loop.png')
+            self.assertEqual(requested.count('/loop.png'),
+                             images.MAX_REDIRECTS + 1)
+
+    def test_eviction(self):
+        """Test that the least recently used files go when over the limit."""
+        image_cache.max_bytes = 2500
+        for name in ['a', 'b', 'c']:
+            image_cache._write(image_cache._file('sources', name * 64),
+                               b'x' * 1000)
+            time.sleep(0.01)
+        image_cache._read(image_cache._file('sources', 'a' * 64))
+        result = app.test_cli_runner().invoke(args=['images', 'evict'])
+        self.assertIn('Evicted 1 files, 2000 bytes left', result.output)
+        left = [name for _, _, names in os.walk(self.tmpdir)
+                for name in names]
+        self.assertEqual(sorted(left), ['a' * 64, 'c' * 64])
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app = app.test_client()
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        new_artists(30)
+
+    def test_gzips_pages(self):
+        """Test that long pages are gzipped and still answer 304s."""
+        plain = self.app.get('/artist')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        response = self.app.get('/artist', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(int(response.headers['Content-Length']),
+                         len(response.data))
+        etag = response.headers['ETag']
+        self.assertEqual(etag, plain.headers['ETag'][:-1] + '-gzip"')
+
+        response = self.app.get('/artist', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_skips_small_and_head_responses(self):
+        """Test that short responses and HEAD requests are left alone."""
+        response = self.app.get('/artist/autocomplete?q=nothing',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_json(), {'artists': []})
+        response = self.app.head('/artist',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_gzips_streams(self):
+        """Test that streamed exports are compressed as they stream."""
+        response = self.app.get('/api/v1/artists.ndjson',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 30)
+
+
+class AssetTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        static_folder = app.static_folder
+        app.static_folder = os.path.join(self.tmpdir, 'static')
+        shutil.copytree(static_folder, app.static_folder,
+                        ignore=shutil.ignore_patterns(assets.DIST))
+        self.addCleanup(assets.load_manifest, app)
+        self.addCleanup(setattr, app, 'static_folder', static_folder)
+
+    def static_url(self, filename):
+        with app.test_request_context():
+            return url_for('static', filename=filename)
+
+    def test_build(self):
+        """Test fingerprinted URLs, caching and precompressed copies."""
+        self.assertEqual(self.static_url('style.css'), '/static/style.css')
+        result = app.test_cli_runner().invoke(args=['assets', 'build'])
+        self.assertIn('style.css -> dist/style.', result.output)
+
+        url = self.static_url('style.css')
+        self.assertRegex(url, r'^/static/dist/style\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+            original = f.read()
+
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        self.assertEqual(brotli.decompress(response.data), original)
+        response.close()
+
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), original)
+        response.close()
+
+        response = self.app.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, original)
+        response.close()
+
+
+class FactoryTests(unittest.TestCase):
+
+    def test_create_app_runs_no_sql(self):
+        """Test that building an app leaves the database alone."""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            started = time.perf_counter()
+            other = create_app()
+            elapsed = time.perf_counter() - started
+        finally:
+            event.remove(Engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(statements, [])
+        self.assertLess(elapsed, 1)
+        self.assertIsNot(other, app)
+        self.assertEqual(set(other.blueprints),
+                         {'main', 'auth', 'api', 'images'})
+
+    def test_apps_share_one_slow_query_handler(self):
+        """Test that each app with the same SLOW_QUERY_LOG logs lines once."""
+        path = os.path.join(tempfile.mkdtemp(), 'slow.log')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        slow_logger = logging.getLogger('concert_app.sql.slow')
+        handlers = list(slow_logger.handlers)
+
+        def restore():
+            for handler in slow_logger.handlers[len(handlers):]:
+                handler.close()
+            slow_logger.handlers[:] = handlers
+        self.addCleanup(restore)
+
+        class SlowLogConfig(Config):
+            SLOW_QUERY_LOG = path
+        for _ in range(2):
+            create_app(SlowLogConfig)
+        slow_logger.warning('slow')
+        with open(path) as log:
+            self.assertEqual(log.read().count('slow'), 1)
+
+
+    def test_request_lines_reach_query_log(self):
+        """Test that QUERY_LOG gets one JSON line per request."""
+        path = os.path.join(tempfile.mkdtemp(), 'queries.log')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        query_logger = logging.getLogger('concert_app.sql')
+        handlers = list(query_logger.handlers)
+
+        def restore():
+            for handler in query_logger.handlers[len(handlers):]:
+                handler.close()
+            query_logger.handlers[:] = handlers
+        self.addCleanup(restore)
+
+        class QueryLogConfig(Config):
+            QUERY_LOG = path
+        other = create_app(QueryLogConfig)
+        other.test_client().get('/no-such-page').close()
+        with open(path) as log:
+            self.assertIn('"status": 404', log.read())
+
+
+class DatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_engine_options_from_environment(self):
+        os.environ.update(DB_POOL_SIZE='10', DB_MAX_OVERFLOW='5',
+                          DB_STATEMENT_TIMEOUT_MS='2000')
+        options = database.engine_options('postgresql://localhost/concerts')
+        self.assertEqual(options['pool_size'], 10)
+        self.assertEqual(options['max_overflow'], 5)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=2000'})
+
+        # SQLite's pools don't take sizes
+        options = database.engine_options('sqlite:///concerts.db')
+        self.assertNotIn('pool_size', options)
+
+    def test_sqlite_connections_use_wal(self):
+        engine = create_engine(
+            f'sqlite:///{os.path.join(self.tmpdir, "wal.db")}')
+        try:
+            self.assertEqual(
+                engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                engine.execute('PRAGMA busy_timeout').scalar(),
+                app.config['SQLITE_BUSY_TIMEOUT_MS'])
+        finally:
+            engine.dispose()
+
+        memory = create_engine('sqlite://')
+        self.assertEqual(
+            memory.execute('PRAGMA journal_mode').scalar(), 'memory')
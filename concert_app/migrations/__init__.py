@@ -0,0 +1,102 @@
+"""Versioned schema migrations.
+
+Each migration is a module in this package named `v<NNNN>_<summary>` that
+defines `upgrade(conn)`. Migrations must be safe to run against a schema
+that `db.create_all()` has already brought up to date, so they check before
+they change anything (`IF NOT EXISTS`, inspecting existing columns, ...).
+
+Applied versions are recorded in the `schema_migrations` table. Run them with:
+
+    flask db upgrade
+"""
+import importlib
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select
+
+# Every migration, oldest first
+MIGRATIONS = [
+    'v0001_hot_query_indexes',
+    'v0002_full_text_search',
+    'v0003_updated_at',
+    'v0004_username_lower',
+    'v0005_artist_name_lower',
+    'v0006_recommendations',
+    'v0007_concert_location',
+    'v0008_popularity_counters',
+    'v0009_activity',
+    'v0010_notifications',
+    'v0011_activity_folded',
+    'v0012_artist_similar_changed_at',
+    'v0013_user_attending_changed_at',
+]
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', String(80), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def applied_versions(engine):
+    """Return the set of migration versions already applied to `engine`."""
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(
+            select([schema_migrations.c.version]))}
+
+
+def pending_versions(engine):
+    """Return the migrations not yet applied to `engine`, oldest first."""
+    applied = applied_versions(engine)
+    return [version for version in MIGRATIONS if version not in applied]
+
+
+def upgrade(engine):
+    """Apply every pending migration to `engine`, each in its own transaction.
+
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    for version in pending_versions(engine):
+        module = importlib.import_module(f'{__name__}.{version}')
+        with engine.begin() as conn:
+            module.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=version, applied_at=datetime.utcnow()))
+        applied.append(version)
+    return applied
+
+
+db_cli = AppGroup('db', help='Manage the database schema.')
+
+
+@db_cli.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    """Create missing tables and apply pending migrations."""
+    from concert_app.extensions import db
+
+    db.create_all()
+    applied = upgrade(db.engine)
+    for version in applied:
+        click.echo(f'Applied {version}')
+    if not applied:
+        click.echo('Database is up to date.')
+
+
+@db_cli.command('status')
+@with_appcontext
+def status_command():
+    """List migrations that have not been applied yet."""
+    from concert_app.extensions import db
+
+    pending = pending_versions(db.engine)
+    for version in pending:
+        click.echo(f'Pending {version}')
+    if not pending:
+        click.echo('Database is up to date.')
@@ -0,0 +1,122 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, inspect
+
+from concert_app import migrations
+from concert_app import models  # noqa: F401 (fills db.metadata)
+from concert_app.extensions import db
+
+"""
+Run these tests with:
+python3 -m unittest concert_app.migrations.tests
+"""
+
+# The schema as it was created before migrations existed
+LEGACY_SCHEMA = [
+    'CREATE TABLE artist (id INTEGER NOT NULL, name VARCHAR(80) NOT NULL, '
+    'hometown VARCHAR(80) NOT NULL, image TEXT, genre VARCHAR(80) NOT NULL, '
+    'biography VARCHAR(250) NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, '
+    'password VARCHAR(80) NOT NULL, PRIMARY KEY (id), UNIQUE (username))',
+    'CREATE TABLE concert (id INTEGER NOT NULL, image TEXT, '
+    'name VARCHAR(80) NOT NULL, price FLOAT NOT NULL, '
+    'venue VARCHAR(80) NOT NULL, address VARCHAR(80) NOT NULL, date DATE, '
+    'artist_id INTEGER NOT NULL, PRIMARY KEY (id), '
+    'FOREIGN KEY(artist_id) REFERENCES artist (id))',
+    'CREATE TABLE user_artist (user_id INTEGER, artist_id INTEGER, '
+    'FOREIGN KEY(user_id) REFERENCES user (id), '
+    'FOREIGN KEY(artist_id) REFERENCES artist (id))',
+    'CREATE TABLE user_concert (user_id INTEGER, concert_id INTEGER, '
+    'FOREIGN KEY(user_id) REFERENCES user (id), '
+    'FOREIGN KEY(concert_id) REFERENCES concert (id))',
+]
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'legacy.db')
+        self.engine = create_engine(f'sqlite:///{path}')
+        for statement in LEGACY_SCHEMA:
+            self.engine.execute(statement)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upgrade_legacy_database(self):
+        """Test that the first migration dedupes pairs and adds indexes."""
+        self.engine.execute('INSERT INTO user_artist VALUES (1, 1), (1, 1), '
+                            '(1, 2), (NULL, 3)')
+        self.engine.execute("INSERT INTO artist (id, name, hometown, genre, "
+                            "biography) VALUES (1, 'A', 'x', 'x', 'x'), "
+                            "(2, 'B', 'x', 'x', 'x'), (3, 'C', 'x', 'x', 'x')")
+
+        applied = migrations.upgrade(self.engine)
+        self.assertEqual(applied, migrations.MIGRATIONS)
+
+        rows = self.engine.execute(
+            'SELECT user_id, artist_id FROM user_artist ORDER BY artist_id')
+        self.assertEqual([tuple(row) for row in rows], [(1, 1), (1, 2)])
+        rows = self.engine.execute('SELECT fan_count FROM artist ORDER BY id')
+        self.assertEqual([row[0] for row in rows], [1, 1, 0])
+
+        indexes = {index['name'] for index in
+                   inspect(self.engine).get_indexes('concert')}
+        self.assertIn('ix_concert_date_id', indexes)
+        self.assertIn('ix_concert_artist_id', indexes)
+        self.assertIn('ix_concert_geohash_date', indexes)
+
+        self.assertIn('activity_bucket', inspect(self.engine).get_table_names())
+        self.assertIn('notification', inspect(self.engine).get_table_names())
+
+        with self.assertRaises(Exception):
+            self.engine.execute('INSERT INTO user_artist VALUES (1, 1)')
+
+    def test_upgrade_backfills_username_lower(self):
+        """Test that existing usernames get their lookup column filled."""
+        self.engine.execute("INSERT INTO user (id, username, password) "
+                            "VALUES (1, 'Laurel', 'x'), (2, 'ÉLODIE', 'x')")
+        migrations.upgrade(self.engine)
+
+        rows = self.engine.execute(
+            'SELECT username_lower FROM user ORDER BY id')
+        self.assertEqual([row[0] for row in rows], ['laurel', 'élodie'])
+        with self.assertRaises(Exception):
+            self.engine.execute("INSERT INTO user (username, password, "
+                                "username_lower) VALUES ('LAUREL', 'x', "
+                                "'laurel')")
+
+    def test_upgrade_matches_models(self):
+        """Test that an upgraded database has the tables of a new one."""
+        migrations.upgrade(self.engine)
+        inspector = inspect(self.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name']
+                       for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, set(table.columns.keys()), table.name)
+            indexes = {index['name']
+                       for index in inspector.get_indexes(table.name)}
+            self.assertLessEqual({index.name for index in table.indexes},
+                                 indexes, table.name)
+
+    def test_migrations_are_frozen(self):
+        """Test that no migration runs the app's current code."""
+        directory = os.path.dirname(migrations.__file__)
+        for version in migrations.MIGRATIONS:
+            with open(os.path.join(directory, f'{version}.py')) as source:
+                self.assertIsNone(re.search(
+                    r'^\s*(from|import) concert_app', source.read(), re.M),
+                    version)
+
+    def test_upgrade_is_recorded(self):
+        """Test that applied migrations are not run a second time."""
+        migrations.upgrade(self.engine)
+        self.assertEqual(migrations.pending_versions(self.engine), [])
+        self.assertEqual(migrations.upgrade(self.engine), [])
@@ -0,0 +1,47 @@
+"""Index the columns the list, detail and membership queries filter on.
+
+Also makes (user_id, <target>_id) unique in the association tables of
+databases created before they had a composite primary key, removing any
+duplicate rows first.
+"""
+from sqlalchemy import inspect
+
+INDEXES = [
+    ('ix_concert_date_id', 'concert', 'date, id'),
+    ('ix_concert_artist_id', 'concert', 'artist_id'),
+    ('ix_artist_name_id', 'artist', 'name, id'),
+    ('ix_artist_genre', 'artist', 'genre'),
+    ('ix_user_concert_concert_id', 'user_concert', 'concert_id'),
+    ('ix_user_artist_artist_id', 'user_artist', 'artist_id'),
+]
+
+ASSOCIATIONS = [
+    ('user_concert', 'concert_id'),
+    ('user_artist', 'artist_id'),
+]
+
+
+def _make_pairs_unique(conn, table, target):
+    if inspect(conn).get_pk_constraint(table)['constrained_columns']:
+        return
+
+    conn.execute(f'DELETE FROM {table} '
+                 f'WHERE user_id IS NULL OR {target} IS NULL')
+    if conn.dialect.name == 'postgresql':
+        conn.execute(f'DELETE FROM {table} a USING {table} b '
+                     f'WHERE a.ctid > b.ctid AND a.user_id = b.user_id '
+                     f'AND a.{target} = b.{target}')
+        conn.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (user_id, {target})')
+    else:
+        conn.execute(f'DELETE FROM {table} WHERE rowid NOT IN ('
+                     f'SELECT min(rowid) FROM {table} '
+                     f'GROUP BY user_id, {target})')
+        conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS uq_{table} '
+                     f'ON {table} (user_id, {target})')
+
+
+def upgrade(conn):
+    for table, target in ASSOCIATIONS:
+        _make_pairs_unique(conn, table, target)
+    for name, table, columns in INDEXES:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
@@ -0,0 +1,65 @@
+"""Add full-text search indexes over artists and concerts.
+
+The DDL is the search index as it stood when this migration was written,
+not `concert_app.search`'s current one, so running it later still does
+what it did then.
+"""
+
+SQLITE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS artist_fts USING fts5("
+    "name, genre, hometown, biography, content='artist', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS artist_fts_insert AFTER INSERT ON artist "
+    "BEGIN INSERT INTO artist_fts(rowid, name, genre, hometown, biography) "
+    "VALUES (new.id, new.name, new.genre, new.hometown, new.biography); END",
+    "CREATE TRIGGER IF NOT EXISTS artist_fts_delete AFTER DELETE ON artist "
+    "BEGIN INSERT INTO artist_fts(artist_fts, rowid, name, genre, hometown, "
+    "biography) VALUES ('delete', old.id, old.name, old.genre, "
+    "old.hometown, old.biography); END",
+    "CREATE TRIGGER IF NOT EXISTS artist_fts_update AFTER UPDATE OF "
+    "name, genre, hometown, biography ON artist "
+    "BEGIN INSERT INTO artist_fts(artist_fts, rowid, name, genre, hometown, "
+    "biography) VALUES ('delete', old.id, old.name, old.genre, "
+    "old.hometown, old.biography); "
+    "INSERT INTO artist_fts(rowid, name, genre, hometown, biography) "
+    "VALUES (new.id, new.name, new.genre, new.hometown, new.biography); END",
+    "INSERT INTO artist_fts(artist_fts) VALUES ('rebuild')",
+
+    "CREATE VIRTUAL TABLE IF NOT EXISTS concert_fts USING fts5("
+    "name, venue, address, content='concert', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS concert_fts_insert AFTER INSERT ON concert "
+    "BEGIN INSERT INTO concert_fts(rowid, name, venue, address) "
+    "VALUES (new.id, new.name, new.venue, new.address); END",
+    "CREATE TRIGGER IF NOT EXISTS concert_fts_delete AFTER DELETE ON concert "
+    "BEGIN INSERT INTO concert_fts(concert_fts, rowid, name, venue, address) "
+    "VALUES ('delete', old.id, old.name, old.venue, old.address); END",
+    "CREATE TRIGGER IF NOT EXISTS concert_fts_update AFTER UPDATE OF "
+    "name, venue, address ON concert "
+    "BEGIN INSERT INTO concert_fts(concert_fts, rowid, name, venue, address) "
+    "VALUES ('delete', old.id, old.name, old.venue, old.address); "
+    "INSERT INTO concert_fts(rowid, name, venue, address) "
+    "VALUES (new.id, new.name, new.venue, new.address); END",
+    "INSERT INTO concert_fts(concert_fts) VALUES ('rebuild')",
+]
+
+POSTGRES = [
+    "CREATE INDEX IF NOT EXISTS ix_artist_search ON artist USING GIN "
+    "(to_tsvector('english', coalesce(name, '') || ' ' || "
+    "coalesce(genre, '') || ' ' || coalesce(hometown, '') || ' ' || "
+    "coalesce(biography, '')))",
+    "CREATE INDEX IF NOT EXISTS ix_concert_search ON concert USING GIN "
+    "(to_tsvector('english', coalesce(name, '') || ' ' || "
+    "coalesce(venue, '') || ' ' || coalesce(address, '')))",
+]
+
+
+def upgrade(conn):
+    if conn.dialect.name == 'sqlite':
+        statements = SQLITE
+    elif conn.dialect.name == 'postgresql':
+        statements = POSTGRES
+    else:
+        statements = []
+    for statement in statements:
+        conn.execute(statement)
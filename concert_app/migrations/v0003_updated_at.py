@@ -0,0 +1,19 @@
+"""Track when artists, concerts and users were last modified."""
+from sqlalchemy import inspect
+
+TABLES = ['artist', 'concert', 'user']
+
+
+def upgrade(conn):
+    quote = conn.dialect.identifier_preparer.quote
+    for table in TABLES:
+        columns = {column['name'] for column in inspect(conn).get_columns(table)}
+        if 'updated_at' not in columns:
+            column_type = ('TIMESTAMP' if conn.dialect.name == 'postgresql'
+                           else 'DATETIME')
+            conn.execute(f'ALTER TABLE {quote(table)} '
+                         f'ADD COLUMN updated_at {column_type}')
+            conn.execute(f'UPDATE {quote(table)} '
+                         f'SET updated_at = CURRENT_TIMESTAMP')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_updated_at '
+                     f'ON {quote(table)} (updated_at)')
@@ -0,0 +1,32 @@
+"""Add the case-normalised `user.username_lower` lookup column."""
+from collections import defaultdict
+
+from sqlalchemy import inspect, text
+
+
+def upgrade(conn):
+    quote = conn.dialect.identifier_preparer.quote
+    user = quote('user')
+    columns = {column['name'] for column in inspect(conn).get_columns('user')}
+    if 'username_lower' not in columns:
+        conn.execute(f'ALTER TABLE {user} ADD COLUMN username_lower VARCHAR(80)')
+
+    # Lower-cased in Python: SQLite's lower() only folds ASCII
+    rows = conn.execute(f'SELECT id, username FROM {user} '
+                        f'WHERE username_lower IS NULL').fetchall()
+    by_name = defaultdict(list)
+    for (username,) in conn.execute(f'SELECT username FROM {user}'):
+        by_name[username.lower()].append(username)
+    clashes = sorted(names for names in by_name.values() if len(names) > 1)
+    if clashes:
+        raise RuntimeError(
+            'Usernames differ only by case, rename all but one of each: '
+            + '; '.join(', '.join(names) for names in clashes))
+
+    if rows:
+        conn.execute(text(f'UPDATE {user} SET username_lower = :lower '
+                          f'WHERE id = :id'),
+                     [{'lower': username.lower(), 'id': id}
+                      for id, username in rows])
+    conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_username_lower '
+                 f'ON {user} (username_lower)')
@@ -0,0 +1,18 @@
+"""Add `artist.name_lower` and its index for prefix searches."""
+from sqlalchemy import inspect, text
+
+
+def upgrade(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('artist')}
+    if 'name_lower' not in columns:
+        conn.execute('ALTER TABLE artist ADD COLUMN name_lower VARCHAR(80)')
+
+    # Lower-cased in Python: SQLite's lower() only folds ASCII
+    rows = conn.execute('SELECT id, name FROM artist '
+                        'WHERE name_lower IS NULL').fetchall()
+    if rows:
+        conn.execute(text('UPDATE artist SET name_lower = :lower '
+                          'WHERE id = :id'),
+                     [{'lower': name.lower(), 'id': id} for id, name in rows])
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_artist_name_lower_id '
+                 'ON artist (name_lower, id)')
@@ -0,0 +1,62 @@
+"""Create and fill the "Fans also like" tables.
+
+The tables and the rebuild are copied here as they stood when this
+migration was written, so later changes to the models or to
+`concert_app.recommendations` don't change what it does.
+"""
+from sqlalchemy import Column, Float, ForeignKey, Integer, MetaData, Table
+
+metadata = MetaData()
+
+# Only referenced by the foreign key, never created here
+Table('artist', metadata, Column('id', Integer, primary_key=True))
+
+artist_cooccurrence = Table(
+    'artist_cooccurrence', metadata,
+    Column('artist_id', Integer, primary_key=True, autoincrement=False),
+    Column('other_id', Integer, primary_key=True, autoincrement=False),
+    Column('together', Integer, nullable=False),
+)
+
+artist_neighbour = Table(
+    'artist_neighbour', metadata,
+    Column('artist_id', Integer, primary_key=True, autoincrement=False),
+    Column('neighbour_id', Integer, ForeignKey('artist.id'),
+           primary_key=True, autoincrement=False),
+    Column('score', Float, nullable=False),
+)
+
+REBUILD = [
+    'DELETE FROM artist_neighbour',
+    'DELETE FROM artist_cooccurrence',
+    'INSERT INTO artist_cooccurrence (artist_id, other_id, together) '
+    'SELECT artist_id, artist_id, count(*) FROM user_artist '
+    'WHERE user_id IS NOT NULL GROUP BY artist_id',
+    'INSERT INTO artist_cooccurrence (artist_id, other_id, together) '
+    'SELECT a.artist_id, b.artist_id, count(*) '
+    'FROM user_artist a JOIN user_artist b ON b.user_id = a.user_id '
+    'WHERE a.artist_id != b.artist_id AND a.user_id IN ('
+    ' SELECT user_id FROM user_artist GROUP BY user_id '
+    ' HAVING count(*) <= 200) '
+    'GROUP BY a.artist_id, b.artist_id',
+    'INSERT INTO artist_neighbour (artist_id, neighbour_id, score) '
+    'SELECT artist_id, other_id, score FROM ('
+    ' SELECT artist_id, other_id, score, row_number() OVER ('
+    '  PARTITION BY artist_id ORDER BY score DESC, other_id) AS neighbour_rank '
+    ' FROM (SELECT c.artist_id, c.other_id, '
+    '   c.together * 1.0 / (a.together + b.together - c.together) AS score '
+    '  FROM artist_cooccurrence c '
+    '  JOIN artist_cooccurrence a '
+    '   ON a.artist_id = c.artist_id AND a.other_id = c.artist_id '
+    '  JOIN artist_cooccurrence b '
+    '   ON b.artist_id = c.other_id AND b.other_id = c.other_id '
+    '  WHERE c.artist_id != c.other_id) scored'
+    ') ranked WHERE neighbour_rank <= 10',
+]
+
+
+def upgrade(conn):
+    artist_cooccurrence.create(conn, checkfirst=True)
+    artist_neighbour.create(conn, checkfirst=True)
+    for statement in REBUILD:
+        conn.execute(statement)
@@ -0,0 +1,49 @@
+"""Add optional concert coordinates and the geohash index for nearby search.
+
+Existing coordinates are hashed with a copy of the encoder as it stood when
+this migration was written (9 characters), not `concert_app.geo`'s.
+"""
+from sqlalchemy import inspect, text
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+PRECISION = 9
+
+
+def encode(lat, lon):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < PRECISION:
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def upgrade(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('concert')}
+    for name, type_ in [('latitude', 'FLOAT'), ('longitude', 'FLOAT'),
+                        ('geohash', 'VARCHAR(12)')]:
+        if name not in columns:
+            conn.execute(f'ALTER TABLE concert ADD COLUMN {name} {type_}')
+
+    rows = conn.execute('SELECT id, latitude, longitude FROM concert '
+                        'WHERE geohash IS NULL AND latitude IS NOT NULL '
+                        'AND longitude IS NOT NULL').fetchall()
+    if rows:
+        conn.execute(text('UPDATE concert SET geohash = :geohash '
+                          'WHERE id = :id'),
+                     [{'geohash': encode(latitude, longitude), 'id': id}
+                      for id, latitude, longitude in rows])
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_concert_geohash_date '
+                 'ON concert (geohash, date)')
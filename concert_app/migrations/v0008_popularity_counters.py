@@ -0,0 +1,27 @@
+"""Add `artist.fan_count` / `concert.attendee_count`, filled and indexed."""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+# (table, counter column, index, join table, join table column)
+COUNTERS = [
+    ('artist', 'fan_count', 'ix_artist_fan_count_id',
+     'user_artist', 'artist_id'),
+    ('concert', 'attendee_count', 'ix_concert_attendee_count_id',
+     'user_concert', 'concert_id'),
+]
+
+
+def upgrade(conn):
+    for table, column, index, rows, key in COUNTERS:
+        columns = {c['name'] for c in inspect(conn).get_columns(table)}
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} '
+                         f'INTEGER NOT NULL DEFAULT 0')
+        counted = (f'(SELECT count(*) FROM {rows} '
+                   f'WHERE {rows}.{key} = {table}.id)')
+        conn.execute(text(f'UPDATE {table} SET {column} = {counted}, '
+                          f'updated_at = :now WHERE {column} != {counted}'),
+                     now=datetime.utcnow())
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index} '
+                     f'ON {table} ({column}, id)')
@@ -0,0 +1,36 @@
+"""Create the activity log and the trending buckets."""
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+
+# As the tables stood when this migration was written
+metadata = MetaData()
+
+activity_event = Table(
+    'activity_event', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('subject', String(16), nullable=False),
+    Column('subject_id', Integer, nullable=False),
+    Column('change', Integer, nullable=False),
+    Column('created_at', DateTime, nullable=False, index=True),
+)
+
+activity_bucket = Table(
+    'activity_bucket', metadata,
+    Column('subject', String(16), primary_key=True),
+    Column('period', String(8), primary_key=True),
+    Column('starts', DateTime, primary_key=True),
+    Column('subject_id', Integer, primary_key=True, autoincrement=False),
+    Column('score', Integer, nullable=False),
+)
+
+activity_watermark = Table(
+    'activity_watermark', metadata,
+    Column('name', String(40), primary_key=True),
+    Column('event_id', Integer, nullable=False),
+)
+
+
+def upgrade(conn):
+    activity_event.create(conn, checkfirst=True)
+    activity_bucket.create(conn, checkfirst=True)
+    activity_watermark.create(conn, checkfirst=True)
@@ -0,0 +1,45 @@
+"""Create the background job queue and the notification inbox."""
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table,
+    Text, UniqueConstraint, text)
+
+# As the tables stood when this migration was written
+metadata = MetaData()
+
+# Only referenced by foreign keys, never created here
+Table('user', metadata, Column('id', Integer, primary_key=True))
+Table('concert', metadata, Column('id', Integer, primary_key=True))
+
+job = Table(
+    'job', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('kind', String(40), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('run_at', DateTime, nullable=False),
+    Column('locked_by', String(80)),
+    Column('locked_until', DateTime),
+    Column('finished_at', DateTime),
+    Column('error', Text),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_job_finished_at_run_at', 'finished_at', 'run_at'),
+)
+
+notification = Table(
+    'notification', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+    Column('concert_id', Integer, ForeignKey('concert.id'), nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('read_at', DateTime),
+    UniqueConstraint('user_id', 'concert_id',
+                     name='uq_notification_user_id_concert_id'),
+    Index('ix_notification_unread', 'user_id', 'id',
+          sqlite_where=text('read_at IS NULL'),
+          postgresql_where=text('read_at IS NULL')),
+)
+
+
+def upgrade(conn):
+    job.create(conn, checkfirst=True)
+    notification.create(conn, checkfirst=True)
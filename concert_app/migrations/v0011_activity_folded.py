@@ -0,0 +1,25 @@
+"""Mark folded activity events instead of keeping a high water mark.
+
+Events up to the old `activity_watermark` are stamped as folded, and the
+watermark table is dropped.
+"""
+from sqlalchemy import inspect
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    columns = {c['name'] for c in inspector.get_columns('activity_event')}
+    if 'folded_at' not in columns:
+        column_type = ('TIMESTAMP' if conn.dialect.name == 'postgresql'
+                       else 'DATETIME')
+        conn.execute(f'ALTER TABLE activity_event '
+                     f'ADD COLUMN folded_at {column_type}')
+
+    if 'activity_watermark' in inspector.get_table_names():
+        conn.execute('UPDATE activity_event SET folded_at = created_at '
+                     'WHERE folded_at IS NULL AND id <= ('
+                     ' SELECT event_id FROM activity_watermark '
+                     " WHERE name = 'trending')")
+        conn.execute('DROP TABLE activity_watermark')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_activity_event_unfolded '
+                 'ON activity_event (id) WHERE folded_at IS NULL')
@@ -0,0 +1,11 @@
+"""Add `artist.similar_changed_at`, the version of its "Fans also like"."""
+from sqlalchemy import inspect
+
+
+def upgrade(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('artist')}
+    if 'similar_changed_at' not in columns:
+        column_type = ('TIMESTAMP' if conn.dialect.name == 'postgresql'
+                       else 'DATETIME')
+        conn.execute(f'ALTER TABLE artist '
+                     f'ADD COLUMN similar_changed_at {column_type}')
@@ -0,0 +1,13 @@
+"""Add `user.attending_changed_at`, the version of the user's calendar feed."""
+from sqlalchemy import inspect
+
+
+def upgrade(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns('user')}
+    if 'attending_changed_at' not in columns:
+        column_type = ('TIMESTAMP' if conn.dialect.name == 'postgresql'
+                       else 'DATETIME')
+        conn.execute(f'ALTER TABLE "user" '
+                     f'ADD COLUMN attending_changed_at {column_type}')
+        # Every feed gets a validator; this is the closest stamp there is
+        conn.execute('UPDATE "user" SET attending_changed_at = updated_at')
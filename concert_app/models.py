@@ -1,19 +1,63 @@
+from datetime import datetime
+from sqlalchemy import and_, exists, func, select, text
+from sqlalchemy.orm import validates
 from sqlalchemy_utils import URLType
 from flask_login import UserMixin
+from concert_app import geo
 from concert_app.extensions import db
 
+
+def _lowercase_of(column):
+    """Column default holding `column` in lower case."""
+    def default(context):
+        return context.get_current_parameters()[column].lower()
+    return default
+
+# Unread notifications are counted up to this many ("99+")
+UNREAD_MAX = 100
+
+
+def location_geohash(latitude, longitude):
+    """Return the geohash stored for a location, or None without one."""
+    if latitude is None or longitude is None:
+        return None
+    return geo.encode(latitude, longitude)
+
+
 class Artist(db.Model):
     """Artist model."""
+    __table_args__ = (
+        db.Index('ix_artist_name_id', 'name', 'id'),
+        # Prefix searches for the artist autocomplete
+        db.Index('ix_artist_name_lower_id', 'name_lower', 'id'),
+        # "Most popular" artist lists
+        db.Index('ix_artist_fan_count_id', 'fan_count', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
+    name_lower = db.Column(db.String(80), nullable=False,
+                           default=_lowercase_of('name'))
     hometown = db.Column(db.String(80), nullable=False)
     image = db.Column(URLType)
-    genre = db.Column(db.String(80), nullable=False)
+    genre = db.Column(db.String(80), nullable=False, index=True)
     biography = db.Column(db.String(250), nullable=False)
+    # Rows in user_artist for this artist, kept up to date by Membership
+    # (repair drift with `flask counters reconcile`)
+    fan_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    # When the "Fans also like" list last changed, see recommendations.py
+    similar_changed_at = db.Column(db.DateTime)
     upcoming_concerts = db.relationship('Concert', back_populates='artist_playing')
     fans = db.relationship(
         'User', secondary='user_artist', back_populates='favourites')
 
+    @validates('name')
+    def _set_name_lower(self, key, name):
+        self.name_lower = name.lower() if name is not None else None
+        return name
+
     def __str__(self):
         return f'{self.name}'
 
@@ -22,6 +66,14 @@ class Artist(db.Model):
 
 class Concert(db.Model):
     """Concert model."""
+    __table_args__ = (
+        db.Index('ix_concert_date_id', 'date', 'id'),
+        # Cell range scans for concerts near a point
+        db.Index('ix_concert_geohash_date', 'geohash', 'date'),
+        # "Most popular" concert lists
+        db.Index('ix_concert_attendee_count_id', 'attendee_count', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     image = db.Column(URLType)
     name = db.Column(db.String(80), nullable=False)
@@ -29,23 +81,123 @@ class Concert(db.Model):
     venue = db.Column(db.String(80), nullable=False)
     address = db.Column(db.String(80), nullable=False)
     date = db.Column(db.Date)
+    # Optional location; geohash is derived from it (see concert_app.geo)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12))
+    # Rows in user_concert for this concert, kept up to date by Membership
+    attendee_count = db.Column(db.Integer, nullable=False, default=0)
     artist_id = db.Column(
-        db.Integer, db.ForeignKey('artist.id'), nullable=False)
+        db.Integer, db.ForeignKey('artist.id'), nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
     artist_playing = db.relationship('Artist', back_populates='upcoming_concerts')
     guests_attending = db.relationship(
         'User', secondary='user_concert', back_populates='attending')
 
+    @validates('latitude', 'longitude')
+    def _set_geohash(self, key, value):
+        latitude = value if key == 'latitude' else self.latitude
+        longitude = value if key == 'longitude' else self.longitude
+        self.geohash = location_geohash(latitude, longitude)
+        return value
+
     def __str__(self):
         return f'{self.name}'
 
     def __repr__(self):
         return f'{self.name}'
 
-class User(UserMixin, db.Model):
+class Membership(object):
+    """Attending and favourites for anything with the `id` of a user."""
+
+    def is_attending(self, concert_id):
+        """Return True if the user is attending the given concert."""
+        return _has_row(user_concert, user_id=self.id, concert_id=concert_id)
+
+    def attend(self, concert_id):
+        """Add the concert to the user's attending list.
+
+        Returns False if it was already there.
+        """
+        if not _insert_row(user_concert, user_id=self.id,
+                           concert_id=concert_id):
+            return False
+        touch(Concert, concert_id, attendee_count=Concert.attendee_count + 1)
+        touch(User, self.id, attending_changed_at=datetime.utcnow())
+        record_activity(self.id, 'concert', concert_id, 1)
+        return True
+
+    def unattend(self, concert_id):
+        """Remove the concert from the user's attending list.
+
+        Returns False if it wasn't there.
+        """
+        removed = db.session.execute(user_concert.delete().where(and_(
+            user_concert.c.user_id == self.id,
+            user_concert.c.concert_id == concert_id))).rowcount
+        if not removed:
+            return False
+        touch(Concert, concert_id,
+              attendee_count=Concert.attendee_count - removed)
+        touch(User, self.id, attending_changed_at=datetime.utcnow())
+        record_activity(self.id, 'concert', concert_id, -removed)
+        return True
+
+    def is_favourite(self, artist_id):
+        """Return True if the artist is in the user's favourites."""
+        return _has_row(user_artist, user_id=self.id, artist_id=artist_id)
+
+    def favourite(self, artist_id):
+        """Add the artist to the user's favourites.
+
+        Returns False if it was already there.
+        """
+        if not _insert_row(user_artist, user_id=self.id, artist_id=artist_id):
+            return False
+        touch(Artist, artist_id, fan_count=Artist.fan_count + 1)
+        touch(User, self.id)
+        record_activity(self.id, 'artist', artist_id, 1)
+        return True
+
+    def unfavourite(self, artist_id):
+        """Remove the artist from the user's favourites.
+
+        Returns False if it wasn't there.
+        """
+        removed = db.session.execute(user_artist.delete().where(and_(
+            user_artist.c.user_id == self.id,
+            user_artist.c.artist_id == artist_id))).rowcount
+        if not removed:
+            return False
+        touch(Artist, artist_id, fan_count=Artist.fan_count - removed)
+        touch(User, self.id)
+        record_activity(self.id, 'artist', artist_id, -removed)
+        return True
+
+    def unread_count(self):
+        """Return the user's unread notifications, counting to UNREAD_MAX."""
+        unread = (select([notification.c.id])
+                  .where(notification.c.user_id == self.id)
+                  .where(notification.c.read_at.is_(None))
+                  .limit(UNREAD_MAX).alias())
+        return db.session.execute(
+            select([func.count()]).select_from(unread)).scalar()
+
+
+class User(Membership, UserMixin, db.Model):
     """User model."""
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False, unique=True)
+    # Lookups go through this column so 'Laurel' and 'laurel' are one user
+    username_lower = db.Column(db.String(80), nullable=False, unique=True,
+                               index=True, default=_lowercase_of('username'))
     password = db.Column(db.String(80), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    # When a concert was last added to or removed from the attending list,
+    # which is all the calendar feed depends on besides the concerts
+    attending_changed_at = db.Column(db.DateTime)
     attending = db.relationship(
         'Concert', secondary='user_concert', back_populates='guests_attending')
     favourites = db.relationship(
@@ -58,12 +210,144 @@ class User(UserMixin, db.Model):
         return f'{self.username}'
 
 user_concert = db.Table('user_concert',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('concert_id', db.Integer, db.ForeignKey('concert.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('concert_id', db.Integer, db.ForeignKey('concert.id'),
+              primary_key=True, index=True)
 )
 
 user_artist = db.Table('user_artist',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'),
+              primary_key=True, index=True)
 )
 
+# Sparse artist x artist matrix of shared fans, one row per non-zero cell.
+# The diagonal (artist_id == other_id) holds each artist's fan count.
+artist_cooccurrence = db.Table('artist_cooccurrence',
+    db.Column('artist_id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('other_id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('together', db.Integer, nullable=False)
+)
+
+# The most similar artists to each artist, see recommendations.py
+artist_neighbour = db.Table('artist_neighbour',
+    db.Column('artist_id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('neighbour_id', db.Integer, db.ForeignKey('artist.id'),
+              primary_key=True, autoincrement=False),
+    db.Column('score', db.Float, nullable=False)
+)
+
+# Append-only log of attends and favourites (change +1) and their undoing
+# (-1), folded into activity_bucket by `flask trending aggregate`
+activity_event = db.Table('activity_event',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, nullable=False),
+    # 'concert' or 'artist'
+    db.Column('subject', db.String(16), nullable=False),
+    db.Column('subject_id', db.Integer, nullable=False),
+    db.Column('change', db.Integer, nullable=False),
+    db.Column('created_at', db.DateTime, nullable=False, index=True),
+    # Set when the event is counted in activity_bucket
+    db.Column('folded_at', db.DateTime),
+    # The aggregation job reads only the events it hasn't folded yet
+    db.Index('ix_activity_event_unfolded', 'id',
+             sqlite_where=db.text('folded_at IS NULL'),
+             postgresql_where=db.text('folded_at IS NULL'))
+)
+
+# Net activity per subject per hour or day, see trending.py
+activity_bucket = db.Table('activity_bucket',
+    db.Column('subject', db.String(16), primary_key=True),
+    # 'hour' or 'day'
+    db.Column('period', db.String(8), primary_key=True),
+    db.Column('starts', db.DateTime, primary_key=True),
+    db.Column('subject_id', db.Integer, primary_key=True,
+              autoincrement=False),
+    db.Column('score', db.Integer, nullable=False)
+)
+
+# A user's inbox: one row per concert announced by an artist they favourite,
+# written in batches by the notify_fans job (see notifications.py)
+notification = db.Table('notification',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              nullable=False),
+    db.Column('concert_id', db.Integer, db.ForeignKey('concert.id'),
+              nullable=False),
+    db.Column('created_at', db.DateTime, nullable=False),
+    db.Column('read_at', db.DateTime),
+    # Fan-out retries insert the same rows again and are ignored
+    db.UniqueConstraint('user_id', 'concert_id',
+                        name='uq_notification_user_id_concert_id'),
+    # Unread counts only read the unread rows of one user
+    db.Index('ix_notification_unread', 'user_id', 'id',
+             sqlite_where=db.text('read_at IS NULL'),
+             postgresql_where=db.text('read_at IS NULL'))
+)
+
+# Background jobs, see jobs.py
+job = db.Table('job',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('kind', db.String(40), nullable=False),
+    # JSON keyword arguments of the handler
+    db.Column('payload', db.Text, nullable=False),
+    db.Column('attempts', db.Integer, nullable=False, default=0),
+    db.Column('run_at', db.DateTime, nullable=False),
+    db.Column('locked_by', db.String(80)),
+    db.Column('locked_until', db.DateTime),
+    db.Column('finished_at', db.DateTime),
+    db.Column('error', db.Text),
+    db.Column('created_at', db.DateTime, nullable=False),
+    # Workers look for unfinished jobs that are due
+    db.Index('ix_job_finished_at_run_at', 'finished_at', 'run_at')
+)
+
+
+def _has_row(table, **values):
+    """Run a single EXISTS query for a row of `table` matching `values`."""
+    condition = and_(*[table.c[name] == value
+                       for name, value in values.items()])
+    return db.session.query(exists().where(condition)).scalar()
+
+
+def _insert_row(table, **values):
+    """Insert a row of `table` unless its key is taken; True if inserted.
+
+    Concurrent inserts of the same row don't fail with an IntegrityError,
+    only one of them inserts it.
+    """
+    columns = ', '.join(values)
+    params = ', '.join(f':{name}' for name in values)
+    return db.session.execute(text(
+        f'INSERT INTO {table.name} ({columns}) VALUES ({params}) '
+        'ON CONFLICT DO NOTHING'), values).rowcount == 1
+
+
+def touch(model, id, **values):
+    """Mark the row of `model` with primary key `id` as modified now.
+
+    Any `values` (e.g. a counter increment) are set in the same UPDATE.
+    """
+    table = model.__table__
+    db.session.execute(table.update().where(table.c.id == id).values(
+        updated_at=datetime.utcnow(), **values))
+    if model is User:
+        user_changed(id)
+
+
+def record_activity(user_id, subject, subject_id, change):
+    """Log that `user_id` changed their attendance or favourite just now."""
+    db.session.execute(activity_event.insert().values(
+        user_id=user_id, subject=subject, subject_id=subject_id,
+        change=change, created_at=datetime.utcnow()))
+
+
+def user_changed(id):
+    """Note that the user `id` changes when the session commits.
+
+    Cached identities of the user are dropped after the commit, in every
+    process sharing the page cache backend (see identity.py).
+    """
+    db.session.info.setdefault('changed_users', set()).add(id)
@@ -0,0 +1,89 @@
+"""Inbox notifications for fans of an artist with a new concert.
+
+Creating a concert only queues a `notify_fans` job (see jobs.py), so the
+request costs one extra INSERT however many fans the artist has. A worker
+then walks the fans in user id order, `BATCH_SIZE` at a time: it reads a
+batch's ids, writes their inbox rows with one INSERT ... SELECT (a single
+statement on every driver, where a list of rows can mean one round trip
+per row) and commits. Rows are unique per (user, concert) and inserted
+with ON CONFLICT DO NOTHING, so a retried job skips the fans it already
+reached.
+
+Pages show the unread count from `Membership.unread_count`, which reads
+at most `UNREAD_MAX` entries of the partial unread index. Each batch marks
+its users changed, so cached identities recount.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, text
+
+from concert_app.extensions import db
+from concert_app.jobs import enqueue, handler
+from concert_app.models import (
+    Artist, Concert, notification, user_artist, user_changed)
+
+# Inbox rows written per INSERT and per transaction
+BATCH_SIZE = 5000
+
+# Notifications listed in the inbox
+INBOX_SHOWN = 50
+
+# The fans of :artist_id with ids from :first to :last
+INSERT_NOTIFICATIONS = text(
+    'INSERT INTO notification (user_id, concert_id, created_at) '
+    'SELECT user_id, :concert_id, :created_at FROM user_artist '
+    'WHERE artist_id = :artist_id AND user_id BETWEEN :first AND :last '
+    'ON CONFLICT (user_id, concert_id) DO NOTHING')
+
+
+def announce(concert_id):
+    """Queue notifications of a new concert for its artist's fans."""
+    enqueue('notify_fans', concert_id=concert_id)
+
+
+@handler('notify_fans')
+def notify_fans(concert_id, batch_size=BATCH_SIZE):
+    """Write an inbox row for every fan of the concert's artist."""
+    artist_id = db.session.execute(
+        select([Concert.artist_id]).where(Concert.id == concert_id)).scalar()
+    if artist_id is None:
+        return 0
+    now = datetime.utcnow()
+    notified = last = 0
+    while True:
+        # The ids are needed anyway, to refresh the fans' cached identities
+        batch = [row[0] for row in db.session.execute(
+            select([user_artist.c.user_id])
+            .where(user_artist.c.artist_id == artist_id)
+            .where(user_artist.c.user_id > last)
+            .order_by(user_artist.c.user_id).limit(batch_size))]
+        if not batch:
+            return notified
+        db.session.execute(INSERT_NOTIFICATIONS, dict(
+            concert_id=concert_id, created_at=now, artist_id=artist_id,
+            first=batch[0], last=batch[-1]))
+        for user_id in batch:
+            user_changed(user_id)
+        db.session.commit()
+        notified += len(batch)
+        last = batch[-1]
+
+
+def inbox(user_id, limit=INBOX_SHOWN):
+    """Return the user's latest notifications as (read_at, concert, artist)."""
+    return (db.session.query(notification.c.read_at, Concert, Artist)
+            .join(Concert, Concert.id == notification.c.concert_id)
+            .join(Artist, Artist.id == Concert.artist_id)
+            .filter(notification.c.user_id == user_id)
+            .order_by(notification.c.id.desc())
+            .limit(limit).all())
+
+
+def mark_all_read(user_id):
+    """Mark every notification of the user read."""
+    db.session.execute(notification.update()
+                       .where(notification.c.user_id == user_id)
+                       .where(notification.c.read_at.is_(None))
+                       .values(read_at=datetime.utcnow()))
+    # Cached identities recount
+    user_changed(user_id)
@@ -0,0 +1,110 @@
+"""Keyset (cursor) pagination helpers."""
+import base64
+import json
+from collections import namedtuple
+from datetime import date, datetime
+
+from flask import abort
+from sqlalchemy import and_, or_
+
+PER_PAGE = 24
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(values):
+    """Encode a tuple of sort key values as an opaque URL-safe cursor."""
+    values = [v.isoformat() if isinstance(v, (date, datetime)) else v
+              for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor back into sort key values typed like `columns`.
+
+    Aborts with a 400 if the cursor has been tampered with.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if len(values) != len(columns):
+            raise ValueError(cursor)
+        return tuple(_coerce(column, value)
+                     for column, value in zip(columns, values))
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+
+
+def _coerce(column, value):
+    python_type = column.type.python_type
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+def _after(columns, values):
+    """Build `(c1, c2, ...) > (v1, v2, ...)` in a form that can use an index.
+
+    Written as `c1 >= v1 AND (c1 > v1 OR (c2 >= v2 AND ...))` so the leading
+    column always gets a plain range condition the planner can seek on.
+    """
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column > value
+    return and_(column >= value,
+                or_(column > value, _after(columns[1:], values[1:])))
+
+
+def _before(columns, values):
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value
+    return and_(column <= value,
+                or_(column < value, _before(columns[1:], values[1:])))
+
+
+def _key(item, columns):
+    return tuple(getattr(item, column.key) for column in columns)
+
+
+def keyset_paginate(query, columns, after=None, before=None,
+                    per_page=PER_PAGE, descending=False):
+    """Return one `Page` of `query` ordered by `columns`.
+
+    `columns` must end in a unique column (normally the primary key) so the
+    ordering is total. Only `per_page + 1` rows are ever fetched, starting
+    from an index seek, so deep pages cost the same as the first one.
+    With `descending` every column is sorted in reverse, which an index on
+    `columns` serves just as well by reading it backwards.
+    """
+    forwards, backwards = (_before, _after) if descending else (_after, _before)
+
+    def order(reverse):
+        return [column.desc() if reverse != descending else column
+                for column in columns]
+
+    if before:
+        values = decode_cursor(before, columns)
+        rows = (query.filter(backwards(columns, values))
+                .order_by(*order(True))
+                .limit(per_page + 1).all())
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        next_cursor = encode_cursor(_key(items[-1], columns)) if items else None
+        prev_cursor = (encode_cursor(_key(items[0], columns))
+                       if has_more else None)
+        return Page(items, next_cursor, prev_cursor)
+
+    if after:
+        query = query.filter(forwards(columns, decode_cursor(after, columns)))
+    rows = query.order_by(*order(False)).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    next_cursor = (encode_cursor(_key(items[-1], columns))
+                   if has_more else None)
+    prev_cursor = (encode_cursor(_key(items[0], columns))
+                   if after and items else None)
+    return Page(items, next_cursor, prev_cursor)
@@ -0,0 +1,271 @@
+""""Fans also like" artist recommendations.
+
+Two artists are similar when the same people favourite both. The shared fan
+counts are kept as a sparse matrix in `artist_cooccurrence` (only non-zero
+cells are stored; the diagonal holds each artist's fan count), and the
+similarity of two artists is the Jaccard index of their fans:
+
+    together / (fans of a + fans of b - together)
+
+The `NEIGHBOURS` most similar artists of each artist are precomputed into
+`artist_neighbour`, so pages only ever read K rows per artist.
+
+Favouriting or unfavouriting an artist updates the matrix cells and the
+neighbour scores of the pairs involved in the same transaction, counting
+pairs of the same users as the rebuild does, so both give the same matrix.
+Other scores drift slightly as fan counts change, and a neighbour pushed
+out of a list isn't replaced until the next full rebuild:
+
+    flask recommendations rebuild
+
+The rebuild is a handful of set-based statements (a self-join of
+`user_artist` grouped by artist pair, then a ranking window), so the
+database does the heavy lifting with its own sorting and temp storage
+rather than holding millions of favourites in Python.
+
+Either way, artists whose neighbours were rewritten get a new
+`Artist.similar_changed_at`, which is part of their pages' validators.
+"""
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import exists, func, select, text
+
+from concert_app.extensions import cache, db
+from concert_app.models import (
+    Artist, artist_cooccurrence, artist_neighbour, user_artist)
+
+# Similar artists kept per artist
+NEIGHBOURS = 10
+
+# People with more favourites than this say little about any one pair and
+# would add favourites-squared pairs, so they only count as fans
+MAX_USER_FAVOURITES = 200
+
+# Favourites of a user that seed their personal suggestions
+MAX_SEEDS = 50
+
+##########################################
+#           Reads                        #
+##########################################
+
+
+def similar_artists(artist_id, limit=NEIGHBOURS):
+    """Return the artists most similar to `artist_id`, best first."""
+    return (Artist.query
+            .join(artist_neighbour,
+                  artist_neighbour.c.neighbour_id == Artist.id)
+            .filter(artist_neighbour.c.artist_id == artist_id)
+            .order_by(artist_neighbour.c.score.desc(), Artist.id)
+            .limit(limit).all())
+
+
+def suggested_artists(favourite_ids, limit=NEIGHBOURS):
+    """Return artists similar to `favourite_ids` but not among them."""
+    seeds = list(favourite_ids)[:MAX_SEEDS]
+    if not seeds:
+        return []
+    return (Artist.query
+            .join(artist_neighbour,
+                  artist_neighbour.c.neighbour_id == Artist.id)
+            .filter(artist_neighbour.c.artist_id.in_(seeds))
+            .filter(~artist_neighbour.c.neighbour_id.in_(seeds))
+            .group_by(Artist.id)
+            .order_by(func.sum(artist_neighbour.c.score).desc(), Artist.id)
+            .limit(limit).all())
+
+##########################################
+#           Incremental updates          #
+##########################################
+
+
+UPSERT_COOCCURRENCE = text(
+    'INSERT INTO artist_cooccurrence (artist_id, other_id, together) '
+    'VALUES (:artist_id, :other_id, :change) '
+    'ON CONFLICT (artist_id, other_id) '
+    'DO UPDATE SET together = artist_cooccurrence.together + :change')
+
+UPSERT_NEIGHBOUR = text(
+    'INSERT INTO artist_neighbour (artist_id, neighbour_id, score) '
+    'VALUES (:artist_id, :neighbour_id, :score) '
+    'ON CONFLICT (artist_id, neighbour_id) DO UPDATE SET score = :score')
+
+TRIM_NEIGHBOURS = text(
+    'DELETE FROM artist_neighbour WHERE artist_id = :artist_id '
+    'AND neighbour_id NOT IN (SELECT neighbour_id FROM artist_neighbour '
+    'WHERE artist_id = :artist_id ORDER BY score DESC, neighbour_id '
+    'LIMIT :limit)')
+
+
+def favourite_added(user_id, artist_id):
+    """Count a new favourite; call after the user_artist row is inserted."""
+    _update(user_id, artist_id, 1)
+
+
+def favourite_removed(user_id, artist_id):
+    """Uncount a favourite; call after the user_artist row is deleted."""
+    _update(user_id, artist_id, -1)
+
+
+def _update(user_id, artist_id, change):
+    others = [row[0] for row in db.session.execute(
+        select([user_artist.c.artist_id])
+        .where(user_artist.c.user_id == user_id)
+        .where(user_artist.c.artist_id != artist_id)
+        .limit(MAX_USER_FAVOURITES + 1))]
+    # The user's favourites with `artist_id` added, or before it was
+    # removed; pairs count under the same limit as in REBUILD
+    favourites = len(others) + 1
+
+    cells = [{'artist_id': artist_id, 'other_id': artist_id,
+              'change': change}]
+    if favourites <= MAX_USER_FAVOURITES:
+        for other in others:
+            cells.append({'artist_id': artist_id, 'other_id': other,
+                          'change': change})
+            cells.append({'artist_id': other, 'other_id': artist_id,
+                          'change': change})
+        changed, rescored = [artist_id], others
+    elif favourites == MAX_USER_FAVOURITES + 1:
+        # Crossing the limit: the user's other pairs stop (or start again)
+        # counting too
+        for other in others:
+            cells.extend({'artist_id': other, 'other_id': another,
+                          'change': -change}
+                         for another in others if another != other)
+        changed, rescored = others, others
+    else:
+        changed, rescored = [], []
+    db.session.execute(UPSERT_COOCCURRENCE, cells)
+    db.session.execute(artist_cooccurrence.delete()
+                       .where(artist_cooccurrence.c.artist_id.in_(
+                           [artist_id] + others))
+                       .where(artist_cooccurrence.c.together <= 0))
+    if changed and rescored:
+        _rescore(changed, rescored)
+
+
+def _rescore(artist_ids, others):
+    """Recompute the scores between each of `artist_ids` and `others`."""
+    c = artist_cooccurrence.c
+    ids = sorted(set(artist_ids) | set(others))
+    fans = dict(db.session.execute(
+        select([c.artist_id, c.together])
+        .where(c.artist_id == c.other_id)
+        .where(c.artist_id.in_(ids))).fetchall())
+    together = {(artist_id, other): shared
+                for artist_id, other, shared in db.session.execute(
+                    select([c.artist_id, c.other_id, c.together])
+                    .where(c.artist_id.in_(artist_ids))
+                    .where(c.other_id.in_(others))
+                    .where(c.artist_id != c.other_id))}
+
+    scores = []
+    for (artist_id, other), shared in together.items():
+        # A missing diagonal (e.g. fans added by hand) counts as no other
+        # fans than these
+        union = (max(fans.get(artist_id, 0), shared)
+                 + max(fans.get(other, 0), shared) - shared)
+        score = shared / union
+        scores.append({'artist_id': artist_id, 'neighbour_id': other,
+                       'score': score})
+        scores.append({'artist_id': other, 'neighbour_id': artist_id,
+                       'score': score})
+
+    n = artist_neighbour.c
+    if scores:
+        db.session.execute(UPSERT_NEIGHBOUR, scores)
+    # Pairs without shared fans any more
+    for left, right in [(artist_ids, others), (others, artist_ids)]:
+        db.session.execute(artist_neighbour.delete()
+                           .where(n.artist_id.in_(left))
+                           .where(n.neighbour_id.in_(right))
+                           .where(~exists().where(
+                               (c.artist_id == n.artist_id)
+                               & (c.other_id == n.neighbour_id))))
+    db.session.execute(TRIM_NEIGHBOURS, [
+        {'artist_id': id, 'limit': NEIGHBOURS} for id in ids])
+    similar_changed(db.session, ids)
+
+
+def similar_changed(conn, artist_ids=None):
+    """Stamp the artists whose neighbour lists were rewritten, or all.
+
+    Their pages and their fans' profiles then get new validators.
+    """
+    artist = Artist.__table__
+    update = artist.update().values(
+        similar_changed_at=datetime.utcnow(),
+        # Not a change to the artist itself
+        updated_at=artist.c.updated_at)
+    if artist_ids is not None:
+        update = update.where(artist.c.id.in_(artist_ids))
+    conn.execute(update)
+
+##########################################
+#           Full rebuild                 #
+##########################################
+
+
+REBUILD = [
+    'DELETE FROM artist_neighbour',
+    'DELETE FROM artist_cooccurrence',
+    # Diagonal: every artist's fan count
+    'INSERT INTO artist_cooccurrence (artist_id, other_id, together) '
+    'SELECT artist_id, artist_id, count(*) FROM user_artist '
+    'WHERE user_id IS NOT NULL GROUP BY artist_id',
+    # Off the diagonal: fans shared by each pair
+    'INSERT INTO artist_cooccurrence (artist_id, other_id, together) '
+    'SELECT a.artist_id, b.artist_id, count(*) '
+    'FROM user_artist a JOIN user_artist b ON b.user_id = a.user_id '
+    'WHERE a.artist_id != b.artist_id AND a.user_id IN ('
+    ' SELECT user_id FROM user_artist GROUP BY user_id '
+    ' HAVING count(*) <= :max_favourites) '
+    'GROUP BY a.artist_id, b.artist_id',
+    # Keep the best NEIGHBOURS of each artist
+    'INSERT INTO artist_neighbour (artist_id, neighbour_id, score) '
+    'SELECT artist_id, other_id, score FROM ('
+    ' SELECT artist_id, other_id, score, row_number() OVER ('
+    '  PARTITION BY artist_id ORDER BY score DESC, other_id) AS neighbour_rank '
+    ' FROM (SELECT c.artist_id, c.other_id, '
+    '   c.together * 1.0 / (a.together + b.together - c.together) AS score '
+    '  FROM artist_cooccurrence c '
+    '  JOIN artist_cooccurrence a '
+    '   ON a.artist_id = c.artist_id AND a.other_id = c.artist_id '
+    '  JOIN artist_cooccurrence b '
+    '   ON b.artist_id = c.other_id AND b.other_id = c.other_id '
+    '  WHERE c.artist_id != c.other_id) scored'
+    ') ranked WHERE neighbour_rank <= :neighbours',
+]
+
+
+def rebuild(conn):
+    """Recompute the co-occurrence matrix and every neighbour list."""
+    for statement in REBUILD:
+        conn.execute(text(statement), max_favourites=MAX_USER_FAVOURITES,
+                     neighbours=NEIGHBOURS)
+    similar_changed(conn)
+
+
+recommendations_cli = AppGroup(
+    'recommendations', help='Maintain the "Fans also like" lists.')
+
+
+@recommendations_cli.command('rebuild')
+@with_appcontext
+def rebuild_command():
+    """Rebuild every artist's similar artists from scratch."""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        rebuild(conn)
+        pairs = conn.execute(
+            'SELECT count(*) FROM artist_cooccurrence '
+            'WHERE artist_id != other_id').scalar()
+        neighbours = conn.execute(
+            'SELECT count(*) FROM artist_neighbour').scalar()
+    # Pages listing neighbours depend on favourites
+    cache.bump('favourites')
+    click.echo(f'Rebuilt {pairs} artist pairs and {neighbours} neighbours '
+               f'in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,102 @@
+"""Send safe reads to read replicas.
+
+Replicas are extra Flask-SQLAlchemy binds listed in `REPLICA_BINDS` (see
+`DATABASE_REPLICA_URLS` in config.py). A view decorated with
+`replica_reads`, or any request that calls `use_replica()`, reads from one
+replica picked at random for the whole request. Everything else uses the
+primary, and so does any session as soon as it writes: a flush, an
+INSERT/UPDATE/DELETE or any textual SQL but a SELECT switches the rest of
+the request to the primary.
+
+Replicas lag behind the primary, so once a visitor's request commits a
+write their Flask session remembers it, and for `READ_YOUR_WRITES_SECONDS`
+afterwards their reads stay on the primary too. Pages and fragments
+rendered for the shared cache in that long after a bump of their
+namespaces read from the primary as well (see `Cache.cached_page`).
+"""
+import random
+import re
+import time
+from functools import wraps
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+# Flask session key holding when the visitor's last write stops mattering
+PRIMARY_UNTIL = '_primary_until'
+
+# Textual SQL that only reads; anything else counts as a write
+READ_SQL = re.compile(r'\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+
+def is_write(clause):
+    """Return True if executing `clause` may change the database."""
+    if isinstance(clause, UpdateBase):
+        return True
+    return (isinstance(clause, TextClause)
+            and not READ_SQL.match(clause.text))
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to a replica when asked to."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or is_write(clause):
+            self.info['wrote'] = True
+        if self.info.get('wrote') or not self.info.get('use_replica'):
+            return super().get_bind(mapper, clause)
+        if 'replica' not in self.info:
+            self.info['replica'] = random.choice(
+                self.app.config['REPLICA_BINDS'])
+        return get_state(self.app).db.get_engine(
+            self.app, bind=self.info['replica'])
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """`SQLAlchemy` whose sessions can read from replicas."""
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_BINDS', [])
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+        super().init_app(app)
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_commit', _remember_write)
+        return factory
+
+
+def reading_own_writes():
+    """Return True if the visitor wrote something moments ago."""
+    return session.get(PRIMARY_UNTIL, 0) > time.time()
+
+
+def use_replica():
+    """Route the rest of this request's reads to a replica, if it's safe."""
+    if (current_app.config['REPLICA_BINDS']
+            and request.method in ('GET', 'HEAD')
+            and not reading_own_writes()):
+        get_state(current_app).db.session.info['use_replica'] = True
+
+
+def use_primary():
+    """Route the rest of this request's reads back to the primary."""
+    get_state(current_app).db.session.info.pop('use_replica', None)
+
+
+def replica_reads(view):
+    """Serve GETs of the decorated view from a read replica."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _remember_write(db_session):
+    if (db_session.info.get('wrote') and has_request_context()
+            and current_app.config['REPLICA_BINDS']):
+        session[PRIMARY_UNTIL] = (
+            time.time() + current_app.config['READ_YOUR_WRITES_SECONDS'])
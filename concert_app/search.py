@@ -0,0 +1,143 @@
+"""Full-text search over artists and concerts.
+
+On SQLite the text columns are indexed by FTS5 tables that mirror `artist`
+and `concert` (external content) and are kept current by triggers, so every
+insert or edit - from the forms or anywhere else - updates the index
+incrementally. On Postgres a GIN index over a `to_tsvector` expression does
+the same job without any extra tables.
+"""
+import re
+from collections import namedtuple
+
+from sqlalchemy import DDL, event, text
+
+from concert_app.extensions import db
+from concert_app.models import Artist, Concert
+
+PER_PAGE = 20
+
+# Deeper pages than this are not worth ranking
+MAX_PAGE = 25
+
+# Search terms beyond this many are ignored
+MAX_TERMS = 8
+
+SearchResults = namedtuple('SearchResults', ['items', 'has_next'])
+
+# table -> (indexed columns, relative weight of each column)
+INDEXED = {
+    'artist': (('name', 'genre', 'hometown', 'biography'),
+               (10.0, 4.0, 2.0, 1.0)),
+    'concert': (('name', 'venue', 'address'), (10.0, 4.0, 2.0)),
+}
+
+
+def _sqlite_ddl(table):
+    columns, _ = INDEXED[table]
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    delete = (f"INSERT INTO {table}_fts({table}_fts, rowid, {names}) "
+              f"VALUES ('delete', old.id, {old});")
+    insert = f"INSERT INTO {table}_fts(rowid, {names}) VALUES (new.id, {new});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+        f"{names}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON "
+        f"{table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON "
+        f"{table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF "
+        f"{names} ON {table} BEGIN {delete} {insert} END",
+    ]
+
+
+def _postgres_document(table):
+    columns, _ = INDEXED[table]
+    return ("to_tsvector('english', "
+            + " || ' ' || ".join(f"coalesce({column}, '')"
+                                 for column in columns)
+            + ")")
+
+
+def _postgres_ddl(table):
+    return [f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+            f"USING GIN ({_postgres_document(table)})"]
+
+
+def install(conn, table, rebuild=False):
+    """Create the search index for `table` on `conn`.
+
+    Pass `rebuild=True` to index rows that already exist, e.g. when
+    migrating a populated database.
+    """
+    if conn.dialect.name == 'sqlite':
+        for statement in _sqlite_ddl(table):
+            conn.execute(statement)
+        if rebuild:
+            conn.execute(f"INSERT INTO {table}_fts({table}_fts) "
+                         f"VALUES ('rebuild')")
+    elif conn.dialect.name == 'postgresql':
+        for statement in _postgres_ddl(table):
+            conn.execute(statement)
+
+
+for _table in (Artist.__table__, Concert.__table__):
+    event.listen(
+        _table, 'after_create',
+        lambda target, connection, **kw: install(connection, target.name))
+    event.listen(
+        _table, 'before_drop',
+        DDL(f'DROP TABLE IF EXISTS {_table.name}_fts')
+        .execute_if(dialect='sqlite'))
+
+
+def search_terms(query):
+    """Turn free text into a list of search terms, or None if there are none."""
+    terms = re.findall(r'\w+', query.lower())[:MAX_TERMS]
+    return terms or None
+
+
+def _ranked_ids(table, terms, page):
+    columns, weights = INDEXED[table]
+    offset = (page - 1) * PER_PAGE
+    if db.engine.dialect.name == 'postgresql':
+        document = _postgres_document(table)
+        sql = text(
+            f"SELECT id FROM {table}, to_tsquery('english', :query) query "
+            f"WHERE {document} @@ query "
+            f"ORDER BY ts_rank({document}, query) DESC, id "
+            f"LIMIT :limit OFFSET :offset")
+        match = ' & '.join(f'{term}:*' for term in terms)
+    else:
+        weight_args = ', '.join(str(weight) for weight in weights)
+        sql = text(
+            f"SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH :query "
+            f"ORDER BY bm25({table}_fts, {weight_args}), rowid "
+            f"LIMIT :limit OFFSET :offset")
+        match = ' '.join(f'"{term}"*' for term in terms)
+    rows = db.session.execute(
+        sql, {'query': match, 'limit': PER_PAGE + 1, 'offset': offset})
+    return [row[0] for row in rows]
+
+
+def _search(model, terms, page):
+    ids = _ranked_ids(model.__tablename__, terms, page)
+    has_next = len(ids) > PER_PAGE and page < MAX_PAGE
+    ids = ids[:PER_PAGE]
+    if not ids:
+        return SearchResults([], False)
+    by_id = {item.id: item
+             for item in model.query.filter(model.id.in_(ids))}
+    return SearchResults([by_id[id] for id in ids if id in by_id], has_next)
+
+
+def search_artists(terms, page=1):
+    """Return one page of artists matching `terms`, best match first."""
+    return _search(Artist, terms, page)
+
+
+def search_concerts(terms, page=1):
+    """Return one page of concerts matching `terms`, best match first."""
+    return _search(Concert, terms, page)
@@ -0,0 +1,250 @@
+"""Synthetic catalogue for benchmarks.
+
+    flask seed --scale 0.01
+    flask seed --artists 100000 --concerts 1000000 --users 500000
+
+Generates artists, concerts, users, favourites, attendance and a month of
+activity for the trending lists with the skew of real traffic: a few
+artists draw most of the concerts and fans and a few concerts most of the
+guests (Zipf), while most users favourite or attend a handful of things and
+a few favourite hundreds (Pareto). Concerts cluster around a fixed set of
+cities, some without coordinates, and run from six months ago to a year
+ahead.
+
+Rows are named predictably (`seed_username(n)`, 'Artist 000001', ...) and
+every user's password is `PASSWORD`, so `benchmarks/load.py` can find pages
+and log in. The same `--seed` always produces the same data. Seeding goes
+into an empty database; run `flask db upgrade` first.
+"""
+import random
+import time
+from bisect import bisect
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from concert_app import counters, recommendations, trending
+from concert_app.auth.passwords import hash_password
+from concert_app.extensions import db, cache
+from concert_app.models import (
+    Artist, Concert, User, activity_event, artist_neighbour,
+    location_geohash, user_artist, user_concert)
+
+# Counts at --scale 1
+ARTISTS = 100000
+CONCERTS = 1000000
+USERS = 500000
+
+# Average favourite artists and attended concerts per user
+FAVOURITES = 10
+ATTENDING = 5
+
+# Activity events per user over the last ACTIVITY_DAYS
+ACTIVITY = 2
+ACTIVITY_DAYS = 30
+
+# Most favourites or attended concerts one user gets
+MAX_PER_USER = 500
+
+# Password of every seeded user
+PASSWORD = 'benchmark'
+
+# Rows per INSERT and per transaction
+BATCH_SIZE = 10000
+
+GENRES = ['Punk', 'Rock', 'Jazz', 'Folk', 'Hip Hop', 'Electronic', 'Metal',
+          'Country', 'Blues', 'Classical', 'Pop', 'Soul']
+
+# Concerts are spread around this many cities
+CITIES = 200
+
+# Share of concerts entered without coordinates
+UNLOCATED = 0.3
+
+
+def seed_username(number):
+    return f'user{number:06d}'
+
+
+def seed_artist_name(number):
+    return f'Artist {number:06d}'
+
+
+class Zipf(object):
+    """Draws 1..n with the probability of k proportional to 1 / k**s."""
+
+    def __init__(self, n, s=1.0):
+        self.cumulative = list(accumulate(1 / k ** s for k in range(1, n + 1)))
+
+    def draw(self, rng):
+        return bisect(self.cumulative, rng.random() * self.cumulative[-1]) + 1
+
+
+def pareto_count(rng, mean, most):
+    """A per-user count with the given mean and a long tail."""
+    # A Pareto variate with shape 1.5 has mean 3
+    return min(most, int(rng.paretovariate(1.5) * mean / 3))
+
+
+def batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert(table, rows):
+    count = 0
+    for batch in batches(rows):
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        count += len(batch)
+    return count
+
+
+def advance_sequences(conn):
+    """Move Postgres id sequences past the ids seeding chose itself.
+
+    Otherwise the first signup or import after seeding collides with a
+    seeded row. SQLite picks max(id) + 1 on its own.
+    """
+    if conn.dialect.name != 'postgresql':
+        return
+    for table in (Artist.__table__, Concert.__table__, User.__table__):
+        name = conn.dialect.identifier_preparer.format_table(table)
+        conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            f'(SELECT max(id) FROM {name}))'), table=name)
+
+##########################################
+#           Generators                   #
+##########################################
+
+
+def artist_rows(rng, artists, now):
+    for number in range(1, artists + 1):
+        yield dict(id=number, name=seed_artist_name(number),
+                   hometown=f'City {rng.randrange(CITIES)}',
+                   genre=rng.choice(GENRES),
+                   biography=f'{rng.choice(GENRES)} band, number {number}',
+                   updated_at=now)
+
+
+def concert_rows(rng, concerts, artists, now):
+    popular = Zipf(artists)
+    cities = [(rng.uniform(-40, 60), rng.uniform(-125, 150))
+              for _ in range(CITIES)]
+    today = date.today()
+    for number in range(1, concerts + 1):
+        latitude = longitude = None
+        if rng.random() >= UNLOCATED:
+            city_latitude, city_longitude = rng.choice(cities)
+            latitude = max(-90, min(90, rng.gauss(city_latitude, 0.2)))
+            longitude = max(-180, min(180, rng.gauss(city_longitude, 0.2)))
+        yield dict(id=number, name=f'Show {number}',
+                   price=rng.randrange(0, 200), venue=f'Venue {number % 997}',
+                   address=f'{number % 1000} Main Street',
+                   date=today + timedelta(days=rng.randrange(-180, 365)),
+                   latitude=latitude, longitude=longitude,
+                   geohash=location_geohash(latitude, longitude),
+                   artist_id=popular.draw(rng), updated_at=now)
+
+
+def user_rows(users, password, now):
+    for number in range(1, users + 1):
+        yield dict(id=number, username=seed_username(number),
+                   password=password, updated_at=now)
+
+
+def pair_rows(rng, users, items, mean, column):
+    """Distinct (user, item) pairs with Zipf items and Pareto counts."""
+    popular = Zipf(items)
+    for user_id in range(1, users + 1):
+        count = min(pareto_count(rng, mean, MAX_PER_USER), items)
+        chosen = set()
+        # Popular items repeat, so stop trying after a while
+        for _ in range(count * 3):
+            if len(chosen) == count:
+                break
+            chosen.add(popular.draw(rng))
+        for item_id in sorted(chosen):
+            yield {'user_id': user_id, column: item_id}
+
+
+def activity_rows(rng, users, artists, concerts, count, now):
+    """Attends and favourites of popular things spread over recent days."""
+    popular = {'artist': Zipf(artists), 'concert': Zipf(concerts)}
+    for _ in range(count):
+        subject = rng.choice(['artist', 'concert'])
+        yield dict(user_id=rng.randint(1, users), subject=subject,
+                   subject_id=popular[subject].draw(rng), change=1,
+                   created_at=now - timedelta(
+                       seconds=rng.randrange(ACTIVITY_DAYS * 86400)))
+
+
+@click.command('seed')
+@click.option('--scale', default=1.0, show_default=True,
+              help='Multiplies the default counts.')
+@click.option('--artists', type=int, help=f'Artists (default {ARTISTS}).')
+@click.option('--concerts', type=int, help=f'Concerts (default {CONCERTS}).')
+@click.option('--users', type=int, help=f'Users (default {USERS}).')
+@click.option('--favourites', default=FAVOURITES, show_default=True,
+              help='Average favourite artists per user.')
+@click.option('--attending', default=ATTENDING, show_default=True,
+              help='Average attended concerts per user.')
+@click.option('--activity', default=ACTIVITY, show_default=True,
+              help='Average trending activity events per user.')
+@click.option('--seed', 'seed', default=1, show_default=True,
+              help='Random seed; the same seed gives the same data.')
+@with_appcontext
+def seed_command(scale, artists, concerts, users, favourites, attending,
+                 activity, seed):
+    """Fill an empty database with a synthetic catalogue."""
+    artists = artists or max(1, int(ARTISTS * scale))
+    concerts = concerts or max(1, int(CONCERTS * scale))
+    users = users or max(1, int(USERS * scale))
+    if db.session.query(Artist.id).first() or db.session.query(User.id).first():
+        raise click.ClickException('The database already has data in it.')
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+
+    def step(label, count):
+        click.echo(f'{label}: {count} ({time.perf_counter() - started:.1f}s)')
+
+    step('Artists', insert(Artist.__table__, artist_rows(rng, artists, now)))
+    step('Concerts', insert(Concert.__table__,
+                            concert_rows(rng, concerts, artists, now)))
+    # Hashing once keeps seeding fast; every user shares the password
+    step('Users', insert(User.__table__,
+                         user_rows(users, hash_password(PASSWORD), now)))
+    step('Favourites', insert(user_artist, pair_rows(
+        rng, users, artists, favourites, 'artist_id')))
+    step('Attending', insert(user_concert, pair_rows(
+        rng, users, concerts, attending, 'concert_id')))
+
+    # Sorted by time, as the routes would have logged them
+    events = sorted(activity_rows(rng, users, artists, concerts,
+                                  users * activity, now),
+                    key=lambda row: row['created_at'])
+    insert(activity_event, events)
+    step('Activity', trending.aggregate(db.engine))
+
+    with db.engine.begin() as conn:
+        advance_sequences(conn)
+        counters.reconcile(conn)
+        recommendations.rebuild(conn)
+    step('Recommendations', db.session.query(artist_neighbour).count())
+    # Fresh planner statistics, as a long-running database would have
+    with db.engine.begin() as conn:
+        conn.execute('ANALYZE')
+    cache.bump('artists', 'concerts', 'attendance', 'favourites', 'trending')
+    step('Done', artists + concerts + users)
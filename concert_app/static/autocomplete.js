@@ -0,0 +1,36 @@
+// Fills the artist box's <datalist> from /artist/autocomplete as the user
+// types, and copies the chosen artist's id into the hidden form field.
+// Suggestions show the hometown (and, failing that, the id) so artists
+// sharing a name each get their own entry.
+document.querySelectorAll('input[data-autocomplete]').forEach(function (box) {
+    var list = document.getElementById(box.getAttribute('list'));
+    var target = document.getElementById(box.dataset.target);
+    var ids = {};
+    var pending = null;
+
+    function label(artist) {
+        var text = artist.name + ' (' + artist.hometown + ')';
+        return text in ids ? text + ' #' + artist.id : text;
+    }
+
+    box.addEventListener('input', function () {
+        target.value = ids[box.value] || '';
+        clearTimeout(pending);
+        pending = setTimeout(function () {
+            var url = box.dataset.autocomplete + '?q=' + encodeURIComponent(box.value);
+            fetch(url).then(function (response) {
+                return response.json();
+            }).then(function (data) {
+                list.innerHTML = '';
+                ids = {};
+                data.artists.forEach(function (artist) {
+                    var option = document.createElement('option');
+                    option.value = label(artist);
+                    list.appendChild(option);
+                    ids[option.value] = artist.id;
+                });
+                target.value = ids[box.value] || '';
+            });
+        }, 150);
+    });
+});
@@ -0,0 +1,15 @@
+// Offers to fill the nearby search with the browser's location.
+(function () {
+    var button = document.getElementById('locate');
+    if (!button || !navigator.geolocation) {
+        return;
+    }
+    button.hidden = false;
+    button.addEventListener('click', function () {
+        navigator.geolocation.getCurrentPosition(function (position) {
+            document.getElementById('lat').value = position.coords.latitude.toFixed(5);
+            document.getElementById('lon').value = position.coords.longitude.toFixed(5);
+            button.form.submit();
+        });
+    });
+})();
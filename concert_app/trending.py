@@ -0,0 +1,224 @@
+"""Trending concerts and artists.
+
+Attending, favouriting and undoing either append a row to `activity_event`
+(see `Membership`). Nothing reads that log on a page: a background job folds
+new events into per-hour and per-day counts in `activity_bucket`,
+
+    flask trending aggregate --every 60
+
+and the trending lists sum the few buckets that cover their window:
+
+    24h  the last 24 hourly buckets
+    7d   the last 7 daily buckets
+    30d  the last 30 daily buckets
+
+Each batch stamps its events' `folded_at` in the same transaction as the
+counts it adds, so a job that is stopped or crashes starts again with the
+events the last committed batch didn't reach, and an event is never
+counted twice. Events are picked by that stamp rather than by an id high
+water mark: on PostgreSQL ids are handed out before commit, so an event
+can commit after a higher id has been folded, and it is simply folded by
+the next run. Buckets and events that no window reads any more are
+pruned as the job runs.
+"""
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select, text
+
+from concert_app.extensions import db, cache
+from concert_app.models import (
+    Artist, Concert, activity_bucket, activity_event)
+
+# Window name: (bucket period, buckets summed)
+WINDOWS = {
+    '24h': ('hour', 24),
+    '7d': ('day', 7),
+    '30d': ('day', 30),
+}
+
+PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+SUBJECTS = ['concert', 'artist']
+
+# Concerts and artists listed per window
+TRENDING_LIMIT = 10
+
+# Events folded per transaction
+BATCH_SIZE = 10000
+
+# Buckets of each period kept once no window reaches them
+KEEP_BUCKETS = {'hour': 48, 'day': 60}
+
+# Folded events are kept this long, then deleted
+KEEP_EVENTS = timedelta(days=30)
+
+
+def bucket_start(moment, period):
+    """Return the start of the `period` bucket `moment` falls in."""
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def window_start(window, now=None):
+    """Return the start of the oldest bucket summed for `window`."""
+    period, buckets = WINDOWS[window]
+    current = bucket_start(now or datetime.utcnow(), period)
+    return current - PERIODS[period] * (buckets - 1)
+
+##########################################
+#           Reads                        #
+##########################################
+
+
+def _ranking(subject, window, limit):
+    """Return [(subject id, score)] for `window`, highest score first."""
+    b = activity_bucket.c
+    period, _ = WINDOWS[window]
+    score = func.sum(b.score)
+    return db.session.execute(
+        select([b.subject_id, score])
+        .where(b.subject == subject)
+        .where(b.period == period)
+        .where(b.starts >= window_start(window))
+        .group_by(b.subject_id)
+        .having(score > 0)
+        .order_by(score.desc(), b.subject_id)
+        .limit(limit)).fetchall()
+
+
+def _load(model, ranking):
+    if not ranking:
+        return []
+    rows = {row.id: row for row in model.query.filter(
+        model.id.in_([id for id, _ in ranking]))}
+    return [(rows[id], score) for id, score in ranking if id in rows]
+
+
+def trending_concerts(window, limit=TRENDING_LIMIT):
+    """Return (concert, new guests) for the concerts trending in `window`."""
+    return _load(Concert, _ranking('concert', window, limit))
+
+
+def trending_artists(window, limit=TRENDING_LIMIT):
+    """Return (artist, new fans) for the artists trending in `window`."""
+    return _load(Artist, _ranking('artist', window, limit))
+
+##########################################
+#           Aggregation                  #
+##########################################
+
+
+UPSERT_BUCKET = text(
+    'INSERT INTO activity_bucket (subject, period, starts, subject_id, score) '
+    'VALUES (:subject, :period, :starts, :subject_id, :score) '
+    'ON CONFLICT (subject, period, starts, subject_id) '
+    'DO UPDATE SET score = activity_bucket.score + :score')
+
+
+class AggregationOverlap(RuntimeError):
+    """Another job claimed some of the events of this batch first."""
+
+
+def aggregate_batch(conn, batch_size=BATCH_SIZE):
+    """Fold the next `batch_size` unfolded events into the buckets.
+
+    Call in a transaction; returns how many events were folded.
+    """
+    e = activity_event.c
+    events = conn.execute(
+        select([e.id, e.subject, e.subject_id, e.change, e.created_at])
+        .where(e.folded_at.is_(None)).order_by(e.id)
+        .limit(batch_size)).fetchall()
+    if not events:
+        return 0
+
+    # Stamping the events first claims the batch: a second job that read
+    # the same events stamps fewer of them and gives up
+    claimed = conn.execute(
+        activity_event.update()
+        .where(e.id.in_([event.id for event in events]))
+        .where(e.folded_at.is_(None))
+        .values(folded_at=datetime.utcnow())).rowcount
+    if claimed != len(events):
+        raise AggregationOverlap('Another job is folding the same events.')
+
+    scores = Counter()
+    for event in events:
+        for period in PERIODS:
+            starts = bucket_start(event.created_at, period)
+            scores[event.subject, period, starts, event.subject_id] += (
+                event.change)
+    changed = [dict(subject=subject, period=period, starts=starts,
+                    subject_id=subject_id, score=score)
+               for (subject, period, starts, subject_id), score
+               in scores.items() if score]
+    if changed:
+        conn.execute(UPSERT_BUCKET, changed)
+    return len(events)
+
+
+def prune(conn, now=None):
+    """Delete buckets and folded events no window reads any more."""
+    now = now or datetime.utcnow()
+    b = activity_bucket.c
+    for period, kept in KEEP_BUCKETS.items():
+        oldest = bucket_start(now, period) - PERIODS[period] * kept
+        for subject in SUBJECTS:
+            conn.execute(activity_bucket.delete()
+                         .where(b.subject == subject)
+                         .where(b.period == period)
+                         .where(b.starts < oldest))
+    conn.execute(activity_event.delete()
+                 .where(activity_event.c.folded_at.isnot(None))
+                 .where(activity_event.c.created_at < now - KEEP_EVENTS))
+
+
+def aggregate(engine, batch_size=BATCH_SIZE):
+    """Fold every pending event, one transaction per batch."""
+    folded = 0
+    while True:
+        with engine.begin() as conn:
+            count = aggregate_batch(conn, batch_size)
+        folded += count
+        if count < batch_size:
+            break
+    with engine.begin() as conn:
+        prune(conn)
+    return folded
+
+
+trending_cli = AppGroup('trending', help='Maintain the trending lists.')
+
+
+@trending_cli.command('aggregate')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True,
+              help='Events folded per transaction.')
+@click.option('--every', type=float,
+              help='Keep running, aggregating every this many seconds.')
+@with_appcontext
+def aggregate_command(batch_size, every):
+    """Fold new activity into the hourly and daily counts."""
+    while True:
+        started = time.perf_counter()
+        try:
+            folded = aggregate(db.engine, batch_size)
+        except AggregationOverlap as error:
+            if every is None:
+                raise
+            # The other job folds those events; the next tick gets the rest.
+            # Batches before the overlap did commit
+            cache.bump('trending')
+            click.echo(f'{error} Trying again in {every:g}s.', err=True)
+        else:
+            if folded:
+                cache.bump('trending')
+            click.echo(f'Aggregated {folded} events '
+                       f'in {time.perf_counter() - started:.2f}s')
+        if every is None:
+            break
+        time.sleep(every)